@@ -1,25 +1,292 @@
 import tkinter as tk
-from tkinter import messagebox, ttk, simpledialog
+from tkinter import messagebox, ttk, simpledialog, filedialog
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
 from reportlab.pdfgen import canvas
 from reportlab.platypus import Table, TableStyle
 import sqlite3
-from datetime import datetime
+from datetime import datetime, date, timedelta
+import calendar
+import math
 from reportlab.lib.pagesizes import A5
 from reportlab.lib.pagesizes import landscape
 import os
+import io
+import gzip
+import json
+import shutil
+import argparse
+import tempfile
+import socket
+import struct
+import sys
+import zlib
+import bisect
+import csv
+import hashlib
+import hmac
+import uuid
+import multiprocessing
+import random
+import unicodedata
+from xml.sax.saxutils import escape, quoteattr
+from array import array
+import threading
+import time
 from ttkthemes import ThemedTk
+try:
+    import numpy as np  # Opcional: solo lo necesita la pestaña de Análisis
+except ImportError:
+    np = None
+try:
+    import tomllib  # Python 3.11+; en versiones anteriores se usa tomli si está instalado
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
 import tkinter.font as font
 from tkinter import PhotoImage  # Para manejar los íconos
 
 
+# =================== AJUSTES Y TIENDAS =================== #
+# Valores por defecto; se pueden cambiar en el archivo TOML (comunes o por tienda) y en la tabla ajustes
+AJUSTES_POR_DEFECTO = {
+    "nombre": "FERRETERIA JJBARJA",
+    "direccion": "C/San Maximiliano 57",
+    "codigo_postal": "28017",
+    "poblacion": "Madrid",
+    "provincia": "Madrid",
+    "email": "juanjobarja@gmail.com",
+    "telefono": "688 902 949",
+    "nif": "33338853P",
+    "iva": 21,
+    "pie_factura": ("Para cambios y devoluciones, dispone de 15 días; el artículo debe estar en perfecto estado y con su ticket.\n"
+                    "Las devoluciones se efectuarán mediante vale sin fecha de caducidad. No se admiten cambios en herramientas,\n"
+                    "salvo defecto de fábrica. Todos los artículos tienen garantía según RDL 1/2007 del 16 de noviembre."),
+    "pie_albaran": "No se admiten reclamaciones ni devoluciones pasados 7 días.",
+    "pie_ticket": "¡Gracias por su visita!",
+    "serie_factura": "",
+    "serie_rectificativa": "",
+    "serie_albaran": "",
+    "serie_ticket": "",
+    "impresora_tickets": "archivo:",
+    "salida": "~/Desktop",
+    "datos": "",        # Directorio de copias, archivo, analítica y carritos; vacío = el de la tienda
+    "base_datos": "",   # Vacío = ferreteria.db dentro del directorio de datos
+    "sincronizacion": "",  # Carpeta compartida o host:puerto de otra tienda; vacío = sin sincronización
+    "clave_sincronizacion": "",  # Secreto compartido por las tiendas que sincronizan por red
+}
+# Se leen solo del archivo TOML: hacen falta antes de poder abrir la base de datos
+AJUSTES_DE_ARRANQUE = ("datos", "base_datos")
+TIENDA_POR_DEFECTO = "principal"
+INTERVALO_RECARGA_AJUSTES = 2.0  # Segundos entre comprobaciones de cambios en el TOML o en la tabla
+cache_ajustes = {"clave": None, "configuracion": None, "valores": None, "comprobado": 0.0}
+bloqueo_ajustes = threading.Lock()  # El hilo de impresión también lee los ajustes
+
+
+def ruta_configuracion():
+    """Ruta del archivo de configuración: la variable FERRETERIA_CONFIG si existe, si no ~/ferreteria.toml."""
+    return os.environ.get("FERRETERIA_CONFIG") or os.path.join(os.path.expanduser("~"), "ferreteria.toml")
+
+
+def leer_configuracion_toml():
+    """Lee el archivo TOML de configuración. Devuelve {} si no existe (o si no hay lector de TOML instalado)."""
+    ruta = ruta_configuracion()
+    if tomllib is None or not os.path.exists(ruta):
+        return {}
+    with open(ruta, "rb") as f:
+        return tomllib.load(f)
+
+
+def tiendas_configuradas(configuracion=None):
+    """Nombres de las tiendas definidas en la sección [tiendas] del TOML."""
+    configuracion = leer_configuracion_toml() if configuracion is None else configuracion
+    return list(configuracion.get("tiendas", {}))
+
+
+def tienda_actual(configuracion=None):
+    """Tienda en uso: la variable FERRETERIA_TIENDA, la clave 'tienda' del TOML o la primera configurada."""
+    configuracion = leer_configuracion_toml() if configuracion is None else configuracion
+    tiendas = tiendas_configuradas(configuracion)
+    return (os.environ.get("FERRETERIA_TIENDA") or configuracion.get("tienda")
+            or (tiendas[0] if tiendas else TIENDA_POR_DEFECTO))
+
+
+def convertir_ajuste(clave, valor):
+    """Convierte un valor guardado como texto al tipo del valor por defecto."""
+    if isinstance(AJUSTES_POR_DEFECTO.get(clave), (int, float)) and not isinstance(valor, (int, float)):
+        numero = float(valor)
+        return int(numero) if numero.is_integer() else numero
+    return valor
+
+
+def configuracion_tienda(tienda, configuracion):
+    """Ajustes de una tienda sin contar la base de datos: por defecto, comunes del TOML y sección de la tienda."""
+    valores = dict(AJUSTES_POR_DEFECTO)
+    valores.update({k: v for k, v in configuracion.items() if k in AJUSTES_POR_DEFECTO})
+    valores.update(configuracion.get("tiendas", {}).get(tienda, {}))
+    if not valores["datos"]:
+        # La tienda sin configurar conserva las rutas de siempre (~/ferreteria.db, ~/ferreteria_copias...)
+        valores["datos"] = "~" if tienda == TIENDA_POR_DEFECTO else f"~/ferreteria_{tienda}"
+    valores["datos"] = os.path.expanduser(valores["datos"])
+    valores["base_datos"] = os.path.expanduser(valores["base_datos"] or os.path.join(valores["datos"], "ferreteria.db"))
+    return valores
+
+
+def ajustes_guardados(ruta_db):
+    """Ajustes cambiados desde el programa (tabla ajustes) y su versión. Sin tabla o sin base de datos, ({}, None).
+
+    Cualquier otro error (por ejemplo, la base bloqueada) se lanza: tomar los valores por defecto
+    pondría otra serie u otro IVA en las facturas que se emitan mientras tanto.
+    """
+    if not os.path.exists(ruta_db):
+        return {}, None
+    conn = sqlite3.connect(ruta_db)
+    try:
+        guardados = dict(conn.execute("SELECT clave, valor FROM ajustes").fetchall())
+    except sqlite3.OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+        guardados = {}
+    finally:
+        conn.close()
+    return guardados, guardados.pop("_version", None)
+
+
+def huella_fuentes_ajustes():
+    """Lo que cambia cuando hay que recargar: tienda, fecha del TOML y versión de la tabla de ajustes."""
+    ruta = ruta_configuracion()
+    mtime = os.path.getmtime(ruta) if os.path.exists(ruta) else None
+    return os.environ.get("FERRETERIA_TIENDA"), os.environ.get("FERRETERIA_DB"), mtime
+
+
+def ajustes(forzar=False):
+    """Devuelve los ajustes de la tienda actual, cargados una vez y guardados en caché.
+
+    Cada INTERVALO_RECARGA_AJUSTES segundos como mucho se comprueba si el TOML o la tabla
+    han cambiado, y en ese caso se recargan sin reiniciar el programa. Si el TOML nuevo
+    tiene errores, o la tabla de ajustes no se puede leer, se siguen usando los ajustes anteriores.
+    """
+    with bloqueo_ajustes:
+        ahora = time.monotonic()
+        entorno = (os.environ.get("FERRETERIA_TIENDA"), os.environ.get("FERRETERIA_DB"))
+        if (not forzar and cache_ajustes["valores"] is not None and entorno == cache_ajustes["clave"][0][:2]
+                and ahora - cache_ajustes["comprobado"] < INTERVALO_RECARGA_AJUSTES):
+            return cache_ajustes["valores"]
+        cache_ajustes["comprobado"] = ahora
+
+        fuentes = huella_fuentes_ajustes()
+        if forzar or cache_ajustes["configuracion"] is None or fuentes != cache_ajustes["clave"][0]:
+            try:
+                configuracion = leer_configuracion_toml()
+            except (OSError, ValueError) as e:  # tomllib.TOMLDecodeError es un ValueError
+                if cache_ajustes["configuracion"] is None:
+                    raise ValueError(f"Error en {ruta_configuracion()}: {e}") from e
+                bus_eventos.avisar(f"Error en {ruta_configuracion()}, se mantienen los ajustes anteriores: {e}")
+                configuracion = None
+            if configuracion is not None:
+                tienda = tienda_actual(configuracion)
+                cache_ajustes["configuracion"] = configuracion_tienda(tienda, configuracion)
+                cache_ajustes["configuracion"]["tienda"] = tienda
+                if os.environ.get("FERRETERIA_DB"):
+                    cache_ajustes["configuracion"]["base_datos"] = os.environ["FERRETERIA_DB"]
+
+        base = cache_ajustes["configuracion"]
+        try:
+            guardados, version = ajustes_guardados(base["base_datos"])
+        except sqlite3.Error as e:
+            if cache_ajustes["valores"] is None:
+                raise
+            bus_eventos.avisar(f"No se pudieron leer los ajustes guardados, se mantienen los anteriores: {e}")
+            return cache_ajustes["valores"]
+        clave = (fuentes, version)
+        if cache_ajustes["valores"] is None or clave != cache_ajustes["clave"]:
+            valores = dict(base)
+            valores.update({k: convertir_ajuste(k, v) for k, v in guardados.items()
+                            if k in AJUSTES_POR_DEFECTO and k not in AJUSTES_DE_ARRANQUE})
+            if os.environ.get("FERRETERIA_IMPRESORA"):
+                valores["impresora_tickets"] = os.environ["FERRETERIA_IMPRESORA"]
+            cache_ajustes["valores"] = valores
+            cache_ajustes["clave"] = clave
+        return cache_ajustes["valores"]
+
+
+def ajuste(clave):
+    """Valor de un ajuste de la tienda actual."""
+    return ajustes()[clave]
+
+
+def recargar_ajustes():
+    """Vuelve a leer el TOML y la tabla de ajustes ahora mismo."""
+    return ajustes(forzar=True)
+
+
+def guardar_ajustes(valores):
+    """Guarda ajustes en la tabla de la tienda actual (tienen prioridad sobre el TOML) y recarga la caché."""
+    desconocidos = set(valores) - set(AJUSTES_POR_DEFECTO)
+    if desconocidos:
+        raise ValueError(f"Ajustes desconocidos: {', '.join(sorted(desconocidos))}")
+    if set(valores) & set(AJUSTES_DE_ARRANQUE):
+        raise ValueError("La base de datos y el directorio de datos solo se configuran en el archivo TOML.")
+    for clave, valor in valores.items():
+        try:
+            convertir_ajuste(clave, valor)
+        except ValueError:
+            raise ValueError(f"Valor no válido para {clave}: {valor}") from None
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.executemany("INSERT OR REPLACE INTO ajustes (clave, valor) VALUES (?, ?)",
+                       [(clave, str(valor)) for clave, valor in valores.items()])
+    cursor.execute('''
+        INSERT INTO ajustes (clave, valor) VALUES ('_version', '1')
+        ON CONFLICT(clave) DO UPDATE SET valor = CAST(valor AS INTEGER) + 1
+    ''')
+    conn.commit()
+    conn.close()
+    return recargar_ajustes()
+
+
+def ruta_salida_documentos():
+    """Directorio donde se guardan los PDF y exportaciones de la tienda (por defecto, el escritorio)."""
+    directorio = os.path.expanduser(ajuste("salida"))
+    os.makedirs(directorio, exist_ok=True)
+    return directorio
+
+
+def directorio_datos():
+    """Directorio de datos de la tienda: copias, archivo histórico, analítica y carritos."""
+    return ajuste("datos")
+
+
+def numero_documento(tipo, id_documento, serie=None):
+    """Número visible de un documento con la serie de su tipo (factura, rectificativa, albaran o ticket).
+
+    Sin serie se usa la de los ajustes actuales: solo vale para documentos que se emiten ahora; los
+    ya emitidos pasan la que se guardó con ellos.
+    """
+    return f"{ajuste('serie_' + tipo) if serie is None else serie}{id_documento}"
+
+
+def lineas_cabecera_emisor():
+    """Líneas con los datos del emisor para la cabecera de facturas y albaranes."""
+    datos = ajustes()
+    return [datos["direccion"], f"{datos['codigo_postal']} {datos['poblacion'].upper()}", datos["email"],
+            datos["nif"], f"Telf. {datos['telefono']}"]
+
+
 # =================== BASE DE DATOS =================== #
+def ruta_base_datos():
+    """Ruta de la base de datos de la tienda actual (la variable FERRETERIA_DB tiene prioridad)."""
+    return ajuste("base_datos")
+
+
 def conectar_db():
-    """Conecta o crea la base de datos en un directorio fijo."""
-    ruta_db = os.path.join(os.path.expanduser("~"), "ferreteria.db")
-    return sqlite3.connect(ruta_db)
+    """Conecta o crea la base de datos de la tienda actual."""
+    ruta = ruta_base_datos()
+    os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+    return sqlite3.connect(ruta)
 
 
 def crear_tablas():
@@ -80,40 +347,536 @@ def crear_tablas():
     ''')
 
 
+    # Ajustes cambiados desde el programa (prevalecen sobre el archivo TOML)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ajustes (
+            clave TEXT PRIMARY KEY,
+            valor TEXT NOT NULL
+        )
+    ''')
+
+    # Crear las tablas de familias y tarifas
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS familias (
+            id_familia INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tarifas (
+            id_tarifa INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL UNIQUE,
+            descuento REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    # Descuento de una familia dentro de una tarifa (sustituye al descuento general de la tarifa)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tarifa_familias (
+            id_tarifa INTEGER NOT NULL,
+            id_familia INTEGER NOT NULL,
+            descuento REAL NOT NULL,
+            PRIMARY KEY (id_tarifa, id_familia)
+        )
+    ''')
+    # Precio fijo de un producto dentro de una tarifa (tiene prioridad sobre cualquier descuento)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tarifa_precios (
+            id_tarifa INTEGER NOT NULL,
+            id_producto INTEGER NOT NULL,
+            precio REAL NOT NULL,
+            PRIMARY KEY (id_tarifa, id_producto)
+        )
+    ''')
+    # Precio final precalculado por tarifa y producto: al cobrar basta una búsqueda por clave
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS precios_efectivos (
+            id_tarifa INTEGER NOT NULL,
+            id_producto INTEGER NOT NULL,
+            precio REAL NOT NULL,
+            PRIMARY KEY (id_tarifa, id_producto)
+        ) WITHOUT ROWID
+    ''')
+    columnas_productos = columnas_tabla(cursor, "productos")
+    if "id_familia" not in columnas_productos:
+        cursor.execute("ALTER TABLE productos ADD COLUMN id_familia INTEGER")
+    # Precio de compra, para calcular márgenes (NULL si no se conoce)
+    if "coste" not in columnas_productos:
+        cursor.execute("ALTER TABLE productos ADD COLUMN coste REAL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_productos_familia ON productos(id_familia)")
+    columnas_clientes = columnas_tabla(cursor, "clientes")
+    if "id_tarifa" not in columnas_clientes:
+        cursor.execute("ALTER TABLE clientes ADD COLUMN id_tarifa INTEGER")
+    if "descuento" not in columnas_clientes:
+        cursor.execute("ALTER TABLE clientes ADD COLUMN descuento REAL NOT NULL DEFAULT 0")
+
+    # Crear la tabla de vales de devolución
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vales (
+            id_vale INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_cliente INTEGER,
+            id_factura INTEGER NOT NULL,
+            fecha TEXT NOT NULL,
+            importe REAL NOT NULL,
+            saldo REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vales_cliente ON vales(id_cliente, saldo)")
+
+    # Crear la tabla de albaranes (cabecera; las líneas están en el historial con tipo 'Albarán')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS albaranes (
+            id_albaran INTEGER PRIMARY KEY,
+            id_cliente INTEGER,
+            cliente TEXT NOT NULL,
+            direccion TEXT,
+            fecha TEXT NOT NULL,
+            dia INTEGER NOT NULL,
+            total REAL NOT NULL,
+            id_factura INTEGER
+        )
+    ''')
+    # Pendientes de facturar (id_factura NULL) por rango de días, y albaranes de una factura consolidada
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_albaranes_factura ON albaranes(id_factura, dia)")
+
+    # Factura rectificativa: ID de la factura o ticket original que rectifica
+    if "id_rectificada" not in columnas_tabla(cursor, "facturas"):
+        cursor.execute("ALTER TABLE facturas ADD COLUMN id_rectificada INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_facturas_rectificada ON facturas(id_rectificada)")
+    # Búsquedas de la venta original por código de barras o producto al tramitar una devolución
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_productos_codigo ON productos(codigo)")
+
+    # Cliente de la factura (NULL en facturas antiguas o de clientes no registrados)
+    if "id_cliente" not in columnas_tabla(cursor, "facturas"):
+        cursor.execute("ALTER TABLE facturas ADD COLUMN id_cliente INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_facturas_cliente ON facturas(id_cliente)")
+
+    # Columna entera con el día (días desde 1970-01-01) para filtrar por rangos usando índices
+    for tabla in ("facturas", "historial"):
+        if "dia" not in columnas_tabla(cursor, tabla):
+            cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN dia INTEGER")
+
+    conn.commit()
+    normalizar_fechas(conn)
+
+    # Crear la tabla de la cola de impresión
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cola_impresion (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            documento TEXT NOT NULL,
+            formato TEXT NOT NULL,
+            destino TEXT NOT NULL,
+            datos BLOB NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            proximo_intento REAL NOT NULL DEFAULT 0,
+            creado TEXT NOT NULL,
+            actualizado TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cola_impresion_estado ON cola_impresion(estado, proximo_intento)")
+    # Trabajos guardados sin renderizar: plantilla con que el hilo de impresión convierte los datos (JSON) en el documento
+    if "plantilla" not in columnas_tabla(cursor, "cola_impresion"):
+        cursor.execute("ALTER TABLE cola_impresion ADD COLUMN plantilla TEXT")
+    # Caja que encoló el trabajo: cada caja imprime solo los suyos (sus impresoras son locales). Los
+    # trabajos de antes de haber columna se los queda la caja que migra la base
+    if "caja" not in columnas_tabla(cursor, "cola_impresion"):
+        cursor.execute("ALTER TABLE cola_impresion ADD COLUMN caja TEXT")
+        cursor.execute("UPDATE cola_impresion SET caja = ?", (nombre_caja(),))
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cola_impresion_caja ON cola_impresion(caja, estado, proximo_intento)")
+
+    # Registros de facturación encadenados (Verifactu): uno por factura, con la huella del anterior
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS registros_facturacion (
+            id_registro INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_factura INTEGER NOT NULL UNIQUE,
+            nif_emisor TEXT NOT NULL,
+            num_serie TEXT NOT NULL,
+            fecha_expedicion TEXT NOT NULL,
+            tipo_factura TEXT NOT NULL,
+            cuota_total TEXT NOT NULL,
+            importe_total TEXT NOT NULL,
+            huella_anterior TEXT,
+            fecha_hora_huso TEXT NOT NULL,
+            huella TEXT NOT NULL
+        )
+    ''')
+    # Serie e IVA con que se emitió cada factura (y serie de cada albarán): cambiar los ajustes no toca lo ya emitido
+    if "serie" not in columnas_tabla(cursor, "facturas"):
+        cursor.execute("ALTER TABLE facturas ADD COLUMN serie TEXT")
+        cursor.execute("ALTER TABLE facturas ADD COLUMN iva REAL")
+        # Las facturas ya encadenadas recuperan la serie de su registro; el resto toma los ajustes actuales
+        cursor.execute('''
+            UPDATE facturas SET serie = (
+                SELECT substr(r.num_serie, 1, length(r.num_serie) - length(facturas.id_factura))
+                FROM registros_facturacion r WHERE r.id_factura = facturas.id_factura)
+        ''')
+        cursor.execute("UPDATE facturas SET serie = ? WHERE serie IS NULL AND id_rectificada IS NULL", (ajuste("serie_factura"),))
+        cursor.execute("UPDATE facturas SET serie = ? WHERE serie IS NULL", (ajuste("serie_rectificativa"),))
+        # El IVA se deduce de la cuota registrada (redondeada a céntimos, solo es fiable con bases de al menos 1 €)
+        cursor.execute('''
+            UPDATE facturas SET iva = (
+                SELECT round(100 * r.cuota_total / (r.importe_total - r.cuota_total))
+                FROM registros_facturacion r
+                WHERE r.id_factura = facturas.id_factura AND abs(r.importe_total - r.cuota_total) >= 1)
+        ''')
+        cursor.execute("UPDATE facturas SET iva = ? WHERE iva IS NULL", (ajuste("iva"),))
+    if "serie" not in columnas_tabla(cursor, "albaranes"):
+        cursor.execute("ALTER TABLE albaranes ADD COLUMN serie TEXT")
+        cursor.execute("UPDATE albaranes SET serie = ?", (ajuste("serie_albaran"),))
+    encadenar_facturas(cursor)  # Facturas anteriores a la tabla de registros, o dadas de alta sin encadenar
+
+    # Sincronización entre tiendas: registro de cambios con secuencia propia de cada tienda
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cambios (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tabla TEXT NOT NULL,
+            clave TEXT NOT NULL,
+            campo TEXT NOT NULL,
+            valor,
+            marca REAL NOT NULL,
+            nodo TEXT
+        )
+    ''')  # nodo NULL = cambio de esta tienda; si no, tienda de la que llegó (ya aplicado)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cambios_campo ON cambios(tabla, clave, campo, marca)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS sincronizacion_aplicando (activo INTEGER)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS nodo_sincronizacion (id_nodo TEXT NOT NULL, exportado INTEGER NOT NULL DEFAULT 0)")
+    cursor.execute("INSERT INTO nodo_sincronizacion (id_nodo) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM nodo_sincronizacion)",
+                   (uuid.uuid4().hex,))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS nodos_remotos (
+            id_nodo TEXT PRIMARY KEY,
+            recibido INTEGER NOT NULL DEFAULT 0,
+            actualizado TEXT
+        )
+    ''')
+    # Hasta qué cambio propio ha confirmado cada tienda haberlo aplicado, y hasta dónde se ha podado el registro
+    if "confirmado" not in columnas_tabla(cursor, "nodos_remotos"):
+        cursor.execute("ALTER TABLE nodos_remotos ADD COLUMN confirmado INTEGER NOT NULL DEFAULT 0")
+    if "podado" not in columnas_tabla(cursor, "nodo_sincronizacion"):
+        cursor.execute("ALTER TABLE nodo_sincronizacion ADD COLUMN podado INTEGER NOT NULL DEFAULT 0")
+    # Ventas de las demás tiendas (sus documentos conservan la numeración y la cadena de huellas de su tienda)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS historial_tiendas (
+            nodo TEXT NOT NULL,
+            id_origen INTEGER NOT NULL,
+            id_factura INTEGER,
+            tipo TEXT NOT NULL,
+            producto TEXT,
+            cantidad INTEGER,
+            precio REAL,
+            total REAL,
+            fecha TEXT,
+            dia INTEGER,
+            PRIMARY KEY (nodo, id_origen)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_tiendas_dia ON historial_tiendas(dia)")
+    # Clave de sincronización: un identificador estable por fila, porque el código de barras o el NIF pueden repetirse
+    for tabla, clave_natural in (("productos", "codigo"), ("clientes", "identificacion_fiscal")):
+        if "uid" not in columnas_tabla(cursor, tabla):
+            cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN uid TEXT")
+            # Las filas con clave natural única la toman derivada de ella, para que tiendas que ya se
+            # sincronizaban por esa clave lleguen al mismo identificador sin intercambiar nada
+            cursor.execute(f'''
+                UPDATE {tabla} SET uid = CASE
+                    WHEN (SELECT COUNT(*) FROM {tabla} t WHERE t.{clave_natural} = {tabla}.{clave_natural}) = 1
+                    THEN 'k' || lower(hex({clave_natural})) ELSE lower(hex(randomblob(16))) END
+            ''')
+            cursor.execute("UPDATE cambios SET clave = 'k' || lower(hex(clave)) WHERE tabla = ?", (tabla,))
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE ?", (f"cambios_{tabla}_%",))
+            for (disparador,) in cursor.fetchall():
+                cursor.execute(f"DROP TRIGGER {disparador}")  # Anotaban por la clave natural
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{tabla}_uid ON {tabla}(uid)")
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS uid_{tabla} AFTER INSERT ON {tabla} WHEN NEW.uid IS NULL
+            BEGIN UPDATE {tabla} SET uid = lower(hex(randomblob(16))) WHERE rowid = NEW.rowid AND uid IS NULL; END
+        ''')
+    crear_disparadores_cambios(cursor)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_facturas_dia ON facturas(dia)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_dia ON historial(dia)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_factura ON historial(id_factura)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_historial_producto ON historial(producto, dia)")
+    # Contador de modificaciones y borrados del historial, para saber si la instantánea de análisis sigue valiendo
+    # (las altas ya se notan en el id máximo y el número de filas)
+    cursor.execute("CREATE TABLE IF NOT EXISTS revision_historial (revision INTEGER NOT NULL)")
+    cursor.execute("INSERT INTO revision_historial SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM revision_historial)")
+    for operacion in ("UPDATE", "DELETE"):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS revision_historial_{operacion.lower()} AFTER {operacion} ON historial
+            BEGIN UPDATE revision_historial SET revision = revision + 1; END
+        ''')
+
     conn.commit()
     conn.close()
 
 
+def columnas_tabla(cursor, tabla):
+    """Devuelve los nombres de las columnas de una tabla."""
+    cursor.execute(f"PRAGMA table_info({tabla})")
+    return [fila[1] for fila in cursor.fetchall()]
+
+
+# =================== AVISOS DE CAMBIOS =================== #
+# Eventos que publica la capa de datos; cada aviso lleva los ids afectados
+EVENTO_PRODUCTO = "producto"                    # Producto creado o modificado (también stock y precio)
+EVENTO_PRODUCTO_ELIMINADO = "producto_eliminado"
+EVENTO_FACTURA = "factura"                      # Factura creada (también rectificativas y consolidadas)
+EVENTO_HISTORIAL = "historial"                  # Líneas nuevas del historial (ids de línea)
+EVENTO_CLIENTE = "cliente"                      # Cliente creado o modificado
+EVENTO_CLIENTE_ELIMINADO = "cliente_eliminado"
+EVENTO_VALE = "vale"                            # Vale creado o con saldo cambiado
+EVENTO_ALBARAN = "albaran"                      # Albarán creado o facturado
+EVENTO_MENSAJE = "mensaje"                      # Texto para la barra de estado (no lleva ids)
+
+
+class BusEventos:
+    """Bus de avisos dentro del proceso: la capa de datos publica qué ids cambian y las pestañas se suscriben.
+
+    Los avisos se acumulan (varios cambios del mismo id cuentan como uno) hasta que se llama a
+    entregar(). La interfaz lo hace desde su bucle con after, así que los suscriptores siempre
+    se ejecutan en el hilo de Tk aunque el cambio venga de otro hilo. Si un evento no tiene
+    suscriptores, publicarlo no hace nada.
+    """
+
+    def __init__(self):
+        self.suscriptores = {}
+        self.pendientes = {}
+        self.mensajes = []
+        self.bloqueo = threading.Lock()
+
+    def suscribir(self, evento, funcion):
+        """funcion(ids) se llamará con el conjunto de ids cambiados desde la entrega anterior."""
+        self.suscriptores.setdefault(evento, []).append(funcion)
+
+    def escuchando(self, evento):
+        """Indica si alguien está suscrito, para no calcular ids que nadie va a usar."""
+        return bool(self.suscriptores.get(evento))
+
+    def publicar(self, evento, ids):
+        if not self.escuchando(evento):
+            return
+        with self.bloqueo:
+            # Los ids pueden llegar como texto desde los valores de un Treeview
+            self.pendientes.setdefault(evento, set()).update(int(i) for i in ids)
+
+    def avisar(self, texto):
+        """Mensaje para el usuario desde cualquier hilo. Sin interfaz suscrita, se escribe en la consola."""
+        if not self.escuchando(EVENTO_MENSAJE):
+            print(texto, file=sys.stderr)
+            return
+        with self.bloqueo:
+            self.mensajes.append(texto)
+
+    def entregar(self):
+        """Entrega los avisos acumulados. Devuelve cuántos eventos distintos se entregaron.
+
+        Un suscriptor que falla no impide que los demás reciban el aviso; el error se avisa como mensaje.
+        """
+        with self.bloqueo:
+            pendientes, self.pendientes = self.pendientes, {}
+            mensajes, self.mensajes = self.mensajes, []
+        for texto in mensajes:
+            for funcion in self.suscriptores.get(EVENTO_MENSAJE, []):
+                try:
+                    funcion(texto)
+                except Exception as e:
+                    print(f"{texto} (no se pudo mostrar: {e})", file=sys.stderr)
+        for evento, ids in pendientes.items():
+            for funcion in self.suscriptores.get(evento, []):
+                try:
+                    funcion(ids)
+                except Exception as e:
+                    self.avisar(f"Error al actualizar la pantalla ({evento}): {e}")
+        return len(pendientes)
+
+
+bus_eventos = BusEventos()
+
+
+# Condición para listas de ids de cualquier tamaño: la lista va en un solo parámetro JSON (ver lista_sql), así
+# que no se llega al límite de variables de SQLite aunque el bus entregue miles de ids de golpe
+EN_LISTA = "IN (SELECT value FROM json_each(?))"
+
+
+def lista_sql(valores):
+    """Parámetro para EN_LISTA."""
+    return json.dumps(list(valores))
+
+
+def ids_productos_por_nombre(cursor, nombres):
+    """IDs de los productos con esos nombres (las líneas del historial guardan el nombre, no el ID)."""
+    cursor.execute(f"SELECT id FROM productos WHERE nombre {EN_LISTA}", (lista_sql(set(nombres)),))
+    return [fila[0] for fila in cursor.fetchall()]
+
+
+# =================== FUNCIONES PARA FECHAS =================== #
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
+FORMATOS_FECHA_ENTRADA = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+    "%d/%m/%Y",
+    "%d-%m-%Y",
+)
+EPOCA = date(1970, 1, 1)
+
+
+def interpretar_fecha(texto):
+    """Convierte un texto de fecha en datetime probando los formatos conocidos. Devuelve None si no se reconoce."""
+    texto = (texto or "").strip()
+    for formato in FORMATOS_FECHA_ENTRADA:
+        try:
+            return datetime.strptime(texto, formato)
+        except ValueError:
+            continue
+    return None
+
+
+def dia_desde_fecha(valor):
+    """Devuelve el número de día (días desde 1970-01-01) de una fecha, datetime o texto."""
+    if isinstance(valor, datetime):
+        valor = valor.date()
+    elif isinstance(valor, str):
+        fecha = interpretar_fecha(valor)
+        if fecha is None:
+            raise ValueError(f"Fecha no válida: {valor}")
+        valor = fecha.date()
+    return (valor - EPOCA).days
+
+
+def fecha_desde_dia(dia):
+    """Convierte un número de día en un objeto date."""
+    return EPOCA + timedelta(days=dia)
+
+
+def normalizar_fechas(conn):
+    """Normaliza las fechas guardadas como texto y rellena la columna dia en facturas e historial."""
+    cursor = conn.cursor()
+    for tabla, clave in (("facturas", "id_factura"), ("historial", "id")):
+        cursor.execute(f"SELECT {clave}, fecha FROM {tabla} WHERE dia IS NULL")
+        cambios = []
+        for clave_fila, fecha in cursor.fetchall():
+            fecha_dt = interpretar_fecha(fecha)
+            if fecha_dt is None:
+                continue  # Se deja intacta para revisarla a mano
+            cambios.append((fecha_dt.strftime(FORMATO_FECHA), dia_desde_fecha(fecha_dt), clave_fila))
+        cursor.executemany(f"UPDATE {tabla} SET fecha=?, dia=? WHERE {clave}=?", cambios)
+    conn.commit()
+
+
+def rango_fechas(fecha):
+    """Convierte un prefijo de fecha (YYYY, YYYY-MM o YYYY-MM-DD) en un rango de días (desde, hasta)."""
+    fecha = fecha.strip()
+    try:
+        if len(fecha) == 4:
+            año = int(fecha)
+            return dia_desde_fecha(date(año, 1, 1)), dia_desde_fecha(date(año, 12, 31))
+        if len(fecha) == 7:
+            año, mes = int(fecha[:4]), int(fecha[5:7])
+            ultimo = calendar.monthrange(año, mes)[1]
+            return dia_desde_fecha(date(año, mes, 1)), dia_desde_fecha(date(año, mes, ultimo))
+        dia = dia_desde_fecha(fecha)
+        return dia, dia
+    except ValueError:
+        return None
+
+
+def rango_predefinido(nombre, hoy=None):
+    """Devuelve (desde, hasta) como objetos date para rangos habituales como 'Último trimestre'."""
+    hoy = hoy or date.today()
+    if nombre == "Hoy":
+        return hoy, hoy
+    if nombre == "Últimos 7 días":
+        return hoy - timedelta(days=6), hoy
+    if nombre == "Este mes":
+        return hoy.replace(day=1), hoy
+    if nombre == "Mes anterior":
+        fin = hoy.replace(day=1) - timedelta(days=1)
+        return fin.replace(day=1), fin
+    if nombre == "Último trimestre":
+        trimestre = (hoy.month - 1) // 3
+        año = hoy.year if trimestre else hoy.year - 1
+        inicio_mes = 3 * ((trimestre - 1) % 4) + 1
+        inicio = date(año, inicio_mes, 1)
+        fin = date(año, inicio_mes + 2, calendar.monthrange(año, inicio_mes + 2)[1])
+        return inicio, fin
+    if nombre == "Este año":
+        return date(hoy.year, 1, 1), hoy
+    return None, None
+
+
+def filtro_dias(query, params, desde=None, hasta=None, columna="dia"):
+    """Añade a la consulta las condiciones de rango sobre la columna de día indexada."""
+    if desde:
+        query += f" AND {columna} >= ?"
+        params.append(dia_desde_fecha(desde))
+    if hasta:
+        query += f" AND {columna} <= ?"
+        params.append(dia_desde_fecha(hasta))
+    return query
+
 
 # =================== FUNCIONES PARA FACTURAS =================== #
-def registrar_factura(id_factura, cliente, fecha, total):
+def registrar_factura(id_factura, cliente, fecha, total, id_cliente=None):
     """Registra una factura en la base de datos."""
     conn = conectar_db()
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO facturas (id_factura, cliente, fecha, total) 
-        VALUES (?, ?, ?, ?)
-    ''', (id_factura, cliente, fecha, total))
+        INSERT INTO facturas (id_factura, cliente, fecha, total, dia, id_cliente, serie, iva)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (id_factura, cliente, fecha, total, dia_desde_fecha(fecha), id_cliente, ajuste("serie_factura"), ajuste("iva")))
+    encadenar_facturas(cursor)
     conn.commit()
     conn.close()  # Asegúrate de cerrar la conexión
+    bus_eventos.publicar(EVENTO_FACTURA, [id_factura])
+
 
+def obtener_facturas(cliente='', producto='', fecha='', desde=None, hasta=None, ids=None):
+    """Obtiene el historial de facturas filtrado por cliente, producto, fecha o rango de fechas (desde/hasta incluidos).
 
-def obtener_facturas(cliente='', producto='', fecha=''):
-    """Obtiene el historial de facturas filtrado por cliente, producto o fecha."""
+    Con ids solo se miran esas facturas (para refrescar las filas cambiadas sin recargar la lista).
+    """
     conn = conectar_db()
     cursor = conn.cursor()
     query = "SELECT id_factura, cliente, fecha, total FROM facturas WHERE 1=1"
     params = []
 
+    if ids is not None:
+        query += f" AND id_factura {EN_LISTA}"
+        params.append(lista_sql(ids))
+
     if cliente:
         query += " AND cliente LIKE ?"
         params.append(f"%{cliente}%")
     if producto:
-        query += " AND id_factura IN (SELECT id_factura FROM historial WHERE producto LIKE ?)"
-        params.append(f"%{producto}%")
+        # Las líneas de ejercicios archivados se buscan en los archivos columnares
+        # y las facturas consolidadas no tienen líneas propias: se buscan a través de sus albaranes
+        condiciones = ["id_factura IN (SELECT id_factura FROM historial WHERE producto LIKE ?)",
+                       "id_factura IN (SELECT a.id_factura FROM historial h JOIN albaranes a ON a.id_albaran = h.id_factura"
+                       " WHERE h.producto LIKE ? AND a.id_factura IS NOT NULL)"]
+        params.extend([f"%{producto}%"] * 2)
+        ids_archivados = ids_factura_archivados(producto, desde, hasta)
+        if ids_archivados:
+            cursor.execute("CREATE TEMP TABLE ids_archivados (id_factura INTEGER PRIMARY KEY)")
+            cursor.executemany("INSERT OR IGNORE INTO ids_archivados VALUES (?)", [(i,) for i in ids_archivados])
+            condiciones.append("id_factura IN (SELECT id_factura FROM ids_archivados)")
+        query += f" AND ({' OR '.join(condiciones)})"
     if fecha:
-        query += " AND fecha LIKE ?"
-        params.append(f"%{fecha}%")
+        rango = rango_fechas(fecha)
+        if rango:
+            query += " AND dia BETWEEN ? AND ?"
+            params.extend(rango)
+        else:
+            query += " AND fecha LIKE ?"
+            params.append(f"%{fecha}%")
+    query = filtro_dias(query, params, desde, hasta)
+    query += " ORDER BY dia DESC, id_factura DESC"
 
     cursor.execute(query, params)
     facturas = cursor.fetchall()
@@ -128,28 +891,76 @@ def registrar_transaccion(id_factura, tipo, producto, cantidad, precio, total, f
     conn = conectar_db()
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO historial (id_factura, tipo, producto, cantidad, precio, total, fecha) VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (id_factura, tipo, producto, cantidad, precio, total, fecha))
+        INSERT INTO historial (id_factura, tipo, producto, cantidad, precio, total, fecha, dia) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (id_factura, tipo, producto, cantidad, precio, total, fecha, dia_desde_fecha(fecha)))
+    id_linea = cursor.lastrowid
     conn.commit()
     conn.close()
+    bus_eventos.publicar(EVENTO_HISTORIAL, [id_linea])
 
-def obtener_historial():
-    """Obtiene el historial de transacciones."""
+def obtener_historial(desde=None, hasta=None, ids=None, tienda=None):
+    """Obtiene el historial de transacciones (incluidos los ejercicios archivados), opcionalmente limitado a un rango de fechas.
+
+    Con ids solo se devuelven esas líneas de la base de datos viva (las líneas nuevas que llegan por el bus de avisos).
+    tienda es None para las ventas de esta tienda, el id de otra tienda para las que llegaron de ella al
+    sincronizar, o TODAS_LAS_TIENDAS. La última columna es la tienda de la línea (None si es de esta).
+    """
     conn = conectar_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT id_factura, tipo, producto, cantidad, precio, total, fecha FROM historial ORDER BY fecha DESC")
-    historial = cursor.fetchall()
+    historial = []
+    if tienda in (None, TODAS_LAS_TIENDAS):
+        params = []
+        query = "SELECT id_factura, tipo, producto, cantidad, precio, total, fecha, NULL FROM historial WHERE 1=1"
+        if ids is not None:
+            query += f" AND id {EN_LISTA}"
+            params.append(lista_sql(ids))
+        query = filtro_dias(query, params, desde, hasta)
+        cursor.execute(query + " ORDER BY dia DESC, fecha DESC", params)
+        historial = cursor.fetchall()
+    if tienda is not None and ids is None:
+        params = []
+        query = "SELECT id_factura, tipo, producto, cantidad, precio, total, fecha, nodo FROM historial_tiendas WHERE 1=1"
+        if tienda != TODAS_LAS_TIENDAS:
+            query += " AND nodo = ?"
+            params.append(tienda)
+        cursor.execute(filtro_dias(query, params, desde, hasta), params)
+        historial.extend(cursor.fetchall())
     conn.close()
+    if ids is not None:
+        return historial
+
+    archivado = historial_archivado(desde, hasta) if tienda in (None, TODAS_LAS_TIENDAS) else []
+    if archivado or tienda is not None:
+        historial.extend(archivado)
+        historial.sort(key=lambda fila: fila[6] or "", reverse=True)
     return historial
 
+
+def tiendas_historial():
+    """Otras tiendas de las que han llegado ventas al sincronizar."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT nodo FROM historial_tiendas ORDER BY nodo")
+    tiendas = [fila[0] for fila in cursor.fetchall()]
+    conn.close()
+    return tiendas
+
 def generar_id_factura():
-    """Genera un nuevo ID único para las facturas."""
+    """Genera un nuevo ID único para facturas, tickets y albaranes (comparten numeración)."""
     conn = conectar_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT MAX(id_factura) FROM facturas")
-    max_id = cursor.fetchone()[0]
+    nuevo_id = siguiente_id_documento(cursor)
     conn.close()
-    return (max_id or 0) + 1
+    return nuevo_id
+
+def siguiente_id_documento(cursor):
+    """Siguiente ID de documento usando un cursor ya abierto (por ejemplo, dentro de una transacción)."""
+    # Los tickets y albaranes solo quedan en el historial, así que también se mira allí (ambas columnas indexadas)
+    cursor.execute('''
+        SELECT MAX(COALESCE((SELECT MAX(id_factura) FROM facturas), 0),
+                   COALESCE((SELECT MAX(id_factura) FROM historial), 0))
+    ''')
+    return cursor.fetchone()[0] + 1
 
 # =================== FUNCIONES PARA GESTIÓN DE PRODUCTOS =================== #
 def actualizar_stock(producto_id, cantidad_vendida):
@@ -162,82 +973,3964 @@ def actualizar_stock(producto_id, cantidad_vendida):
     cursor.execute("UPDATE productos SET cantidad=? WHERE id=?", (nueva_cantidad, producto_id))
     conn.commit()
     conn.close()
+    bus_eventos.publicar(EVENTO_PRODUCTO, [producto_id])
 
-def añadir_producto(nombre, codigo, descripcion, precio, cantidad):
+def añadir_producto(nombre, codigo, descripcion, precio, cantidad, coste=None):
     """Añade un producto a la base de datos."""
     conn = conectar_db()
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO productos (nombre, codigo, descripcion, precio, cantidad) VALUES (?, ?, ?, ?, ?)
-    ''', (nombre, codigo, descripcion, precio, cantidad))
+        INSERT INTO productos (nombre, codigo, descripcion, precio, cantidad, coste) VALUES (?, ?, ?, ?, ?, ?)
+    ''', (nombre, codigo, descripcion, precio, cantidad, coste))
+    id_producto = cursor.lastrowid
+    recalcular_precios_efectivos(conn, id_producto=id_producto)
     conn.commit()
     conn.close()
+    bus_eventos.publicar(EVENTO_PRODUCTO, [id_producto])
+    return id_producto
 
-def modificar_producto(id, nombre, codigo, descripcion, precio, cantidad):
-    """Modifica un producto existente en la base de datos."""
+def modificar_producto(id, nombre, codigo, descripcion, precio, cantidad, coste=None):
+    """Modifica un producto existente en la base de datos (el coste solo se cambia si se indica)."""
     conn = conectar_db()
     cursor = conn.cursor()
     cursor.execute('''
-        UPDATE productos SET nombre=?, codigo=?, descripcion=?, precio=?, cantidad=? WHERE id=?
-    ''', (nombre, codigo, descripcion, precio, cantidad, id))
+        UPDATE productos SET nombre=?, codigo=?, descripcion=?, precio=?, cantidad=?, coste=COALESCE(?, coste) WHERE id=?
+    ''', (nombre, codigo, descripcion, precio, cantidad, coste, id))
+    recalcular_precios_efectivos(conn, id_producto=id)
     conn.commit()
     conn.close()
+    bus_eventos.publicar(EVENTO_PRODUCTO, [id])
 
 def eliminar_producto(id):
     """Elimina un producto de la base de datos por su ID."""
     conn = conectar_db()
     cursor = conn.cursor()
-    cursor.execute('DELETE FROM productos WHERE id=?', (id,))
-    conn.commit()
+    cursor.execute('DELETE FROM productos WHERE id=?', (id,))
+    cursor.execute('DELETE FROM tarifa_precios WHERE id_producto=?', (id,))
+    cursor.execute('DELETE FROM precios_efectivos WHERE id_producto=?', (id,))
+    conn.commit()
+    conn.close()
+    bus_eventos.publicar(EVENTO_PRODUCTO_ELIMINADO, [id])
+
+def obtener_productos(ids=None):
+    """Obtiene todos los productos de la base de datos (o solo los de la lista de IDs)."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    query = "SELECT id, nombre, codigo, descripcion, precio, cantidad, coste FROM productos"
+    params = []
+    if ids is not None:
+        query += f" WHERE id {EN_LISTA}"
+        params = [lista_sql(ids)]
+    cursor.execute(query, params)
+    productos = cursor.fetchall()
+    conn.close()
+    return productos
+
+# =================== FUNCIONES PARA CLIENTES =================== #
+
+def añadir_cliente(identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion, codigo_postal, poblacion, provincia, pais, telefono):
+    """Añade un cliente a la base de datos."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO clientes (identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion, codigo_postal, poblacion, provincia, pais, telefono) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion, codigo_postal, poblacion, provincia, pais, telefono))
+    id_cliente = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    indice_clientes.añadir((id_cliente, identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion,
+                            codigo_postal, poblacion, provincia, pais, telefono))
+    bus_eventos.publicar(EVENTO_CLIENTE, [id_cliente])
+    return id_cliente
+
+def obtener_clientes(ids=None):
+    """Obtiene todos los clientes de la base de datos (o solo los de la lista de IDs)."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    query = '''
+        SELECT id_cliente, identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion, codigo_postal,
+               poblacion, provincia, pais, telefono
+        FROM clientes
+    '''
+    params = []
+    if ids is not None:
+        query += f" WHERE id_cliente {EN_LISTA}"
+        params = [lista_sql(ids)]
+    cursor.execute(query, params)
+    clientes = cursor.fetchall()
+    conn.close()
+    return clientes
+
+def eliminar_cliente(id_cliente):
+    """Elimina un cliente de la base de datos por su ID."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM clientes WHERE id_cliente=?', (id_cliente,))
+    conn.commit()
+    conn.close()
+    indice_clientes.eliminar(id_cliente)
+    bus_eventos.publicar(EVENTO_CLIENTE_ELIMINADO, [id_cliente])
+
+def obtener_cliente(id_cliente):
+    """Obtiene todos los datos de un cliente por su ID."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM clientes WHERE id_cliente=?", (id_cliente,))
+    cliente = cursor.fetchone()
+    conn.close()
+    return cliente
+
+
+def normalizar_busqueda(texto):
+    """Pasa un texto a minúsculas y sin tildes para comparar prefijos."""
+    texto = unicodedata.normalize("NFKD", (texto or "").strip().lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+
+class IndiceClientes:
+    """Índice en memoria de clientes por prefijo de NIF, nombre fiscal y nombre comercial.
+
+    Guarda una lista ordenada de (clave, id_cliente) y busca con bisect, así cada
+    pulsación en el autocompletado no consulta la base de datos. Se indexa el texto
+    completo y el comienzo de cada palabra ("ferr" encuentra "Construcciones Ferrer").
+    """
+
+    def __init__(self):
+        self.claves = []
+        self.clientes = {}
+        self.cargado = False
+
+    def claves_cliente(self, cliente):
+        claves = set()
+        for campo in (cliente[1], cliente[2], cliente[3]):
+            texto = normalizar_busqueda(campo)
+            if not texto:
+                continue
+            claves.add(texto)
+            palabras = texto.split()
+            for i in range(1, len(palabras)):
+                claves.add(" ".join(palabras[i:]))
+        return claves
+
+    def cargar(self):
+        """Carga (o recarga) todos los clientes desde la base de datos."""
+        self.clientes = {cliente[0]: cliente for cliente in obtener_clientes()}
+        self.claves = sorted((clave, id_cliente) for id_cliente, cliente in self.clientes.items()
+                             for clave in self.claves_cliente(cliente))
+        self.cargado = True
+
+    def añadir(self, cliente):
+        if not self.cargado:
+            return
+        self.eliminar(cliente[0])
+        self.clientes[cliente[0]] = cliente
+        for clave in self.claves_cliente(cliente):
+            bisect.insort(self.claves, (clave, cliente[0]))
+
+    def eliminar(self, id_cliente):
+        if not self.cargado:
+            return
+        id_cliente = int(id_cliente)
+        cliente = self.clientes.pop(id_cliente, None)
+        if cliente is None:
+            return
+        for clave in self.claves_cliente(cliente):
+            posicion = bisect.bisect_left(self.claves, (clave, id_cliente))
+            if posicion < len(self.claves) and self.claves[posicion] == (clave, id_cliente):
+                del self.claves[posicion]
+
+    def buscar(self, prefijo, limite=10):
+        """Devuelve hasta 'limite' clientes cuyo NIF o nombre (o alguna palabra) empieza por el prefijo."""
+        if not self.cargado:
+            self.cargar()
+        prefijo = normalizar_busqueda(prefijo)
+        if not prefijo:
+            return []
+        encontrados = []
+        vistos = set()
+        posicion = bisect.bisect_left(self.claves, (prefijo,))
+        while posicion < len(self.claves) and len(encontrados) < limite:
+            clave, id_cliente = self.claves[posicion]
+            if not clave.startswith(prefijo):
+                break
+            if id_cliente not in vistos:
+                vistos.add(id_cliente)
+                encontrados.append(self.clientes[id_cliente])
+            posicion += 1
+        return encontrados
+
+
+indice_clientes = IndiceClientes()
+
+
+def descripcion_cliente(cliente):
+    """Texto con el que se muestra un cliente en el autocompletado."""
+    nombre = cliente[2]
+    if cliente[3] and cliente[3] != cliente[2]:
+        nombre += f" ({cliente[3]})"
+    return f"{nombre} - {cliente[1]}"
+
+
+# =================== VENTA EN CAJA =================== #
+class CatalogoVenta:
+    """Catálogo en memoria para la caja: búsqueda por código exacto y por prefijo de nombre o código.
+
+    Se carga una vez y se mantiene al día con los avisos del bus (solo se vuelven a leer los
+    productos cambiados), así que escanear o teclear en la caja no consulta la base de datos.
+    """
+
+    def __init__(self):
+        self.productos = {}   # id -> (id, nombre, codigo, descripcion, precio, cantidad, coste)
+        self.por_codigo = {}
+        self.claves = []      # Lista ordenada de (clave, id) para buscar por prefijo con bisect
+        self.cargado = False
+
+    def claves_producto(self, producto):
+        return {clave for clave in (normalizar_busqueda(producto[1]), normalizar_busqueda(producto[2])) if clave}
+
+    def cargar(self):
+        productos = obtener_productos()
+        self.productos = {producto[0]: producto for producto in productos}
+        self.por_codigo = {producto[2]: producto[0] for producto in productos}
+        self.claves = sorted((clave, producto[0]) for producto in productos for clave in self.claves_producto(producto))
+        self.cargado = True
+
+    def quitar(self, id_producto):
+        producto = self.productos.pop(id_producto, None)
+        if producto is None:
+            return
+        if self.por_codigo.get(producto[2]) == id_producto:
+            del self.por_codigo[producto[2]]
+        for clave in self.claves_producto(producto):
+            posicion = bisect.bisect_left(self.claves, (clave, id_producto))
+            if posicion < len(self.claves) and self.claves[posicion] == (clave, id_producto):
+                del self.claves[posicion]
+
+    def actualizar(self, ids):
+        """Vuelve a leer solo los productos indicados (suscrito a EVENTO_PRODUCTO)."""
+        if not self.cargado:
+            return
+        for id_producto in ids:
+            self.quitar(id_producto)
+        for producto in obtener_productos(ids):
+            self.productos[producto[0]] = producto
+            self.por_codigo[producto[2]] = producto[0]
+            for clave in self.claves_producto(producto):
+                bisect.insort(self.claves, (clave, producto[0]))
+
+    def eliminar(self, ids):
+        """Quita productos dados de baja (suscrito a EVENTO_PRODUCTO_ELIMINADO)."""
+        for id_producto in ids:
+            self.quitar(id_producto)
+
+    def buscar_codigo(self, codigo):
+        if not self.cargado:
+            self.cargar()
+        return self.productos.get(self.por_codigo.get(codigo.strip()))
+
+    def buscar(self, prefijo, limite=10):
+        """Productos cuyo nombre o código empieza por el prefijo (sin distinguir mayúsculas ni tildes)."""
+        if not self.cargado:
+            self.cargar()
+        prefijo = normalizar_busqueda(prefijo)
+        if not prefijo:
+            return []
+        encontrados = []
+        posicion = bisect.bisect_left(self.claves, (prefijo,))
+        while posicion < len(self.claves) and len(encontrados) < limite:
+            clave, id_producto = self.claves[posicion]
+            if not clave.startswith(prefijo):
+                break
+            if self.productos[id_producto] not in encontrados:
+                encontrados.append(self.productos[id_producto])
+            posicion += 1
+        return encontrados
+
+
+def interpretar_entrada_caja(texto):
+    """Separa 'cantidad*código' (o solo 'código') en (cantidad, código). Lanza ValueError si la cantidad no es válida."""
+    cantidad, separador, codigo = texto.strip().partition("*")
+    if not separador:
+        return 1, cantidad
+    cantidad = int(cantidad)
+    if cantidad <= 0:
+        raise ValueError("La cantidad debe ser mayor que 0.")
+    return cantidad, codigo.strip()
+
+
+def registrar_venta(lineas, tipo="Ticket", cliente="", id_cliente=None, fecha=None):
+    """Registra una venta completa (documento, líneas y stock) en una sola transacción. Devuelve su ID.
+
+    lineas es una lista de (id_producto, producto, cantidad, precio, total). Con tipo 'Venta' se
+    crea además la factura (y su registro encadenado); con 'Ticket' solo las líneas del historial.
+    """
+    fecha = fecha or datetime.now().strftime(FORMATO_FECHA)
+    dia = dia_desde_fecha(fecha)
+    conn = conectar_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")  # Reserva la numeración hasta terminar
+        id_venta = siguiente_id_documento(cursor)
+        if tipo == "Venta":
+            cursor.execute('''
+                INSERT INTO facturas (id_factura, cliente, fecha, total, dia, id_cliente, serie, iva) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (id_venta, cliente, fecha, round(sum(linea[4] for linea in lineas), 2), dia, id_cliente,
+                  ajuste("serie_factura"), ajuste("iva")))
+        cursor.executemany('''
+            INSERT INTO historial (id_factura, tipo, producto, cantidad, precio, total, fecha, dia) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(id_venta, tipo, producto, cantidad, precio, total, fecha, dia) for _, producto, cantidad, precio, total in lineas])
+        cursor.executemany("UPDATE productos SET cantidad = cantidad - ? WHERE id = ?",
+                           [(cantidad, id_producto) for id_producto, _, cantidad, _, _ in lineas])
+        if tipo == "Venta":
+            encadenar_facturas(cursor)
+        conn.commit()
+        avisar_documento(cursor, id_venta, [])
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if tipo == "Venta":
+        bus_eventos.publicar(EVENTO_FACTURA, [id_venta])
+    bus_eventos.publicar(EVENTO_PRODUCTO, [linea[0] for linea in lineas])
+    return id_venta
+
+
+# =================== FUNCIONES PARA DEVOLUCIONES Y VALES =================== #
+TIPOS_VENDIDOS = ("Venta", "Ticket", "Albarán")
+
+
+def lineas_devolubles(id_factura, cursor=None):
+    """Líneas de una venta (factura, ticket o albarán) con lo vendido, lo ya devuelto y el precio unitario.
+
+    Devuelve una lista de (producto, vendida, devuelta, precio_unitario) y usa los índices
+    de historial(id_factura) y facturas(id_rectificada). Una factura consolidada no tiene líneas
+    propias: se toman las de sus albaranes, como en lineas_factura, y cuenta como devuelto lo
+    devuelto contra la factura o contra cualquiera de ellos. Con cursor se usa la transacción en curso.
+    """
+    conn = None
+    if cursor is None:
+        conn = conectar_db()
+        cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT producto, SUM(cantidad), SUM(total) FROM (
+            SELECT producto, cantidad, total FROM historial
+            WHERE id_factura = ? AND tipo IN ({", ".join("?" * len(TIPOS_VENDIDOS))})
+            UNION ALL
+            SELECT h.producto, h.cantidad, h.total
+            FROM albaranes a JOIN historial h ON h.id_factura = a.id_albaran AND h.tipo = 'Albarán'
+            WHERE a.id_factura = ?
+        )
+        GROUP BY producto
+    ''', (id_factura, *TIPOS_VENDIDOS, id_factura))
+    vendidas = cursor.fetchall()
+    cursor.execute('''
+        SELECT h.producto, -SUM(h.cantidad) FROM facturas f
+        JOIN historial h ON h.id_factura = f.id_factura
+        WHERE (f.id_rectificada = ? OR f.id_rectificada IN (SELECT id_albaran FROM albaranes WHERE id_factura = ?))
+              AND h.tipo = 'Devolución'
+        GROUP BY h.producto
+    ''', (id_factura, id_factura))
+    devueltas = dict(cursor.fetchall())
+    if conn is not None:
+        conn.close()
+    return [(producto, cantidad, devueltas.get(producto, 0), round(total / cantidad, 2) if cantidad else 0.0)
+            for producto, cantidad, total in vendidas]
+
+
+def factura_de_albaran(id_albaran, cursor=None):
+    """ID de la factura consolidada en que se facturó un albarán, o None si no es un albarán facturado."""
+    conn = None
+    if cursor is None:
+        conn = conectar_db()
+        cursor = conn.cursor()
+    cursor.execute("SELECT id_factura FROM albaranes WHERE id_albaran = ? AND id_factura IS NOT NULL", (id_albaran,))
+    fila = cursor.fetchone()
+    if conn is not None:
+        conn.close()
+    return fila[0] if fila else None
+
+
+def buscar_ventas_por_codigo(codigo, limite=20):
+    """Últimas ventas de un producto a partir de su código de barras: (id_factura, fecha, tipo, producto, cantidad, total)."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT h.id_factura, h.fecha, h.tipo, h.producto, h.cantidad, h.total
+        FROM productos p
+        JOIN historial h ON h.producto = p.nombre
+        WHERE p.codigo = ? AND h.tipo IN ({", ".join("?" * len(TIPOS_VENDIDOS))})
+        ORDER BY h.dia DESC, h.id DESC
+        LIMIT ?
+    ''', (codigo, *TIPOS_VENDIDOS, limite))
+    ventas = cursor.fetchall()
+    conn.close()
+    return ventas
+
+
+def avisar_documento(cursor, id_documento, productos):
+    """Publica las líneas de historial de un documento recién guardado y los productos cuyo stock ha cambiado."""
+    if bus_eventos.escuchando(EVENTO_HISTORIAL):
+        cursor.execute("SELECT id FROM historial WHERE id_factura = ?", (id_documento,))
+        bus_eventos.publicar(EVENTO_HISTORIAL, [fila[0] for fila in cursor.fetchall()])
+    if productos and bus_eventos.escuchando(EVENTO_PRODUCTO):
+        bus_eventos.publicar(EVENTO_PRODUCTO, ids_productos_por_nombre(cursor, productos))
+
+
+def registrar_devolucion(id_factura, lineas, reembolso="vale"):
+    """Registra la devolución de una venta en una sola transacción.
+
+    lineas es una lista de (producto, cantidad); un producto repetido cuenta por la suma de sus
+    cantidades. Crea la factura rectificativa (total negativo), sus líneas 'Devolución' en el
+    historial, devuelve el stock y, si el reembolso es en vale, crea el vale. Lo devolvible se
+    comprueba dentro de la transacción, así que dos cajas no pueden devolver las mismas unidades.
+    Un albarán ya facturado se devuelve contra su factura, que es donde se cuenta lo devuelto.
+    Devuelve (id_rectificativa, id_vale o None).
+    """
+    cantidades = {}
+    for producto, cantidad in lineas:
+        if cantidad <= 0:
+            raise ValueError(f"La cantidad a devolver de {producto} debe ser mayor que 0.")
+        cantidades[producto] = cantidades.get(producto, 0) + cantidad
+    lineas = list(cantidades.items())
+
+    fecha_actual = datetime.now().strftime(FORMATO_FECHA)
+    dia = dia_desde_fecha(fecha_actual)
+
+    conn = conectar_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")  # Comprobación y numeración con el bloqueo de escritura ya tomado
+        id_consolidada = factura_de_albaran(id_factura, cursor)
+        if id_consolidada is not None:
+            raise ValueError(f"El albarán {id_factura} está facturado en la factura {id_consolidada}: "
+                             "haz la devolución contra la factura.")
+        devolubles = {producto: (vendida - devuelta, precio)
+                      for producto, vendida, devuelta, precio in lineas_devolubles(id_factura, cursor)}
+        if not devolubles:
+            raise ValueError(f"No existe ninguna venta con número {id_factura}.")
+        for producto, cantidad in lineas:
+            if producto not in devolubles:
+                raise ValueError(f"El producto {producto} no está en la venta {id_factura}.")
+            if cantidad > devolubles[producto][0]:
+                raise ValueError(f"Solo se pueden devolver {devolubles[producto][0]} unidades de {producto}.")
+        total = -round(sum(cantidad * devolubles[producto][1] for producto, cantidad in lineas), 2)
+
+        cursor.execute("SELECT cliente, id_cliente FROM facturas WHERE id_factura=?", (id_factura,))
+        original = cursor.fetchone() or (f"Devolución ticket {id_factura}", None)
+        id_rectificativa = siguiente_id_documento(cursor)
+
+        cursor.execute('''
+            INSERT INTO facturas (id_factura, cliente, fecha, total, dia, id_cliente, id_rectificada, serie, iva)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (id_rectificativa, original[0], fecha_actual, total, dia, original[1], id_factura,
+              ajuste("serie_rectificativa"), ajuste("iva")))
+        cursor.executemany('''
+            INSERT INTO historial (id_factura, tipo, producto, cantidad, precio, total, fecha, dia)
+            VALUES (?, 'Devolución', ?, ?, ?, ?, ?, ?)
+        ''', [(id_rectificativa, producto, -cantidad, devolubles[producto][1],
+                -round(cantidad * devolubles[producto][1], 2), fecha_actual, dia) for producto, cantidad in lineas])
+        cursor.executemany("UPDATE productos SET cantidad = cantidad + ? WHERE nombre = ?",
+                           [(cantidad, producto) for producto, cantidad in lineas])
+
+        id_vale = None
+        if reembolso == "vale":
+            cursor.execute("INSERT INTO vales (id_cliente, id_factura, fecha, importe, saldo) VALUES (?, ?, ?, ?, ?)",
+                           (original[1], id_rectificativa, fecha_actual, -total, -total))
+            id_vale = cursor.lastrowid
+        encadenar_facturas(cursor)
+        conn.commit()
+        avisar_documento(cursor, id_rectificativa, [producto for producto, cantidad in lineas])
+    except (sqlite3.Error, ValueError):
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bus_eventos.publicar(EVENTO_FACTURA, [id_rectificativa])
+    if id_vale is not None:
+        bus_eventos.publicar(EVENTO_VALE, [id_vale])
+    return id_rectificativa, id_vale
+
+
+def obtener_vales(solo_pendientes=True, ids=None):
+    """Obtiene los vales (por defecto, solo los que tienen saldo) con el nombre del cliente, o solo los de la lista de IDs."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    condiciones = ["v.saldo > 0"] if solo_pendientes else []
+    params = []
+    if ids is not None:
+        params = [lista_sql(ids)]
+        condiciones.append(f"v.id_vale {EN_LISTA}")
+    cursor.execute(f'''
+        SELECT v.id_vale, COALESCE(c.nombre_fiscal, ''), v.id_factura, v.fecha, v.importe, v.saldo
+        FROM vales v LEFT JOIN clientes c ON c.id_cliente = v.id_cliente
+        {"WHERE " + " AND ".join(condiciones) if condiciones else ""}
+        ORDER BY v.id_vale DESC
+    ''', params)
+    vales = cursor.fetchall()
+    conn.close()
+    return vales
+
+
+def saldo_vales_cliente(id_cliente):
+    """Saldo total pendiente en vales de un cliente."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(SUM(saldo), 0) FROM vales WHERE id_cliente = ? AND saldo > 0", (id_cliente,))
+    saldo = cursor.fetchone()[0]
+    conn.close()
+    return saldo
+
+
+def canjear_vale(id_vale, importe):
+    """Descuenta un importe del saldo de un vale. Devuelve el saldo restante o lanza ValueError si no alcanza."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE vales SET saldo = ROUND(saldo - ?, 2) WHERE id_vale = ? AND saldo >= ?", (importe, id_vale, importe))
+    if cursor.rowcount == 0:
+        conn.close()
+        raise ValueError("El vale no existe o no tiene saldo suficiente.")
+    cursor.execute("SELECT saldo FROM vales WHERE id_vale = ?", (id_vale,))
+    saldo = cursor.fetchone()[0]
+    conn.commit()
+    conn.close()
+    bus_eventos.publicar(EVENTO_VALE, [id_vale])
+    return saldo
+
+
+# =================== FUNCIONES PARA ALBARANES Y FACTURACIÓN MENSUAL =================== #
+FILAS_POR_PAGINA_FACTURA = 22  # Filas de la tabla de líneas que caben en una página A5
+
+
+def registrar_albaran(id_albaran, cliente, direccion, fecha, lineas, id_cliente=None):
+    """Registra un albarán (cabecera y líneas) y descuenta el stock, en una sola transacción.
+
+    lineas es una lista de (producto, cantidad, precio, total). Si no se indica id_cliente se
+    busca un cliente registrado con ese nombre fiscal, para poder agruparlo después en su factura.
+    """
+    dia = dia_desde_fecha(fecha)
+    conn = conectar_db()
+    cursor = conn.cursor()
+    try:
+        if id_cliente is None:
+            cursor.execute("SELECT id_cliente FROM clientes WHERE nombre_fiscal = ? COLLATE NOCASE", (cliente.strip(),))
+            fila = cursor.fetchone()
+            id_cliente = fila[0] if fila else None
+        cursor.execute('''
+            INSERT INTO albaranes (id_albaran, id_cliente, cliente, direccion, fecha, dia, total, serie)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (id_albaran, id_cliente, cliente.strip(), direccion, fecha, dia, round(sum(linea[3] for linea in lineas), 2),
+              ajuste("serie_albaran")))
+        cursor.executemany('''
+            INSERT INTO historial (id_factura, tipo, producto, cantidad, precio, total, fecha, dia)
+            VALUES (?, 'Albarán', ?, ?, ?, ?, ?, ?)
+        ''', [(id_albaran, producto, cantidad, precio, total, fecha, dia) for producto, cantidad, precio, total in lineas])
+        # La mercancía sale con el albarán, aunque se facture a final de mes
+        cursor.executemany("UPDATE productos SET cantidad = cantidad - ? WHERE nombre = ?",
+                           [(cantidad, producto) for producto, cantidad, precio, total in lineas])
+        conn.commit()
+        avisar_documento(cursor, id_albaran, [linea[0] for linea in lineas])
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bus_eventos.publicar(EVENTO_ALBARAN, [id_albaran])
+    return id_cliente
+
+
+def resumen_albaranes_pendientes(desde=None, hasta=None):
+    """Albaranes sin facturar agrupados por cliente: (cliente, nº de albaranes, primer día, último día, total)."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    params = []
+    query = filtro_dias("SELECT * FROM albaranes WHERE id_factura IS NULL", params, desde, hasta)
+    cursor.execute(f'''
+        SELECT COALESCE(c.nombre_fiscal, a.cliente), COUNT(*), MIN(a.fecha), MAX(a.fecha), ROUND(SUM(a.total), 2)
+        FROM ({query}) a LEFT JOIN clientes c ON c.id_cliente = a.id_cliente
+        GROUP BY COALESCE('c' || a.id_cliente, 'n' || a.cliente)
+        ORDER BY 1
+    ''', params)
+    resumen = cursor.fetchall()
+    conn.close()
+    return resumen
+
+
+def consolidar_albaranes(desde=None, hasta=None, fecha=None):
+    """Agrupa los albaranes pendientes del periodo en una factura por cliente y los marca como facturados.
+
+    Todo se hace con sentencias sobre conjuntos dentro de una transacción: da igual que haya
+    diez clientes o quinientos. Los albaranes de un cliente registrado se agrupan por id_cliente
+    y los demás por el nombre escrito en el albarán. Devuelve los IDs de las facturas creadas.
+    """
+    fecha = fecha or datetime.now().strftime(FORMATO_FECHA)
+    conn = conectar_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")  # Reserva la numeración hasta terminar
+        cursor.execute("CREATE TEMP TABLE albaranes_a_facturar (id_albaran INTEGER PRIMARY KEY, grupo TEXT NOT NULL)")
+        params = []
+        query = filtro_dias('''
+            INSERT INTO albaranes_a_facturar
+            SELECT id_albaran, COALESCE('c' || id_cliente, 'n' || cliente) FROM albaranes
+            WHERE id_factura IS NULL AND cliente <> ''
+        ''', params, desde, hasta)
+        cursor.execute(query, params)
+
+        primer_id = siguiente_id_documento(cursor)
+        cursor.execute('''
+            CREATE TEMP TABLE facturas_consolidadas AS
+            SELECT p.grupo AS grupo,
+                   ? - 1 + ROW_NUMBER() OVER (ORDER BY MIN(a.id_albaran)) AS id_factura,
+                   MAX(a.id_cliente) AS id_cliente,
+                   MAX(a.cliente) AS cliente,
+                   ROUND(SUM(a.total), 2) AS total
+            FROM albaranes_a_facturar p JOIN albaranes a ON a.id_albaran = p.id_albaran
+            GROUP BY p.grupo
+        ''', (primer_id,))
+        cursor.execute('''
+            INSERT INTO facturas (id_factura, cliente, fecha, total, dia, id_cliente, serie, iva)
+            SELECT f.id_factura, COALESCE(c.nombre_fiscal, f.cliente), ?, f.total, ?, f.id_cliente, ?, ?
+            FROM facturas_consolidadas f LEFT JOIN clientes c ON c.id_cliente = f.id_cliente
+        ''', (fecha, dia_desde_fecha(fecha), ajuste("serie_factura"), ajuste("iva")))
+        cursor.execute('''
+            UPDATE albaranes SET id_factura = (
+                SELECT f.id_factura FROM albaranes_a_facturar p
+                JOIN facturas_consolidadas f ON f.grupo = p.grupo
+                WHERE p.id_albaran = albaranes.id_albaran)
+            WHERE id_albaran IN (SELECT id_albaran FROM albaranes_a_facturar)
+        ''')
+        cursor.execute("SELECT id_factura FROM facturas_consolidadas ORDER BY id_factura")
+        ids_facturas = [fila[0] for fila in cursor.fetchall()]
+        cursor.execute("SELECT id_albaran FROM albaranes_a_facturar")
+        ids_albaranes = [fila[0] for fila in cursor.fetchall()]
+        encadenar_facturas(cursor)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bus_eventos.publicar(EVENTO_FACTURA, ids_facturas)
+    bus_eventos.publicar(EVENTO_ALBARAN, ids_albaranes)
+    return ids_facturas
+
+
+def datos_facturas_consolidadas(ids_facturas):
+    """Carga de una vez las cabeceras y líneas de varias facturas consolidadas.
+
+    Devuelve una lista de (cabecera, lineas) en el orden de ids_facturas, donde cabecera es
+    (id_factura, cliente, fecha, total, nif, direccion, codigo_postal, poblacion, provincia, serie, iva)
+    y cada línea es (numero_albaran, fecha_albaran, producto, cantidad, precio, total).
+    """
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE ids_a_imprimir (id_factura INTEGER PRIMARY KEY)")
+    cursor.executemany("INSERT OR IGNORE INTO ids_a_imprimir VALUES (?)", [(i,) for i in ids_facturas])
+    cursor.execute('''
+        SELECT f.id_factura, f.cliente, f.fecha, f.total, COALESCE(c.identificacion_fiscal, ''),
+               COALESCE(c.direccion, (SELECT a.direccion FROM albaranes a WHERE a.id_factura = f.id_factura
+                                      ORDER BY a.id_albaran DESC LIMIT 1), ''),
+               COALESCE(c.codigo_postal, ''), COALESCE(c.poblacion, ''), COALESCE(c.provincia, ''), f.serie, f.iva
+        FROM ids_a_imprimir i
+        JOIN facturas f ON f.id_factura = i.id_factura
+        LEFT JOIN clientes c ON c.id_cliente = f.id_cliente
+    ''')
+    cabeceras = {fila[0]: fila for fila in cursor.fetchall()}
+    cursor.execute('''
+        SELECT a.id_factura, COALESCE(a.serie, '') || a.id_albaran, a.fecha, h.producto, h.cantidad, h.precio, h.total
+        FROM ids_a_imprimir i
+        JOIN albaranes a ON a.id_factura = i.id_factura
+        JOIN historial h ON h.id_factura = a.id_albaran AND h.tipo = 'Albarán'
+        ORDER BY a.id_factura, a.id_albaran, h.id
+    ''')
+    lineas = {}
+    for fila in cursor.fetchall():
+        lineas.setdefault(fila[0], []).append(fila[1:])
+    conn.close()
+    return [(cabeceras[i], lineas.get(i, [])) for i in ids_facturas if i in cabeceras]
+
+
+def renderizar_factura_consolidada(ruta, cabecera, lineas):
+    """Dibuja en A5 la factura de varios albaranes, con una fila de encabezado por albarán y salto de página si no cabe.
+
+    La cabecera y las líneas son las de datos_facturas_consolidadas; las líneas con numero_albaran
+    None (venta directa en caja) van sin fila de encabezado.
+    """
+    id_factura, cliente, fecha, total_con_iva, nif, direccion, codigo_postal, poblacion, provincia, serie, iva_porcentaje = cabecera
+    filas = []
+    albaran_actual = None
+    for numero_albaran, fecha_albaran, producto, cantidad, precio, total in lineas:
+        if numero_albaran != albaran_actual:
+            albaran_actual = numero_albaran
+            filas.append([f"Albarán {numero_albaran} ({fecha_albaran[:10]})", "", "", ""])
+        filas.append([producto, str(cantidad), f"{precio:.2f} €", f"{total:.2f} €"])
+    paginas = [filas[i:i + FILAS_POR_PAGINA_FACTURA] for i in range(0, len(filas), FILAS_POR_PAGINA_FACTURA)] or [[]]
+
+    c = canvas.Canvas(ruta, pagesize=A5)
+    top_position = 570
+    for numero, filas_pagina in enumerate(paginas, start=1):
+        c.setFont("Helvetica-Bold", 9)
+        c.drawString(20, top_position, f"Factura ID: {numero_documento('factura', id_factura, serie)}")
+        c.setFont("Helvetica", 8)
+        lineas_cliente = [f"Cliente: {cliente}"]
+        if nif:
+            lineas_cliente.append(f"NIF: {nif}")
+        lineas_cliente.append(f"Dirección: {direccion}")
+        localidad = " ".join(parte for parte in (codigo_postal, poblacion) if parte)
+        if provincia:
+            localidad += f" ({provincia})"
+        if localidad:
+            lineas_cliente.append(localidad)
+        lineas_cliente.append(f"Fecha: {fecha}")
+        for i, linea in enumerate(lineas_cliente):
+            c.drawString(20, top_position - 15 - 10 * i, linea)
+        for i, linea in enumerate(lineas_cabecera_emisor()):
+            c.drawString(200, top_position - 8 - 10 * i, linea)
+        c.drawRightString(400, 20, f"Página {numero} de {len(paginas)}")
+
+        c.setFont("Helvetica-Bold", 12)
+        c.drawCentredString(150, top_position - 85, ajuste("nombre"))
+
+        data = [['Descripción / Producto', 'Cantidad', 'Precio', 'Total']] + filas_pagina
+        estilo = [
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 7),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+        ]
+        # Las filas de encabezado de cada albarán ocupan toda la anchura
+        for i, fila in enumerate(data[1:], start=1):
+            if not fila[1]:
+                estilo += [('SPAN', (0, i), (-1, i)), ('ALIGN', (0, i), (-1, i), 'LEFT'),
+                           ('FONTNAME', (0, i), (-1, i), 'Helvetica-Bold')]
+        table = Table(data, colWidths=[160, 50, 50, 50])
+        table.setStyle(TableStyle(estilo))
+        _, table_height = table.wrapOn(c, 360, 420)
+        table.drawOn(c, 20, top_position - 100 - table_height)
+
+        if numero < len(paginas):
+            c.showPage()
+            continue
+
+        y_position = top_position - 100 - table_height - 30
+        total_sin_iva = total_con_iva / (1 + iva_porcentaje / 100)
+        iva_total = total_con_iva - total_sin_iva
+        c.setFont("Helvetica-Bold", 8)
+        c.drawString(150, y_position, "Subtotal (sin IVA):")
+        c.drawRightString(250, y_position, f"{total_sin_iva:.2f} €")
+        c.drawString(150, y_position - 15, f"IVA ({iva_porcentaje}%):")
+        c.drawRightString(250, y_position - 15, f"{iva_total:.2f} €")
+        c.drawString(150, y_position - 30, "Total (con IVA):")
+        c.drawRightString(250, y_position - 30, f"{total_con_iva:.2f} €")
+    c.save()
+
+
+def generar_pdfs_consolidados(ids_facturas, directorio=None, progreso=None):
+    """Genera los PDF de varias facturas consolidadas en un directorio. progreso(hechas, total) se llama tras cada una."""
+    directorio = directorio or os.path.join(ruta_salida_documentos(), f"facturas_{datetime.now():%Y-%m-%d}")
+    os.makedirs(directorio, exist_ok=True)
+    facturas = datos_facturas_consolidadas(ids_facturas)
+    rutas = []
+    for hechas, (cabecera, lineas) in enumerate(facturas, start=1):
+        ruta = os.path.join(directorio, f"factura_{cabecera[0]}.pdf")
+        renderizar_factura_consolidada(ruta, cabecera, lineas)
+        rutas.append(ruta)
+        if progreso:
+            progreso(hechas, len(facturas))
+    return rutas
+
+
+def facturar_albaranes(desde=None, hasta=None, directorio=None, progreso=None):
+    """Consolida los albaranes del periodo y genera sus PDF. Devuelve (ids de facturas, rutas de los PDF)."""
+    ids_facturas = consolidar_albaranes(desde, hasta)
+    return ids_facturas, generar_pdfs_consolidados(ids_facturas, directorio, progreso) if ids_facturas else []
+
+
+# =================== FACTURA ELECTRÓNICA (FACTURAE Y VERIFACTU) =================== #
+# Los datos del emisor y el tipo de IVA salen de los ajustes de la tienda
+NS_FACTURAE = "http://www.facturae.gob.es/formato/Versiones/Facturaev3_2_2.xml"
+NS_XMLDSIG = "http://www.w3.org/2000/09/xmldsig#"
+NS_VERIFACTU = "https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/"
+REGISTROS_POR_ENVIO = 1000  # Máximo de registros de facturación por envío a la AEAT
+LETRAS_PERSONA_JURIDICA = "ABCDEFGHJNPQRSUVW"
+
+
+class EscritorXML:
+    """Escribe XML en un archivo de texto según se genera, con sangría y sin construir el árbol en memoria."""
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self.nivel = 0
+        archivo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+
+    def abrir(self, nombre, atributos=None):
+        texto_atributos = "".join(f" {clave}={quoteattr(valor)}" for clave, valor in (atributos or {}).items())
+        self.archivo.write(f"{'  ' * self.nivel}<{nombre}{texto_atributos}>\n")
+        self.nivel += 1
+
+    def cerrar(self, nombre):
+        self.nivel -= 1
+        self.archivo.write(f"{'  ' * self.nivel}</{nombre}>\n")
+
+    def elemento(self, nombre, texto):
+        self.archivo.write(f"{'  ' * self.nivel}<{nombre}>{escape(str(texto))}</{nombre}>\n")
+
+    def importe(self, nombre, valor):
+        """Elemento con un TotalAmount dentro, como piden las bases y cuotas de Facturae."""
+        self.abrir(nombre)
+        self.elemento("TotalAmount", importe_xml(valor))
+        self.cerrar(nombre)
+
+
+def importe_xml(valor, decimales=2):
+    """Formatea un importe con punto decimal y los decimales indicados."""
+    return f"{valor:.{decimales}f}"
+
+
+def desglose_iva(total, iva=None):
+    """(base, cuota) de un importe con IVA incluido. La cuota es la diferencia, para que base + cuota = total."""
+    iva = ajuste("iva") if iva is None else iva
+    base = round(total / (1 + iva / 100), 2)
+    return base, round(total - base, 2)
+
+
+def es_persona_juridica(nif):
+    """Las sociedades y entidades tienen NIF que empieza por letra (los NIE empiezan por X, Y o Z)."""
+    return bool(nif) and nif[0].upper() in LETRAS_PERSONA_JURIDICA
+
+
+def tipo_factura_verifactu(id_cliente, id_rectificada, original_con_cliente):
+    """Tipo de factura de Verifactu: F1 completa, F2 simplificada, R1 rectificativa y R5 rectificativa de simplificada."""
+    if id_rectificada is None:
+        return "F1" if id_cliente else "F2"
+    # Las devoluciones rectifican por el art. 80.Dos LIVA; si la venta fue un ticket, la rectificativa es R5
+    return "R1" if original_con_cliente else "R5"
+
+
+def huella_registro(nif, num_serie, fecha_expedicion, tipo_factura, cuota_total, importe_total, huella_anterior, fecha_hora_huso):
+    """Huella SHA-256 de un registro de alta, encadenada con la del registro anterior."""
+    cadena = (f"IDEmisorFactura={nif}&NumSerieFactura={num_serie}&FechaExpedicionFactura={fecha_expedicion}"
+              f"&TipoFactura={tipo_factura}&CuotaTotal={cuota_total}&ImporteTotal={importe_total}"
+              f"&Huella={huella_anterior or ''}&FechaHoraHusoGenRegistro={fecha_hora_huso}")
+    return hashlib.sha256(cadena.encode("utf-8")).hexdigest().upper()
+
+
+def encadenar_facturas(cursor):
+    """Crea el registro encadenado de las facturas que aún no lo tienen, por orden de número.
+
+    Se llama con la transacción de alta abierta (la factura ya insertada tiene el bloqueo de
+    escritura), así que la huella se graba en el mismo commit que la factura y dos cajas no
+    pueden encadenar a la vez sobre el mismo registro anterior. Se buscan todas las facturas sin
+    registro, no solo las de número mayor que la última encadenada: con varias cajas, un número
+    reservado antes puede guardarse después. Devuelve cuántos registros creó.
+    """
+    cursor.execute("SELECT huella FROM registros_facturacion ORDER BY id_registro DESC LIMIT 1")
+    huella = (cursor.fetchone() or (None,))[0]
+    cursor.execute('''
+        SELECT f.id_factura, f.dia, f.total, f.id_cliente, f.id_rectificada, o.id_cliente IS NOT NULL, f.serie, f.iva
+        FROM facturas f LEFT JOIN facturas o ON o.id_factura = f.id_rectificada
+        WHERE NOT EXISTS (SELECT 1 FROM registros_facturacion r WHERE r.id_factura = f.id_factura)
+        ORDER BY f.id_factura
+    ''')
+    registros = []
+    nif = ajuste("nif")
+    for id_factura, dia, total, id_cliente, id_rectificada, original_con_cliente, serie, iva in cursor.fetchall():
+        fecha_expedicion = (fecha_desde_dia(dia) if dia is not None else date.today()).strftime("%d-%m-%Y")
+        tipo = tipo_factura_verifactu(id_cliente, id_rectificada, original_con_cliente)
+        cuota, importe = importe_xml(desglose_iva(total, iva)[1]), importe_xml(total)
+        momento = datetime.now().astimezone().isoformat(timespec="seconds")
+        num_serie = numero_documento("rectificativa" if id_rectificada else "factura", id_factura, serie)
+        nueva = huella_registro(nif, num_serie, fecha_expedicion, tipo, cuota, importe, huella, momento)
+        registros.append((id_factura, nif, num_serie, fecha_expedicion, tipo, cuota, importe, huella, momento, nueva))
+        huella = nueva
+    cursor.executemany('''
+        INSERT INTO registros_facturacion (id_factura, nif_emisor, num_serie, fecha_expedicion, tipo_factura,
+                                           cuota_total, importe_total, huella_anterior, fecha_hora_huso, huella)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', registros)
+    return len(registros)
+
+
+def verificar_cadena_registros(cursor=None):
+    """Recalcula la cadena de huellas. Devuelve los id_factura cuyo registro no cuadra (lista vacía si está íntegra).
+
+    Un registro no cuadra si su huella no coincide, si no enlaza con el anterior o si el
+    importe de la factura ya no es el que se registró. También se devuelven las facturas que
+    no tienen registro. Con cursor se usa la transacción en curso.
+    """
+    conn = None
+    if cursor is None:
+        conn = conectar_db()
+        cursor = conn.cursor()
+    cursor.execute('''
+        SELECT r.id_factura, r.nif_emisor, r.num_serie, r.fecha_expedicion, r.tipo_factura, r.cuota_total,
+               r.importe_total, r.huella_anterior, r.fecha_hora_huso, r.huella, f.total
+        FROM registros_facturacion r LEFT JOIN facturas f ON f.id_factura = r.id_factura
+        ORDER BY r.id_registro
+    ''')
+    erroneos = []
+    anterior = None
+    for fila in cursor:
+        id_factura, huella_anterior, huella, total = fila[0], fila[7], fila[9], fila[10]
+        correcta = (huella_anterior == anterior and huella_registro(*fila[1:9]) == huella
+                    and total is not None and importe_xml(total) == fila[6])
+        if not correcta:
+            erroneos.append(id_factura)
+        anterior = huella
+    cursor.execute('''
+        SELECT f.id_factura FROM facturas f
+        WHERE NOT EXISTS (SELECT 1 FROM registros_facturacion r WHERE r.id_factura = f.id_factura)
+        ORDER BY f.id_factura
+    ''')
+    erroneos.extend(fila[0] for fila in cursor.fetchall())
+    if conn is not None:
+        conn.close()
+    return erroneos
+
+
+def lineas_factura(cursor, id_factura):
+    """Líneas de una factura: las suyas del historial o, si es consolidada, las de sus albaranes."""
+    cursor.execute('''
+        SELECT producto, cantidad, precio, total FROM historial WHERE id_factura = ?
+        UNION ALL
+        SELECT h.producto, h.cantidad, h.precio, h.total
+        FROM albaranes a JOIN historial h ON h.id_factura = a.id_albaran AND h.tipo = 'Albarán'
+        WHERE a.id_factura = ?
+    ''', (id_factura, id_factura))
+    return cursor.fetchall()
+
+
+def escribir_parte_facturae(xml, etiqueta, nif, nombre, direccion, codigo_postal, poblacion, provincia):
+    """Escribe el vendedor o el comprador (SellerParty / BuyerParty) de un archivo Facturae."""
+    juridica = es_persona_juridica(nif)
+    xml.abrir(etiqueta)
+    xml.abrir("TaxIdentification")
+    xml.elemento("PersonTypeCode", "J" if juridica else "F")
+    xml.elemento("ResidenceTypeCode", "R")
+    xml.elemento("TaxIdentificationNumber", nif)
+    xml.cerrar("TaxIdentification")
+    if juridica:
+        xml.abrir("LegalEntity")
+        xml.elemento("CorporateName", nombre)
+    else:
+        partes = nombre.split()
+        xml.abrir("Individual")
+        xml.elemento("Name", partes[0] if partes else "")
+        xml.elemento("FirstSurname", partes[1] if len(partes) > 1 else "")
+        if len(partes) > 2:
+            xml.elemento("SecondSurname", " ".join(partes[2:]))
+    xml.abrir("AddressInSpain")
+    xml.elemento("Address", direccion or "")
+    xml.elemento("PostCode", codigo_postal or "")
+    xml.elemento("Town", poblacion or "")
+    xml.elemento("Province", provincia or "")
+    xml.elemento("CountryCode", "ESP")
+    xml.cerrar("AddressInSpain")
+    xml.cerrar("LegalEntity" if juridica else "Individual")
+    xml.cerrar(etiqueta)
+
+
+def escribir_impuesto_facturae(xml, base, cuota, iva):
+    xml.abrir("TaxesOutputs")
+    xml.abrir("Tax")
+    xml.elemento("TaxTypeCode", "01")
+    xml.elemento("TaxRate", importe_xml(iva))
+    xml.importe("TaxableBase", base)
+    xml.importe("TaxAmount", cuota)
+    xml.cerrar("Tax")
+    xml.cerrar("TaxesOutputs")
+
+
+def escribir_factura_facturae(xml, id_factura, serie, fecha, total, iva, id_rectificada, serie_original, dia_original, lineas):
+    """Escribe un elemento Invoice. Las líneas de una sola factura sí se tienen en memoria: hacen falta los totales antes.
+
+    La serie y el IVA son los guardados con la factura al emitirla.
+    """
+    if not lineas:  # Líneas ya archivadas: se declara el importe en una única línea
+        lineas = [(f"Factura {id_factura}", 1, total, total)]
+    bases = [desglose_iva(importe, iva)[0] for _, _, _, importe in lineas]
+    base = round(sum(bases), 2)
+    cuota = round(total - base, 2)
+
+    xml.abrir("Invoice")
+    xml.abrir("InvoiceHeader")
+    xml.elemento("InvoiceNumber", id_factura)
+    if serie:
+        xml.elemento("InvoiceSeriesCode", serie)
+    xml.elemento("InvoiceDocumentType", "FC")
+    xml.elemento("InvoiceClass", "OR" if id_rectificada else "OO")
+    if id_rectificada:
+        dia_original = fecha_desde_dia(dia_original if dia_original is not None else dia_desde_fecha(fecha)).isoformat()
+        xml.abrir("Corrective")
+        xml.elemento("InvoiceNumber", id_rectificada)
+        if serie_original:
+            xml.elemento("InvoiceSeriesCode", serie_original)
+        xml.elemento("ReasonCode", "83")
+        xml.elemento("ReasonDescription", "Base imponible modificada por descuentos y bonificaciones")
+        xml.abrir("TaxPeriod")
+        xml.elemento("StartDate", dia_original)
+        xml.elemento("EndDate", dia_original)
+        xml.cerrar("TaxPeriod")
+        xml.elemento("CorrectionMethod", "02")
+        xml.elemento("CorrectionMethodDescription", "Rectificación por diferencias")
+        xml.cerrar("Corrective")
+    xml.cerrar("InvoiceHeader")
+
+    xml.abrir("InvoiceIssueData")
+    xml.elemento("IssueDate", fecha[:10])
+    xml.elemento("InvoiceCurrencyCode", "EUR")
+    xml.elemento("TaxCurrencyCode", "EUR")
+    xml.elemento("LanguageName", "es")
+    xml.cerrar("InvoiceIssueData")
+    escribir_impuesto_facturae(xml, base, cuota, iva)
+
+    xml.abrir("InvoiceTotals")
+    xml.elemento("TotalGrossAmount", importe_xml(base))
+    xml.elemento("TotalGrossAmountBeforeTaxes", importe_xml(base))
+    xml.elemento("TotalTaxOutputs", importe_xml(cuota))
+    xml.elemento("TotalTaxesWithheld", importe_xml(0))
+    xml.elemento("InvoiceTotal", importe_xml(total))
+    xml.elemento("TotalOutstandingAmount", importe_xml(total))
+    xml.elemento("TotalExecutableAmount", importe_xml(total))
+    xml.cerrar("InvoiceTotals")
+
+    xml.abrir("Items")
+    for (producto, cantidad, precio, importe), base_linea in zip(lineas, bases):
+        xml.abrir("InvoiceLine")
+        xml.elemento("ItemDescription", producto)
+        xml.elemento("Quantity", importe_xml(cantidad))
+        xml.elemento("UnitOfMeasure", "01")
+        xml.elemento("UnitPriceWithoutTax", importe_xml(precio / (1 + iva / 100), 6))
+        xml.elemento("TotalCost", importe_xml(base_linea))
+        xml.elemento("GrossAmount", importe_xml(base_linea))
+        escribir_impuesto_facturae(xml, base_linea, round(importe - base_linea, 2), iva)
+        xml.cerrar("InvoiceLine")
+    xml.cerrar("Items")
+    xml.cerrar("Invoice")
+
+
+def ruta_exportaciones(directorio=None):
+    """Directorio de las exportaciones de factura electrónica (por defecto, dentro del directorio de salida)."""
+    directorio = directorio or os.path.join(ruta_salida_documentos(), "factura_electronica")
+    os.makedirs(directorio, exist_ok=True)
+    return directorio
+
+
+def sufijo_periodo(desde=None, hasta=None):
+    return f"{desde or 'inicio'}_{hasta or 'hoy'}".replace("-", "")
+
+
+def exportar_facturae(desde=None, hasta=None, directorio=None):
+    """Genera un archivo Facturae 3.2.2 por cliente con sus facturas del periodo. Devuelve las rutas.
+
+    Solo entran las facturas de clientes registrados con NIF (Facturae exige identificar al
+    comprador). Las facturas se leen con un cursor y se escriben según llegan, así que la
+    memoria no crece con el número de facturas.
+    """
+    directorio = ruta_exportaciones(directorio)
+    emisor = ajustes()
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor_lineas = conn.cursor()
+    params = []
+    filtro = filtro_dias("c.identificacion_fiscal <> ''", params, desde, hasta, columna="f.dia")
+    # Totales del lote por cliente: la cabecera del archivo va antes que las facturas
+    cursor.execute(f'''
+        SELECT f.id_cliente, COUNT(*), MIN(f.id_factura), ROUND(SUM(f.total), 2)
+        FROM facturas f JOIN clientes c ON c.id_cliente = f.id_cliente
+        WHERE {filtro} GROUP BY f.id_cliente
+    ''', params)
+    lotes = {fila[0]: fila[1:] for fila in cursor.fetchall()}
+    cursor.execute(f'''
+        SELECT f.id_cliente, c.identificacion_fiscal, c.nombre_fiscal, c.direccion, c.codigo_postal, c.poblacion, c.provincia,
+               f.id_factura, COALESCE(f.serie, ''), f.fecha, f.total, COALESCE(f.iva, ?), f.id_rectificada, o.serie,
+               COALESCE(o.dia, (SELECT MIN(h.dia) FROM historial h WHERE h.id_factura = f.id_rectificada))
+        FROM facturas f JOIN clientes c ON c.id_cliente = f.id_cliente
+        LEFT JOIN facturas o ON o.id_factura = f.id_rectificada
+        WHERE {filtro}
+        ORDER BY f.id_cliente, f.id_factura
+    ''', [emisor["iva"]] + params)
+
+    rutas = []
+    archivo = xml = None
+    id_cliente_actual = None
+    for fila in cursor:
+        id_cliente, nif = fila[0], fila[1]
+        if id_cliente != id_cliente_actual:
+            if xml:
+                xml.cerrar("Invoices")
+                xml.cerrar("fe:Facturae")
+                archivo.close()
+            id_cliente_actual = id_cliente
+            numero, primera, importe = lotes[id_cliente]
+            ruta = os.path.join(directorio, f"facturae_{nif}_{sufijo_periodo(desde, hasta)}.xml")
+            archivo = open(ruta, "w", encoding="utf-8")
+            rutas.append(ruta)
+            xml = EscritorXML(archivo)
+            xml.abrir("fe:Facturae", {"xmlns:fe": NS_FACTURAE, "xmlns:ds": NS_XMLDSIG})
+            xml.abrir("FileHeader")
+            xml.elemento("SchemaVersion", "3.2.2")
+            xml.elemento("Modality", "I" if numero == 1 else "L")
+            xml.elemento("InvoiceIssuerType", "EM")
+            xml.abrir("Batch")
+            xml.elemento("BatchIdentifier", f"{emisor['nif']}{primera}")
+            xml.elemento("InvoicesCount", numero)
+            xml.importe("TotalInvoicesAmount", importe)
+            xml.importe("TotalOutstandingAmount", importe)
+            xml.importe("TotalExecutableAmount", importe)
+            xml.elemento("InvoiceCurrencyCode", "EUR")
+            xml.cerrar("Batch")
+            xml.cerrar("FileHeader")
+            xml.abrir("Parties")
+            escribir_parte_facturae(xml, "SellerParty", emisor["nif"], emisor["nombre"], emisor["direccion"],
+                                    emisor["codigo_postal"], emisor["poblacion"], emisor["provincia"])
+            escribir_parte_facturae(xml, "BuyerParty", *fila[1:7])
+            xml.cerrar("Parties")
+            xml.abrir("Invoices")
+        escribir_factura_facturae(xml, *fila[7:], lineas_factura(cursor_lineas, fila[7]))
+    if xml:
+        xml.cerrar("Invoices")
+        xml.cerrar("fe:Facturae")
+        archivo.close()
+    conn.close()
+    return rutas
+
+
+def escribir_id_factura_verifactu(xml, etiqueta, nif, num_serie, fecha_expedicion):
+    xml.abrir(etiqueta)
+    xml.elemento("sum1:IDEmisorFactura", nif)
+    xml.elemento("sum1:NumSerieFactura", num_serie)
+    xml.elemento("sum1:FechaExpedicionFactura", fecha_expedicion)
+    xml.cerrar(etiqueta)
+
+
+def exportar_verifactu(desde=None, hasta=None, directorio=None):
+    """Exporta los registros de alta encadenados del periodo, en archivos de hasta REGISTROS_POR_ENVIO registros.
+
+    Las huellas ya están calculadas (se encadenan al dar de alta cada factura); aquí solo se
+    leen con un cursor y se escriben según llegan. Devuelve las rutas de los archivos.
+    """
+    directorio = ruta_exportaciones(directorio)
+    emisor = ajustes()
+    conn = conectar_db()
+    cursor = conn.cursor()
+    params = []
+    filtro = filtro_dias("1=1", params, desde, hasta, columna="f.dia")
+    cursor.execute(f'''
+        SELECT r.nif_emisor, r.num_serie, r.fecha_expedicion, r.tipo_factura, r.cuota_total, r.importe_total,
+               r.huella_anterior, r.fecha_hora_huso, r.huella, f.id_rectificada,
+               COALESCE(o.dia, (SELECT MIN(h.dia) FROM historial h WHERE h.id_factura = f.id_rectificada)),
+               c.identificacion_fiscal, c.nombre_fiscal, p.num_serie, p.fecha_expedicion, COALESCE(f.iva, ?),
+               ro.num_serie, ro.fecha_expedicion
+        FROM registros_facturacion r
+        JOIN facturas f ON f.id_factura = r.id_factura
+        LEFT JOIN facturas o ON o.id_factura = f.id_rectificada
+        LEFT JOIN registros_facturacion ro ON ro.id_factura = f.id_rectificada
+        LEFT JOIN clientes c ON c.id_cliente = f.id_cliente
+        LEFT JOIN registros_facturacion p ON p.id_registro = (
+            SELECT MAX(id_registro) FROM registros_facturacion WHERE id_registro < r.id_registro)
+        WHERE {filtro}
+        ORDER BY r.id_registro
+    ''', [emisor["iva"]] + params)
+
+    rutas = []
+    archivo = xml = None
+    for n, fila in enumerate(cursor):
+        (nif, num_serie, fecha_expedicion, tipo, cuota, importe, huella_anterior, momento, huella,
+         id_rectificada, dia_original, nif_cliente, nombre_cliente, serie_anterior, fecha_anterior, iva,
+         serie_rectificada, fecha_rectificada) = fila
+        if n % REGISTROS_POR_ENVIO == 0:
+            if xml:
+                xml.cerrar("sum:RegFactuSistemaFacturacion")
+                archivo.close()
+            ruta = os.path.join(directorio, f"verifactu_{sufijo_periodo(desde, hasta)}_{n // REGISTROS_POR_ENVIO + 1:03d}.xml")
+            archivo = open(ruta, "w", encoding="utf-8")
+            rutas.append(ruta)
+            xml = EscritorXML(archivo)
+            xml.abrir("sum:RegFactuSistemaFacturacion", {"xmlns:sum": NS_VERIFACTU + "SuministroLR.xsd",
+                                                         "xmlns:sum1": NS_VERIFACTU + "SuministroInformacion.xsd"})
+            xml.abrir("sum:Cabecera")
+            xml.abrir("sum1:ObligadoEmision")
+            xml.elemento("sum1:NombreRazon", emisor["nombre"])
+            xml.elemento("sum1:NIF", emisor["nif"])
+            xml.cerrar("sum1:ObligadoEmision")
+            xml.cerrar("sum:Cabecera")
+
+        xml.abrir("sum:RegistroFactura")
+        xml.abrir("sum1:RegistroAlta")
+        xml.elemento("sum1:IDVersion", "1.0")
+        escribir_id_factura_verifactu(xml, "sum1:IDFactura", nif, num_serie, fecha_expedicion)
+        xml.elemento("sum1:NombreRazonEmisor", emisor["nombre"])
+        xml.elemento("sum1:TipoFactura", tipo)
+        if id_rectificada:
+            xml.elemento("sum1:TipoRectificativa", "I")
+            xml.abrir("sum1:FacturasRectificadas")
+            # Una factura rectificada lleva su número y fecha registrados; un ticket no tiene registro
+            if serie_rectificada is None:
+                serie_rectificada = numero_documento("ticket", id_rectificada)
+                fecha_rectificada = fecha_desde_dia(dia_original).strftime("%d-%m-%Y") if dia_original is not None else fecha_expedicion
+            escribir_id_factura_verifactu(xml, "sum1:IDFacturaRectificada", nif, serie_rectificada, fecha_rectificada)
+            xml.cerrar("sum1:FacturasRectificadas")
+        xml.elemento("sum1:DescripcionOperacion", "Venta de artículos de ferretería")
+        if tipo in ("F1", "R1") and nif_cliente:
+            xml.abrir("sum1:Destinatarios")
+            xml.abrir("sum1:IDDestinatario")
+            xml.elemento("sum1:NombreRazon", nombre_cliente)
+            xml.elemento("sum1:NIF", nif_cliente)
+            xml.cerrar("sum1:IDDestinatario")
+            xml.cerrar("sum1:Destinatarios")
+        xml.abrir("sum1:Desglose")
+        xml.abrir("sum1:DetalleDesglose")
+        xml.elemento("sum1:Impuesto", "01")
+        xml.elemento("sum1:ClaveRegimen", "01")
+        xml.elemento("sum1:CalificacionOperacion", "S1")
+        xml.elemento("sum1:TipoImpositivo", importe_xml(iva))
+        xml.elemento("sum1:BaseImponibleOimporteNoSujeto", importe_xml(float(importe) - float(cuota)))
+        xml.elemento("sum1:CuotaRepercutida", cuota)
+        xml.cerrar("sum1:DetalleDesglose")
+        xml.cerrar("sum1:Desglose")
+        xml.elemento("sum1:CuotaTotal", cuota)
+        xml.elemento("sum1:ImporteTotal", importe)
+        xml.abrir("sum1:Encadenamiento")
+        if huella_anterior:
+            xml.abrir("sum1:RegistroAnterior")
+            xml.elemento("sum1:IDEmisorFactura", nif)
+            xml.elemento("sum1:NumSerieFactura", serie_anterior)
+            xml.elemento("sum1:FechaExpedicionFactura", fecha_anterior)
+            xml.elemento("sum1:Huella", huella_anterior)
+            xml.cerrar("sum1:RegistroAnterior")
+        else:
+            xml.elemento("sum1:PrimerRegistro", "S")
+        xml.cerrar("sum1:Encadenamiento")
+        xml.abrir("sum1:SistemaInformatico")
+        xml.elemento("sum1:NombreRazon", emisor["nombre"])
+        xml.elemento("sum1:NIF", emisor["nif"])
+        xml.elemento("sum1:NombreSistemaInformatico", "FactuFerreteria")
+        xml.elemento("sum1:IdSistemaInformatico", "01")
+        xml.elemento("sum1:Version", "2.0")
+        xml.elemento("sum1:NumeroInstalacion", nombre_caja())
+        xml.elemento("sum1:TipoUsoPosibleSoloVerifactu", "N")
+        xml.elemento("sum1:TipoUsoPosibleMultiOT", "S")
+        xml.elemento("sum1:IndicadorMultiplesOT", "N")
+        xml.cerrar("sum1:SistemaInformatico")
+        xml.elemento("sum1:FechaHoraHusoGenRegistro", momento)
+        xml.elemento("sum1:TipoHuella", "01")
+        xml.elemento("sum1:Huella", huella)
+        xml.cerrar("sum1:RegistroAlta")
+        xml.cerrar("sum:RegistroFactura")
+    if xml:
+        xml.cerrar("sum:RegFactuSistemaFacturacion")
+        archivo.close()
+    conn.close()
+    return rutas
+
+
+# =================== FUNCIONES PARA FAMILIAS Y TARIFAS =================== #
+def añadir_familia(nombre):
+    """Crea una familia de productos (o devuelve la existente con ese nombre). Devuelve su ID."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR IGNORE INTO familias (nombre) VALUES (?)", (nombre,))
+    cursor.execute("SELECT id_familia FROM familias WHERE nombre=?", (nombre,))
+    id_familia = cursor.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return id_familia
+
+
+def obtener_familias():
+    """Obtiene las familias de productos con el número de productos de cada una."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT f.id_familia, f.nombre, COUNT(p.id) FROM familias f
+        LEFT JOIN productos p ON p.id_familia = f.id_familia
+        GROUP BY f.id_familia ORDER BY f.nombre
+    ''')
+    familias = cursor.fetchall()
+    conn.close()
+    return familias
+
+
+def asignar_familia(ids_productos, id_familia):
+    """Asigna varios productos a una familia en una sola transacción."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE productos SET id_familia=? WHERE id=?", [(id_familia, i) for i in ids_productos])
+    for id_producto in ids_productos:
+        recalcular_precios_efectivos(conn, id_producto=id_producto)
+    conn.commit()
+    conn.close()
+    bus_eventos.publicar(EVENTO_PRODUCTO, ids_productos)
+
+
+def añadir_tarifa(nombre, descuento=0):
+    """Crea una tarifa con un descuento general en porcentaje. Devuelve su ID."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO tarifas (nombre, descuento) VALUES (?, ?)", (nombre, descuento))
+    id_tarifa = cursor.lastrowid
+    recalcular_precios_efectivos(conn, id_tarifa=id_tarifa)
+    conn.commit()
+    conn.close()
+    return id_tarifa
+
+
+def obtener_tarifas():
+    """Obtiene todas las tarifas."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id_tarifa, nombre, descuento FROM tarifas ORDER BY nombre")
+    tarifas = cursor.fetchall()
+    conn.close()
+    return tarifas
+
+
+def eliminar_tarifa(id_tarifa):
+    """Elimina una tarifa y desasigna a sus clientes."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM tarifas WHERE id_tarifa=?", (id_tarifa,))
+    cursor.execute("DELETE FROM tarifa_familias WHERE id_tarifa=?", (id_tarifa,))
+    cursor.execute("DELETE FROM tarifa_precios WHERE id_tarifa=?", (id_tarifa,))
+    cursor.execute("DELETE FROM precios_efectivos WHERE id_tarifa=?", (id_tarifa,))
+    cursor.execute("UPDATE clientes SET id_tarifa=NULL WHERE id_tarifa=?", (id_tarifa,))
+    conn.commit()
+    conn.close()
+
+
+def descuento_familia_tarifa(id_tarifa, id_familia, descuento):
+    """Fija el descuento de una familia dentro de una tarifa (None lo quita)."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    if descuento is None:
+        cursor.execute("DELETE FROM tarifa_familias WHERE id_tarifa=? AND id_familia=?", (id_tarifa, id_familia))
+    else:
+        cursor.execute("INSERT OR REPLACE INTO tarifa_familias (id_tarifa, id_familia, descuento) VALUES (?, ?, ?)",
+                       (id_tarifa, id_familia, descuento))
+    recalcular_precios_efectivos(conn, id_tarifa=id_tarifa)
+    conn.commit()
+    conn.close()
+
+
+def precio_fijo_tarifa(id_tarifa, id_producto, precio):
+    """Fija el precio de un producto dentro de una tarifa (None lo quita)."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    if precio is None:
+        cursor.execute("DELETE FROM tarifa_precios WHERE id_tarifa=? AND id_producto=?", (id_tarifa, id_producto))
+    else:
+        cursor.execute("INSERT OR REPLACE INTO tarifa_precios (id_tarifa, id_producto, precio) VALUES (?, ?, ?)",
+                       (id_tarifa, id_producto, precio))
+    recalcular_precios_efectivos(conn, id_tarifa=id_tarifa, id_producto=id_producto)
+    conn.commit()
+    conn.close()
+
+
+def asignar_tarifa_cliente(id_cliente, id_tarifa, descuento=0):
+    """Asigna a un cliente una tarifa (o ninguna) y un descuento propio en porcentaje."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE clientes SET id_tarifa=?, descuento=? WHERE id_cliente=?", (id_tarifa, descuento, id_cliente))
+    conn.commit()
+    conn.close()
+    bus_eventos.publicar(EVENTO_CLIENTE, [id_cliente])
+
+
+def recalcular_precios_efectivos(conn, id_tarifa=None, id_producto=None):
+    """Recalcula con una sola sentencia la tabla de precios efectivos (toda, de una tarifa o de un producto).
+
+    Prioridad: precio fijo de la tarifa, después descuento de la familia en la tarifa y por último
+    el descuento general de la tarifa. No hace commit: se llama dentro de la transacción que cambia los precios.
+    """
+    condiciones = []
+    params = []
+    if id_tarifa is not None:
+        condiciones.append("id_tarifa = ?")
+        params.append(id_tarifa)
+    if id_producto is not None:
+        condiciones.append("id_producto = ?")
+        params.append(id_producto)
+    where = " AND ".join(condiciones) or "1=1"
+
+    cursor = conn.cursor()
+    cursor.execute(f"DELETE FROM precios_efectivos WHERE {where}", params)
+    where = where.replace("id_tarifa", "t.id_tarifa").replace("id_producto", "p.id")
+    cursor.execute(f'''
+        INSERT INTO precios_efectivos (id_tarifa, id_producto, precio)
+        SELECT t.id_tarifa, p.id,
+               ROUND(COALESCE(tp.precio, p.precio * (1 - COALESCE(tf.descuento, t.descuento) / 100.0)), 2)
+        FROM tarifas t
+        CROSS JOIN productos p
+        LEFT JOIN tarifa_precios tp ON tp.id_tarifa = t.id_tarifa AND tp.id_producto = p.id
+        LEFT JOIN tarifa_familias tf ON tf.id_tarifa = t.id_tarifa AND tf.id_familia = p.id_familia
+        WHERE {where}
+    ''', params)
+
+
+def aplicar_reglas_precio(reglas, redondeo=2):
+    """Aplica reglas de subida o bajada de precios en una sola transacción.
+
+    Cada regla es (id_familia, porcentaje); id_familia None afecta a todos los productos.
+    Cada regla es un único UPDATE sobre el conjunto de productos afectados. Devuelve los productos cambiados.
+    """
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cambiados = 0
+    ids_cambiados = set()
+    try:
+        for id_familia, porcentaje in reglas:
+            where, filtro = ("WHERE id_familia = ?", [id_familia]) if id_familia is not None else ("", [])
+            if bus_eventos.escuchando(EVENTO_PRODUCTO):
+                cursor.execute(f"SELECT id FROM productos {where}", filtro)
+                ids_cambiados.update(fila[0] for fila in cursor.fetchall())
+            cursor.execute(f"UPDATE productos SET precio = ROUND(precio * (1 + ? / 100.0), ?) {where}",
+                           [porcentaje, redondeo] + filtro)
+            cambiados += cursor.rowcount
+        recalcular_precios_efectivos(conn)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bus_eventos.publicar(EVENTO_PRODUCTO, ids_cambiados)
+    return cambiados
+
+
+def precio_para_cliente(id_producto, id_cliente=None):
+    """Precio de venta de un producto para un cliente: una sola consulta sobre la tabla precalculada.
+
+    Lanza ValueError si el producto ya no existe (por ejemplo, dado de baja desde otra caja o tienda).
+    """
+    conn = conectar_db()
+    cursor = conn.cursor()
+    if id_cliente is None:
+        cursor.execute("SELECT precio FROM productos WHERE id=?", (id_producto,))
+        fila = cursor.fetchone()
+        conn.close()
+        if fila is None:
+            raise ValueError(f"El producto {id_producto} ya no existe: se ha dado de baja.")
+        return fila[0]
+    cursor.execute('''
+        SELECT ROUND(COALESCE(pe.precio, p.precio) * (1 - c.descuento / 100.0), 2)
+        FROM clientes c
+        JOIN productos p ON p.id = ?
+        LEFT JOIN precios_efectivos pe ON pe.id_tarifa = c.id_tarifa AND pe.id_producto = p.id
+        WHERE c.id_cliente = ?
+    ''', (id_producto, id_cliente))
+    fila = cursor.fetchone()
+    conn.close()
+    return fila[0] if fila else precio_para_cliente(id_producto)
+
+
+# =================== IMPRESIÓN DE TICKETS =================== #
+ANCHO_TICKET = 42  # Caracteres por línea en papel de 80 mm con fuente A
+MAX_INTENTOS_IMPRESION = 5
+ESC = b"\x1b"
+GS = b"\x1d"
+
+
+def texto_escpos(texto):
+    """Codifica texto para la impresora térmica (página de códigos 858, con símbolo €)."""
+    return texto.encode("cp858", errors="replace")
+
+
+def linea_ticket(izquierda, derecha, ancho=ANCHO_TICKET):
+    """Compone una línea con texto a la izquierda y a la derecha, recortando la parte izquierda si no cabe.
+
+    La parte derecha se recorta a ancho - 2 caracteres, para que siempre quede el espacio y una columna a la izquierda.
+    """
+    derecha = derecha[:ancho - 2]
+    hueco = ancho - len(derecha) - 1
+    return f"{izquierda[:hueco]:<{hueco}} {derecha}\n"
+
+
+def renderizar_ticket_escpos(id_ticket, fecha, productos, ancho=ANCHO_TICKET):
+    """Genera los bytes ESC/POS de un ticket listos para enviar a una impresora térmica."""
+    datos = bytearray()
+    datos += ESC + b"@"                # Inicializar impresora
+    datos += ESC + b"t\x13"            # Página de códigos 858
+    datos += ESC + b"a\x01"            # Centrado
+    datos += ESC + b"E\x01" + GS + b"!\x11"
+    tienda = ajustes()
+    datos += texto_escpos(f"{tienda['nombre']}\n")
+    datos += GS + b"!\x00" + ESC + b"E\x00"
+    datos += texto_escpos(f"{tienda['direccion']}, {tienda['codigo_postal']} {tienda['poblacion']}\n")
+    datos += texto_escpos(f"Teléfono: {tienda['telefono']}\n\n")
+    datos += ESC + b"a\x00"            # Alineado a la izquierda
+    datos += texto_escpos(linea_ticket(f"Ticket: {numero_documento('ticket', id_ticket)}", fecha, ancho))
+    datos += texto_escpos("-" * ancho + "\n")
+
+    total_con_iva = 0
+    for descripcion, cantidad, precio, total in productos:
+        datos += texto_escpos(f"{descripcion[:ancho]}\n")
+        datos += texto_escpos(linea_ticket(f"  {cantidad} x {precio:.2f} €", f"{total:.2f} €", ancho))
+        total_con_iva += total
+
+    datos += texto_escpos("-" * ancho + "\n")
+    datos += ESC + b"E\x01" + GS + b"!\x01"
+    datos += texto_escpos(linea_ticket("TOTAL:", f"{total_con_iva:.2f} €", ancho))
+    datos += GS + b"!\x00" + ESC + b"E\x00"
+    datos += ESC + b"a\x01"
+    datos += texto_escpos(f"\n{tienda['pie_ticket']}\n")
+    datos += ESC + b"d\x04"            # Avanzar 4 líneas
+    datos += GS + b"V\x42\x00"         # Corte parcial
+    return bytes(datos)
+
+
+def renderizar_ticket_pdf(id_ticket, fecha, productos):
+    """Genera el ticket en PDF (para guardarlo como archivo) y devuelve sus bytes."""
+    ticket_width = 3 * inch
+    ticket_height = 1.5 * inch + (len(productos) * 0.3 * inch) + 2 * inch  # Ajustar altura dinámica
+
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=(ticket_width, ticket_height))
+    tienda = ajustes()
+
+    # Encabezado del ticket con los datos de la tienda
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(10, ticket_height - 20, tienda["nombre"])
+    c.setFont("Helvetica", 10)
+    c.drawString(10, ticket_height - 40, f"{tienda['direccion']}, {tienda['codigo_postal']} {tienda['poblacion']}")
+    c.drawString(10, ticket_height - 60, f"Teléfono: {tienda['telefono']}")
+
+    # Fecha
+    c.setFont("Helvetica-Bold", 10)
+    c.drawString(10, ticket_height - 100, f"Fecha: {fecha}")
+
+    # Encabezado de productos
+    c.setFont("Helvetica-Bold", 10)
+    c.drawString(10, ticket_height - 130, "Producto")
+    c.drawString(120, ticket_height - 130, "Cant.")
+    c.drawString(170, ticket_height - 130, "Precio")
+    c.drawString(220, ticket_height - 130, "Total")
+
+    # Detalle de productos y acumulación del total
+    y_position = ticket_height - 150
+    total_con_iva = 0
+
+    for item in productos:
+        c.setFont("Helvetica", 10)
+        c.drawString(10, y_position, item[0])
+        c.drawString(120, y_position, str(item[1]))
+        c.drawString(170, y_position, f"{item[2]:.2f} €")
+        c.drawString(220, y_position, f"{item[3]:.2f} €")
+        total_con_iva += item[3]  # Acumula el total aquí
+        y_position -= 20
+
+    # Mostrar el total final
+    c.setFont("Helvetica-Bold", 10)
+    c.drawString(10, y_position - 20, "TOTAL: " + f"{total_con_iva:.2f} €")
+
+    # Mensaje de agradecimiento
+    c.setFont("Helvetica", 8)
+    c.drawCentredString(ticket_width / 2, y_position - 50, tienda["pie_ticket"])
+
+    c.save()
+    return buffer.getvalue()
+
+
+class DestinoArchivo:
+    """Guarda cada documento como un archivo en un directorio."""
+
+    def __init__(self, parametro):
+        self.directorio = parametro or ruta_salida_documentos()
+
+    def enviar(self, documento, formato, datos):
+        extension = "pdf" if formato == "pdf" else "bin"
+        ruta = os.path.join(self.directorio, f"{documento}.{extension}")
+        with open(ruta, "wb") as f:
+            f.write(datos)
+        return ruta
+
+
+class DestinoDispositivo:
+    """Escribe los bytes directamente en un dispositivo de impresora (/dev/usb/lp0, LPT1, ...)."""
+
+    def __init__(self, parametro):
+        self.ruta = parametro
+
+    def enviar(self, documento, formato, datos):
+        with open(self.ruta, "wb", buffering=0) as f:
+            f.write(datos)
+        return self.ruta
+
+
+class DestinoTCP:
+    """Envía los bytes a una impresora de red (puerto RAW, normalmente 9100)."""
+
+    def __init__(self, parametro, timeout=5):
+        host, _, puerto = parametro.rpartition(":")
+        self.host = host or "127.0.0.1"
+        self.puerto = int(puerto or 9100)
+        self.timeout = timeout
+
+    def enviar(self, documento, formato, datos):
+        with socket.create_connection((self.host, self.puerto), timeout=self.timeout) as conexion:
+            conexion.sendall(datos)
+        return f"{self.host}:{self.puerto}"
+
+
+class ImpresoraFalsa:
+    """Impresora en memoria para pruebas. Puede simular un número de fallos antes de imprimir."""
+
+    def __init__(self, parametro=""):
+        self.nombre = parametro
+        self.trabajos = []
+        self.fallos_pendientes = 0
+
+    def enviar(self, documento, formato, datos):
+        if self.fallos_pendientes > 0:
+            self.fallos_pendientes -= 1
+            raise OSError("Fallo simulado de la impresora falsa")
+        self.trabajos.append((documento, formato, datos))
+        return f"falsa:{self.nombre}"
+
+
+# Tipos de destino disponibles: "archivo:<dir>", "dispositivo:<ruta>", "tcp:<host>:<puerto>", "falsa:<nombre>"
+TIPOS_DESTINO = {
+    "archivo": DestinoArchivo,
+    "dispositivo": DestinoDispositivo,
+    "tcp": DestinoTCP,
+}
+IMPRESORAS_FALSAS = {}
+
+
+def registrar_tipo_destino(tipo, clase):
+    """Registra un nuevo tipo de destino de impresión. La clase recibe el parámetro y expone enviar(documento, formato, datos)."""
+    TIPOS_DESTINO[tipo] = clase
+
+
+def obtener_impresora_falsa(nombre=""):
+    """Devuelve (creándola si hace falta) la impresora falsa con ese nombre."""
+    if nombre not in IMPRESORAS_FALSAS:
+        IMPRESORAS_FALSAS[nombre] = ImpresoraFalsa(nombre)
+    return IMPRESORAS_FALSAS[nombre]
+
+
+def abrir_destino(destino):
+    """Crea el objeto de salida para un destino con formato 'tipo:parametro'."""
+    tipo, _, parametro = destino.partition(":")
+    if tipo == "falsa":
+        return obtener_impresora_falsa(parametro)
+    if tipo not in TIPOS_DESTINO:
+        raise ValueError(f"Destino de impresión desconocido: {destino}")
+    return TIPOS_DESTINO[tipo](parametro)
+
+
+def destino_impresora_tickets():
+    """Destino configurado para los tickets (ajuste impresora_tickets o variable FERRETERIA_IMPRESORA)."""
+    return ajuste("impresora_tickets")
+
+
+def formato_para_destino(destino):
+    """Los destinos de archivo reciben PDF; las impresoras reciben ESC/POS."""
+    return "pdf" if destino.startswith("archivo:") else "escpos"
+
+
+evento_impresion = threading.Event()
+hilo_impresion = None
+
+
+def encolar_impresion(documento, formato, datos, destino, plantilla=None):
+    """Guarda un trabajo de esta caja en la cola persistente de impresión y despierta al hilo de impresión. Devuelve su ID.
+
+    Con plantilla, datos son los argumentos (JSON) de su renderizador en PLANTILLAS_IMPRESION, y el
+    documento se renderiza en el hilo de impresión en vez de en quien lo encola.
+    """
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO cola_impresion (documento, formato, destino, datos, creado, plantilla, caja) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (documento, formato, destino, datos, datetime.now().strftime(FORMATO_FECHA), plantilla, nombre_caja()))
+    id_trabajo = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    evento_impresion.set()
+    return id_trabajo
+
+
+# Renderizadores por (plantilla, formato) de los trabajos que se encolan sin renderizar
+PLANTILLAS_IMPRESION = {
+    ("ticket", "pdf"): renderizar_ticket_pdf,
+    ("ticket", "escpos"): renderizar_ticket_escpos,
+}
+
+
+def imprimir_ticket(id_ticket, fecha, productos, destino=None):
+    """Manda un ticket a la cola; el hilo de impresión lo renderiza en el formato de su destino. Devuelve el ID del trabajo.
+
+    Aquí solo se guardan los datos, así que la ventana no espera a que se genere el PDF o el ESC/POS.
+    """
+    destino = destino or destino_impresora_tickets()
+    datos = json.dumps({"id_ticket": id_ticket, "fecha": fecha, "productos": [list(p) for p in productos]},
+                       ensure_ascii=False).encode("utf-8")
+    return encolar_impresion(f"ticket_{id_ticket}", formato_para_destino(destino), datos, destino, plantilla="ticket")
+
+
+def procesar_cola_impresion():
+    """Envía los trabajos pendientes de esta caja cuyo reintento ya ha vencido. Devuelve cuántos se han procesado.
+
+    Cada trabajo se reclama pasándolo a 'imprimiendo' solo si sigue pendiente, así que no se
+    imprime dos veces aunque otro proceso de la misma caja esté leyendo la cola a la vez.
+    Los trabajos con plantilla se renderizan antes de enviarlos y se guardan ya renderizados, de
+    modo que un reintento imprime exactamente lo mismo.
+    """
+    conn = conectar_db()
+    cursor = conn.cursor()
+    procesados = 0
+    try:
+        cursor.execute('''
+            SELECT id, documento, formato, destino, datos, intentos, plantilla FROM cola_impresion
+            WHERE caja=? AND estado='pendiente' AND proximo_intento <= ? ORDER BY id
+        ''', (nombre_caja(), time.time()))
+        trabajos = cursor.fetchall()
+
+        for id_trabajo, documento, formato, destino, datos, intentos, plantilla in trabajos:
+            cursor.execute("UPDATE cola_impresion SET estado='imprimiendo' WHERE id=? AND estado='pendiente'", (id_trabajo,))
+            reclamado = cursor.rowcount == 1
+            conn.commit()
+            if not reclamado:
+                continue  # Ya lo ha reclamado otro
+            procesados += 1
+            ahora = datetime.now().strftime(FORMATO_FECHA)
+            try:
+                if plantilla:
+                    datos = PLANTILLAS_IMPRESION[(plantilla, formato)](**json.loads(datos))
+                    cursor.execute("UPDATE cola_impresion SET datos=?, plantilla=NULL WHERE id=?", (datos, id_trabajo))
+                abrir_destino(destino).enviar(documento, formato, datos)
+            except Exception as e:
+                intentos += 1
+                estado = "error" if intentos >= MAX_INTENTOS_IMPRESION else "pendiente"
+                espera = 2 ** intentos  # Espera exponencial entre reintentos
+                cursor.execute('''
+                    UPDATE cola_impresion SET estado=?, intentos=?, error=?, proximo_intento=?, actualizado=? WHERE id=?
+                ''', (estado, intentos, str(e), time.time() + espera, ahora, id_trabajo))
+            else:
+                cursor.execute('''
+                    UPDATE cola_impresion SET estado='impreso', intentos=?, error=NULL, actualizado=? WHERE id=?
+                ''', (intentos + 1, ahora, id_trabajo))
+            conn.commit()
+    finally:
+        conn.close()
+    return procesados
+
+
+def segundos_hasta_proximo_trabajo():
+    """Segundos hasta el próximo reintento pendiente de esta caja, o None si no tiene nada en cola."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(proximo_intento) FROM cola_impresion WHERE caja=? AND estado='pendiente'", (nombre_caja(),))
+    proximo = cursor.fetchone()[0]
+    conn.close()
+    if proximo is None:
+        return None
+    return max(0.0, proximo - time.time())
+
+
+def bucle_impresion():
+    """Bucle del hilo de impresión: procesa la cola y espera a nuevos trabajos o al próximo reintento."""
+    while True:
+        evento_impresion.clear()
+        try:
+            procesar_cola_impresion()
+            espera = segundos_hasta_proximo_trabajo()
+        except sqlite3.Error:
+            espera = 1.0  # Base de datos ocupada; se reintenta en breve
+        evento_impresion.wait(timeout=espera)
+
+
+def iniciar_hilo_impresion():
+    """Arranca (una sola vez) el hilo de impresión en segundo plano, recuperando los trabajos interrumpidos de esta caja.
+
+    Los de otras cajas pueden estar imprimiéndose ahora mismo: se recuperan cuando arranque la suya.
+    """
+    global hilo_impresion
+    if hilo_impresion is not None and hilo_impresion.is_alive():
+        return hilo_impresion
+    conn = conectar_db()
+    conn.execute("UPDATE cola_impresion SET estado='pendiente' WHERE caja=? AND estado='imprimiendo'", (nombre_caja(),))
+    conn.commit()
+    conn.close()
+    hilo_impresion = threading.Thread(target=bucle_impresion, name="impresion", daemon=True)
+    hilo_impresion.start()
+    return hilo_impresion
+
+
+def estado_trabajo_impresion(id_trabajo):
+    """Devuelve (estado, intentos, error) de un trabajo de impresión."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT estado, intentos, error FROM cola_impresion WHERE id=?", (id_trabajo,))
+    fila = cursor.fetchone()
+    conn.close()
+    return fila
+
+
+def obtener_cola_impresion(limite=200):
+    """Obtiene los últimos trabajos de impresión de esta caja (solo ella puede imprimirlos o reintentarlos)."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, documento, formato, destino, estado, intentos, error, creado FROM cola_impresion
+        WHERE caja=? ORDER BY id DESC LIMIT ?
+    ''', (nombre_caja(), limite))
+    trabajos = cursor.fetchall()
+    conn.close()
+    return trabajos
+
+
+def reintentar_impresion(id_trabajo):
+    """Vuelve a poner en cola un trabajo fallido."""
+    conn = conectar_db()
+    conn.execute('''
+        UPDATE cola_impresion SET estado='pendiente', intentos=0, proximo_intento=0 WHERE id=? AND estado='error'
+    ''', (id_trabajo,))
+    conn.commit()
+    conn.close()
+    evento_impresion.set()
+
+
+# =================== ARCHIVO HISTÓRICO POR EJERCICIOS =================== #
+# Formato de archivo columnar: cabecera mágica, longitud y JSON de cabecera, y después
+# cada columna comprimida por separado con zlib. Los números se guardan como arrays
+# binarios y los textos con diccionario (valores distintos + códigos enteros), así que
+# una consulta solo descomprime las columnas que necesita.
+MAGIA_ARCHIVO = b"FHAR1\n"
+COLUMNAS_ARCHIVO = (
+    ("id", "q"), ("id_factura", "q"), ("tipo", "s"), ("producto", "s"),
+    ("cantidad", "q"), ("precio", "d"), ("total", "d"), ("fecha", "s"), ("dia", "q"),
+)
+cache_archivo = {}
+
+
+def ruta_archivo_historico():
+    """Directorio donde se guardan los ejercicios archivados, junto a la base de datos."""
+    return os.path.join(directorio_datos(), "ferreteria_archivo")
+
+
+def ruta_ejercicio_archivado(año):
+    """Ruta del archivo columnar de un ejercicio."""
+    return os.path.join(ruta_archivo_historico(), f"historial_{año}.fhar")
+
+
+def escribir_archivo_columnar(ruta, columnas):
+    """Escribe un dict {nombre: lista de valores} con los tipos de COLUMNAS_ARCHIVO en un archivo columnar."""
+    filas = len(columnas["id"])
+    bloques = []
+    cabecera = {"filas": filas, "orden": sys.byteorder, "columnas": []}
+    posicion = 0
+
+    def añadir_bloque(datos):
+        nonlocal posicion
+        comprimido = zlib.compress(datos, 6)
+        bloques.append(comprimido)
+        inicio = posicion
+        posicion += len(comprimido)
+        return [inicio, len(comprimido)]
+
+    for nombre, tipo in COLUMNAS_ARCHIVO:
+        valores = columnas[nombre]
+        info = {"nombre": nombre, "tipo": tipo}
+        if tipo == "s":
+            diccionario = {}
+            codigos = array("I", (diccionario.setdefault(v, len(diccionario)) for v in valores))
+            info["diccionario"] = añadir_bloque(json.dumps(list(diccionario), ensure_ascii=False).encode("utf-8"))
+            info["datos"] = añadir_bloque(codigos.tobytes())
+        else:
+            nulos = [i for i, v in enumerate(valores) if v is None]
+            info["nulos"] = nulos
+            datos = array(tipo, (0 if v is None else v for v in valores))
+            info["datos"] = añadir_bloque(datos.tobytes())
+        cabecera["columnas"].append(info)
+
+    cabecera_bytes = json.dumps(cabecera).encode("utf-8")
+    temporal = ruta + ".tmp"
+    with open(temporal, "wb") as f:
+        f.write(MAGIA_ARCHIVO)
+        f.write(struct.pack("<I", len(cabecera_bytes)))
+        f.write(cabecera_bytes)
+        for bloque in bloques:
+            f.write(bloque)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+
+
+def leer_archivo_columnar(ruta, nombres=None):
+    """Lee las columnas pedidas (todas por defecto) de un archivo columnar. Usa caché mientras el archivo no cambie."""
+    clave = (ruta, os.path.getmtime(ruta))
+    columnas_cache = cache_archivo.setdefault(clave, {})
+    for otra in [c for c in cache_archivo if c[0] == ruta and c != clave]:
+        del cache_archivo[otra]
+    nombres = nombres or [nombre for nombre, _ in COLUMNAS_ARCHIVO]
+    faltan = [n for n in nombres if n not in columnas_cache]
+
+    if faltan:
+        with open(ruta, "rb") as f:
+            if f.read(len(MAGIA_ARCHIVO)) != MAGIA_ARCHIVO:
+                raise ValueError(f"No es un archivo de historial: {ruta}")
+            longitud = struct.unpack("<I", f.read(4))[0]
+            cabecera = json.loads(f.read(longitud))
+            base = len(MAGIA_ARCHIVO) + 4 + longitud
+
+            def leer_bloque(bloque):
+                f.seek(base + bloque[0])
+                return zlib.decompress(f.read(bloque[1]))
+
+            for info in cabecera["columnas"]:
+                if info["nombre"] not in faltan:
+                    continue
+                if info["tipo"] == "s":
+                    diccionario = json.loads(leer_bloque(info["diccionario"]))
+                    codigos = array("I")
+                    codigos.frombytes(leer_bloque(info["datos"]))
+                    if cabecera["orden"] != sys.byteorder:
+                        codigos.byteswap()
+                    columnas_cache[info["nombre"]] = (diccionario, codigos)
+                else:
+                    datos = array(info["tipo"])
+                    datos.frombytes(leer_bloque(info["datos"]))
+                    if cabecera["orden"] != sys.byteorder:
+                        datos.byteswap()
+                    valores = datos.tolist()
+                    for i in info["nulos"]:
+                        valores[i] = None
+                    columnas_cache[info["nombre"]] = valores
+    return {n: columnas_cache[n] for n in nombres}
+
+
+def valores_columna(columna):
+    """Expande una columna leída del archivo a lista de valores (decodificando el diccionario si es de texto)."""
+    if isinstance(columna, tuple):
+        diccionario, codigos = columna
+        return [diccionario[c] for c in codigos]
+    return columna
+
+
+def ejercicios_archivados():
+    """Lista los años que tienen archivo columnar."""
+    directorio = ruta_archivo_historico()
+    if not os.path.isdir(directorio):
+        return []
+    años = []
+    for nombre in os.listdir(directorio):
+        if nombre.startswith("historial_") and nombre.endswith(".fhar"):
+            try:
+                años.append(int(nombre[len("historial_"):-len(".fhar")]))
+            except ValueError:
+                continue
+    return sorted(años)
+
+
+def ejercicios_en_rango(desde=None, hasta=None):
+    """Ejercicios archivados que se solapan con el rango de fechas indicado."""
+    def año_de(valor):
+        if isinstance(valor, date):
+            return valor.year
+        fecha = interpretar_fecha(valor) if valor else None
+        return fecha.year if fecha else None
+
+    año_desde, año_hasta = año_de(desde), año_de(hasta)
+    return [a for a in ejercicios_archivados()
+            if (año_desde is None or a >= año_desde) and (año_hasta is None or a <= año_hasta)]
+
+
+def indices_en_rango(dias, desde=None, hasta=None):
+    """Posiciones de las filas cuyo día está dentro del rango."""
+    dia_desde = dia_desde_fecha(desde) if desde else None
+    dia_hasta = dia_desde_fecha(hasta) if hasta else None
+    if dia_desde is None and dia_hasta is None:
+        return range(len(dias))
+    return [i for i, d in enumerate(dias)
+            if (dia_desde is None or d >= dia_desde) and (dia_hasta is None or d <= dia_hasta)]
+
+
+def historial_archivado(desde=None, hasta=None):
+    """Devuelve las filas archivadas con el mismo formato que obtener_historial."""
+    nombres = ["id_factura", "tipo", "producto", "cantidad", "precio", "total", "fecha"]
+    filas = []
+    for año in ejercicios_en_rango(desde, hasta):
+        columnas = leer_archivo_columnar(ruta_ejercicio_archivado(año), nombres + ["dia"])
+        indices = indices_en_rango(columnas["dia"], desde, hasta)
+        valores = [valores_columna(columnas[n]) for n in nombres]
+        filas.extend(tuple(v[i] for v in valores) + (None,) for i in indices)
+    return filas
+
+
+def ids_factura_archivados(producto, desde=None, hasta=None):
+    """IDs de factura archivados con alguna línea cuyo producto contiene el texto (sin distinguir mayúsculas)."""
+    producto = producto.lower()
+    ids = set()
+    for año in ejercicios_en_rango(desde, hasta):
+        columnas = leer_archivo_columnar(ruta_ejercicio_archivado(año), ["id_factura", "producto"])
+        diccionario, codigos = columnas["producto"]
+        # El filtro se evalúa una vez por producto distinto, no por fila
+        coinciden = {i for i, nombre in enumerate(diccionario) if nombre and producto in nombre.lower()}
+        if not coinciden:
+            continue
+        id_facturas = columnas["id_factura"]
+        ids.update(id_facturas[i] for i, c in enumerate(codigos) if c in coinciden)
+    return ids
+
+
+def ejercicios_archivables():
+    """Años cerrados (anteriores al actual) que aún tienen filas en el historial."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT CAST(substr(fecha, 1, 4) AS INTEGER) FROM historial WHERE dia < ?",
+                   (dia_desde_fecha(date(date.today().year, 1, 1)),))
+    años = sorted(fila[0] for fila in cursor.fetchall() if fila[0])
+    conn.close()
+    return años
+
+
+def archivar_ejercicio(año, compactar=True):
+    """Mueve las filas de historial de un ejercicio cerrado a su archivo columnar. Devuelve cuántas filas se movieron."""
+    if año >= date.today().year:
+        raise ValueError("Solo se pueden archivar ejercicios cerrados.")
+    dia_inicio = dia_desde_fecha(date(año, 1, 1))
+    dia_fin = dia_desde_fecha(date(año, 12, 31))
+    nombres = [nombre for nombre, _ in COLUMNAS_ARCHIVO]
+
+    conn = conectar_db()
+    cursor = conn.cursor()
+    try:
+        # La transacción impide que entren líneas del ejercicio entre la lectura y el borrado
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(f"SELECT {', '.join(nombres)} FROM historial WHERE dia BETWEEN ? AND ? ORDER BY id",
+                       (dia_inicio, dia_fin))
+        filas = cursor.fetchall()
+        if not filas:
+            conn.rollback()
+            return 0
+
+        # Si el ejercicio ya tenía archivo (líneas añadidas después, o un archivado que no llegó a
+        # borrar del historial) se fusionan por id: una línea que ya estaba no se duplica
+        por_id = {}
+        ruta = ruta_ejercicio_archivado(año)
+        if os.path.exists(ruta):
+            existentes = [valores_columna(columna) for columna in leer_archivo_columnar(ruta, nombres).values()]
+            for fila in zip(*existentes):
+                por_id[fila[0]] = fila
+        for fila in filas:
+            por_id[fila[0]] = fila
+        columnas = {n: [] for n in nombres}
+        for id_linea in sorted(por_id):
+            for n, valor in zip(nombres, por_id[id_linea]):
+                columnas[n].append(valor)
+
+        os.makedirs(ruta_archivo_historico(), exist_ok=True)
+        escribir_archivo_columnar(ruta, columnas)
+
+        # Solo se borra del historial cuando el archivo está escrito y sincronizado en disco
+        cursor.execute("DELETE FROM historial WHERE dia BETWEEN ? AND ?", (dia_inicio, dia_fin))
+        conn.commit()
+        if compactar:
+            conn.execute("VACUUM")
+    except (sqlite3.Error, OSError):
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return len(filas)
+
+
+# =================== SINCRONIZACIÓN ENTRE TIENDAS =================== #
+# Tablas y campos que se replican. Los IDs son locales de cada tienda: la fila se identifica por su uid, que se
+# asigna al darla de alta y viaja con ella (el código de barras o el NIF son campos más y pueden repetirse)
+CAMPOS_SINCRONIZADOS = {
+    "productos": ("uid", ("codigo", "nombre", "descripcion", "precio", "coste")),
+    "clientes": ("uid", ("identificacion_fiscal", "nombre_fiscal", "nombre_comercial", "direccion", "codigo_postal",
+                         "poblacion", "provincia", "pais", "telefono")),
+}
+# Fila mínima que se crea al recibir el alta de otra tienda; sus campos llegan después en el mismo conjunto
+FILA_NUEVA_SINCRONIZADA = {
+    "productos": "INSERT INTO productos (uid, codigo, nombre, precio) VALUES (?, '', '', 0)",
+    "clientes": "INSERT INTO clientes (uid, identificacion_fiscal, nombre_fiscal) VALUES (?, '', '')",
+}
+CAMPO_STOCK = "cantidad"      # El stock viaja como incremento y se suma; no se resuelve por último escritor
+CAMPO_BORRADO = "_borrado"    # Baja de la fila
+CAMPO_LINEA = "_linea"        # Línea de venta del historial (se guarda aparte, en historial_tiendas)
+TODAS_LAS_TIENDAS = "*"       # Filtro de historial y análisis: esta tienda y las ventas llegadas de las demás
+MARCA_AHORA = "((julianday('now') - 2440587.5) * 86400.0)"  # Segundos Unix con milisegundos
+SIN_APLICAR = "NOT EXISTS (SELECT 1 FROM sincronizacion_aplicando)"
+FORMATO_CAMBIOS = 2  # 2: filas identificadas por uid (el 1 usaba la clave natural)
+PUERTO_SINCRONIZACION = 8765
+TAMAÑO_SALUDO = 64 * 1024                 # Máximo de un mensaje antes de comprobar la clave
+TAMAÑO_MAXIMO_MENSAJE = 256 * 1024 * 1024  # Máximo de un conjunto de cambios, comprimido y descomprimido
+
+
+def crear_disparadores_cambios(cursor):
+    """Crea los disparadores que anotan en la tabla cambios cada cambio local de catálogo, clientes y ventas.
+
+    Mientras se aplican cambios de otra tienda hay una fila en sincronizacion_aplicando y los
+    disparadores no anotan nada, para que esos cambios no vuelvan a enviarse.
+    """
+    for tabla, (clave, campos) in CAMPOS_SINCRONIZADOS.items():
+        # El alta puede ejecutarse antes que uid_{tabla}: asigna el uid si aún falta y lo lee de la fila
+        uid = f"(SELECT {clave} FROM {tabla} WHERE rowid = NEW.rowid)"
+        alta = [f"('{tabla}', {uid}, '{campo}', NEW.{campo}, {MARCA_AHORA})" for campo in campos]
+        if tabla == "productos":
+            alta.append(f"('{tabla}', {uid}, '{CAMPO_STOCK}', COALESCE(NEW.{CAMPO_STOCK}, 0), {MARCA_AHORA})")
+        alta = ", ".join(alta)
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS cambios_{tabla}_alta AFTER INSERT ON {tabla} WHEN {SIN_APLICAR}
+            BEGIN UPDATE {tabla} SET {clave} = COALESCE({clave}, lower(hex(randomblob(16)))) WHERE rowid = NEW.rowid;
+                  INSERT INTO cambios (tabla, clave, campo, valor, marca) VALUES {alta}; END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS cambios_{tabla}_baja AFTER DELETE ON {tabla} WHEN {SIN_APLICAR}
+            BEGIN INSERT INTO cambios (tabla, clave, campo, valor, marca)
+                  VALUES ('{tabla}', OLD.{clave}, '{CAMPO_BORRADO}', NULL, {MARCA_AHORA}); END
+        ''')
+        for campo in campos:
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS cambios_{tabla}_{campo} AFTER UPDATE OF {campo} ON {tabla}
+                WHEN OLD.{campo} IS NOT NEW.{campo} AND {SIN_APLICAR}
+                BEGIN INSERT INTO cambios (tabla, clave, campo, valor, marca)
+                      VALUES ('{tabla}', NEW.{clave}, '{campo}', NEW.{campo}, {MARCA_AHORA}); END
+            ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cambios_productos_{CAMPO_STOCK} AFTER UPDATE OF {CAMPO_STOCK} ON productos
+        WHEN OLD.{CAMPO_STOCK} IS NOT NEW.{CAMPO_STOCK} AND {SIN_APLICAR}
+        BEGIN INSERT INTO cambios (tabla, clave, campo, valor, marca)
+              VALUES ('productos', NEW.uid, '{CAMPO_STOCK}',
+                      COALESCE(NEW.{CAMPO_STOCK}, 0) - COALESCE(OLD.{CAMPO_STOCK}, 0), {MARCA_AHORA}); END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cambios_historial_alta AFTER INSERT ON historial WHEN {SIN_APLICAR}
+        BEGIN INSERT INTO cambios (tabla, clave, campo, valor, marca)
+              VALUES ('historial', NEW.id, '{CAMPO_LINEA}',
+                      json_array(NEW.id_factura, NEW.tipo, NEW.producto, NEW.cantidad, NEW.precio, NEW.total, NEW.fecha, NEW.dia),
+                      {MARCA_AHORA}); END
+    ''')
+
+
+def id_nodo_local(cursor):
+    """Identificador de esta tienda en la sincronización."""
+    cursor.execute("SELECT id_nodo FROM nodo_sincronizacion")
+    return cursor.fetchone()[0]
+
+
+def recibido_de(cursor, nodo):
+    """Última secuencia de la tienda 'nodo' que ya se ha aplicado aquí (0 si nunca se ha recibido nada)."""
+    cursor.execute("SELECT recibido FROM nodos_remotos WHERE id_nodo = ?", (nodo,))
+    fila = cursor.fetchone()
+    return fila[0] if fila else 0
+
+
+def conjunto_cambios(cursor, desde):
+    """Cambios propios con secuencia mayor que 'desde', listos para enviar."""
+    cursor.execute('''
+        SELECT seq, tabla, clave, campo, valor, marca FROM cambios
+        WHERE seq > ? AND nodo IS NULL ORDER BY seq
+    ''', (desde,))
+    cambios = [list(fila) for fila in cursor.fetchall()]
+    # Último cambio propio anterior al conjunto: quien lo reciba debe tenerlo ya, si no falta algún envío.
+    # Si se pide desde antes de lo podado, faltan los cambios borrados: quien lo reciba lo detecta
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios WHERE seq <= ? AND nodo IS NULL", (desde,))
+    previo = cursor.fetchone()[0]
+    cursor.execute("SELECT podado FROM nodo_sincronizacion")
+    podado = cursor.fetchone()[0]
+    if desde < podado:
+        previo = podado
+    return {"formato": FORMATO_CAMBIOS, "nodo": id_nodo_local(cursor), "desde": desde, "previo": previo,
+            "hasta": cambios[-1][0] if cambios else desde, "cambios": cambios}
+
+
+def comprimir_cambios(conjunto):
+    return gzip.compress(json.dumps(conjunto, separators=(",", ":")).encode("utf-8"))
+
+
+def descomprimir_cambios(datos):
+    conjunto = json.loads(gzip.decompress(datos))
+    if conjunto.get("formato") != FORMATO_CAMBIOS:
+        raise ValueError(f"Formato de cambios no admitido: {conjunto.get('formato')}")
+    return conjunto
+
+
+def hay_que_aplicar(cursor, tabla, clave, campo, marca, nodo, local):
+    """Decide si un cambio recibido se aplica.
+
+    La baja es definitiva (el uid no se vuelve a usar): gana a cualquier cambio de campo, aunque
+    sea posterior, y tras ella no se aplica nada más de esa fila; si no, una tienda tendría la fila
+    y la otra no. Entre cambios de campo gana el último escritor, comparando (marca, tienda).
+    """
+    cursor.execute("SELECT 1 FROM cambios WHERE tabla = ? AND clave = ? AND campo = ? LIMIT 1",
+                   (tabla, clave, CAMPO_BORRADO))
+    if cursor.fetchone() is not None:
+        return False
+    if campo == CAMPO_BORRADO:
+        return True
+    cursor.execute('''
+        SELECT marca, COALESCE(nodo, ?) FROM cambios WHERE tabla = ? AND clave = ? AND campo = ?
+        ORDER BY marca DESC, 2 DESC LIMIT 1
+    ''', (local, tabla, clave, campo))
+    fila = cursor.fetchone()
+    return fila is None or (marca, nodo) > tuple(fila)
+
+
+def aplicar_cambios(conjunto):
+    """Aplica en una transacción un conjunto de cambios de otra tienda. Devuelve (cambios nuevos, secuencia recibida).
+
+    Solo se aplican los cambios posteriores a la última secuencia recibida de esa tienda, así que
+    recibir dos veces el mismo conjunto no duplica nada. Los campos de catálogo y clientes se
+    resuelven por último escritor y las bajas ganan siempre (ver hay_que_aplicar); el stock se
+    suma; las ventas van a historial_tiendas.
+    """
+    nodo = conjunto["nodo"]
+    productos, clientes, bajas = set(), set(), {"productos": [], "clientes": []}
+    conn = conectar_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        local = id_nodo_local(cursor)
+        if nodo == local:
+            raise ValueError("Los cambios son de esta misma tienda.")
+        recibido = recibido_de(cursor, nodo)
+        if conjunto["previo"] > recibido:
+            raise error_faltan_cambios(nodo, recibido, conjunto["previo"])
+        nuevos = [cambio for cambio in conjunto["cambios"] if cambio[0] > recibido]
+        cursor.execute("INSERT INTO sincronizacion_aplicando VALUES (1)")
+
+        for seq, tabla, clave, campo, valor, marca in nuevos:
+            if tabla == "historial" and campo == CAMPO_LINEA:
+                cursor.execute("INSERT OR IGNORE INTO historial_tiendas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (nodo, int(clave), *json.loads(valor)))
+                continue
+            if tabla not in CAMPOS_SINCRONIZADOS:
+                continue
+            columna_clave, campos = CAMPOS_SINCRONIZADOS[tabla]
+            afectados = productos if tabla == "productos" else clientes
+            if tabla == "productos" and campo == CAMPO_STOCK:
+                # Solo si la fila existe: una venta en otra tienda no resucita un producto dado de baja aquí
+                cursor.execute("UPDATE productos SET cantidad = COALESCE(cantidad, 0) + ? WHERE uid = ?", (valor, clave))
+                afectados.add(clave)
+                continue
+            if campo != CAMPO_BORRADO and campo not in campos:
+                continue  # Campo de una versión más nueva del programa
+            if not hay_que_aplicar(cursor, tabla, clave, campo, marca, nodo, local):
+                continue
+            if campo == CAMPO_BORRADO:
+                id_columna = "id" if tabla == "productos" else "id_cliente"
+                cursor.execute(f"SELECT {id_columna} FROM {tabla} WHERE {columna_clave} = ?", (clave,))
+                bajas[tabla].extend(fila[0] for fila in cursor.fetchall())
+                cursor.execute(f"DELETE FROM {tabla} WHERE {columna_clave} = ?", (clave,))
+                afectados.discard(clave)
+            else:
+                cursor.execute(f"SELECT 1 FROM {tabla} WHERE {columna_clave} = ?", (clave,))
+                if cursor.fetchone() is None:
+                    # Alta en otra tienda (una fila dada de baja ya no llega aquí): se crea con su uid y se completa campo a campo
+                    cursor.execute(FILA_NUEVA_SINCRONIZADA[tabla], (clave,))
+                cursor.execute(f"UPDATE {tabla} SET {campo} = ? WHERE {columna_clave} = ?", (valor, clave))
+                afectados.add(clave)
+            cursor.execute("INSERT INTO cambios (tabla, clave, campo, valor, marca, nodo) VALUES (?, ?, ?, ?, ?, ?)",
+                           (tabla, clave, campo, valor, marca, nodo))
+
+        if bajas["productos"]:
+            cursor.execute(f"DELETE FROM tarifa_precios WHERE id_producto {EN_LISTA}", (lista_sql(bajas["productos"]),))
+            cursor.execute(f"DELETE FROM precios_efectivos WHERE id_producto {EN_LISTA}", (lista_sql(bajas["productos"]),))
+        ids_productos = ids_por_clave(cursor, "productos", productos)
+        for id_producto in ids_productos:
+            recalcular_precios_efectivos(conn, id_producto=id_producto)
+        ids_clientes = ids_por_clave(cursor, "clientes", clientes)
+
+        recibido = max(recibido, conjunto["hasta"])
+        cursor.execute('''
+            INSERT INTO nodos_remotos (id_nodo, recibido, actualizado) VALUES (?, ?, ?)
+            ON CONFLICT(id_nodo) DO UPDATE SET recibido = excluded.recibido, actualizado = excluded.actualizado
+        ''', (nodo, recibido, datetime.now().strftime(FORMATO_FECHA)))
+        cursor.execute("DELETE FROM sincronizacion_aplicando")
+        conn.commit()
+        clientes_cambiados = obtener_clientes(ids_clientes) if ids_clientes else []
+    except (sqlite3.Error, ValueError):
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for id_cliente in bajas["clientes"]:
+        indice_clientes.eliminar(id_cliente)
+    for cliente in clientes_cambiados:
+        indice_clientes.añadir(cliente)
+    bus_eventos.publicar(EVENTO_PRODUCTO, ids_productos)
+    bus_eventos.publicar(EVENTO_PRODUCTO_ELIMINADO, bajas["productos"])
+    bus_eventos.publicar(EVENTO_CLIENTE, ids_clientes)
+    bus_eventos.publicar(EVENTO_CLIENTE_ELIMINADO, bajas["clientes"])
+    return len(nuevos), recibido
+
+
+def error_faltan_cambios(nodo, recibido, hasta):
+    return ValueError(f"Faltan cambios de la tienda {nodo} entre las secuencias {recibido} y {hasta}: ya los habían "
+                      "recibido todas las tiendas conocidas y se han borrado. Para dar de alta otra tienda, copia la "
+                      "base de datos de una existente y ejecuta nuevo-nodo en la copia.")
+
+
+def confirmar_recibido(cursor, nodo, confirmado):
+    """Anota que la tienda 'nodo' ya ha aplicado los cambios propios hasta la secuencia 'confirmado'."""
+    cursor.execute('''
+        INSERT INTO nodos_remotos (id_nodo, confirmado) VALUES (?, ?)
+        ON CONFLICT(id_nodo) DO UPDATE SET confirmado = MAX(confirmado, excluded.confirmado)
+    ''', (nodo, confirmado))
+
+
+def podar_cambios(cursor):
+    """Borra del registro de cambios lo que ya no hace falta. Devuelve cuántas filas se han borrado.
+
+    Un cambio propio se puede borrar cuando todas las tiendas conocidas han confirmado que lo tienen
+    (si no se conoce ninguna, no se borra nada). De cada campo se conserva el último cambio, propio
+    o recibido, porque el último escritor gana se decide contra él; los incrementos de stock y las
+    líneas de venta no se comparan y se borran enteros.
+    """
+    cursor.execute("SELECT MIN(confirmado) FROM nodos_remotos")
+    limite = cursor.fetchone()[0] or 0
+    superado = '''EXISTS (SELECT 1 FROM cambios c WHERE c.tabla = cambios.tabla AND c.clave = cambios.clave
+                   AND c.campo = cambios.campo AND (c.marca, c.seq) > (cambios.marca, cambios.seq))'''
+    cursor.execute(f'''
+        DELETE FROM cambios WHERE CASE WHEN nodo IS NULL
+            THEN seq <= ? AND (campo IN (?, ?) OR {superado})
+            ELSE {superado} END
+    ''', (limite, CAMPO_STOCK, CAMPO_LINEA))
+    borrados = cursor.rowcount
+    cursor.execute("UPDATE nodo_sincronizacion SET podado = MAX(podado, ?)", (limite,))
+    return borrados
+
+
+def podar_tras_confirmar(nodo, confirmado):
+    """Anota lo que la otra tienda ha confirmado por red y poda el registro de cambios."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    confirmar_recibido(cursor, nodo, confirmado)
+    podar_cambios(cursor)
+    conn.commit()
+    conn.close()
+
+
+def ids_por_clave(cursor, tabla, claves):
+    """IDs locales de las filas con esas claves de sincronización (uid)."""
+    if not claves:
+        return []
+    columna_clave = CAMPOS_SINCRONIZADOS[tabla][0]
+    id_columna = "id" if tabla == "productos" else "id_cliente"
+    cursor.execute(f"SELECT {id_columna} FROM {tabla} WHERE {columna_clave} {EN_LISTA}", (lista_sql(claves),))
+    return [fila[0] for fila in cursor.fetchall()]
+
+
+def escribir_atomico(ruta, datos):
+    """Escribe un archivo de forma que quien lo lea nunca lo vea a medias."""
+    temporal = ruta + ".tmp"
+    with open(temporal, "wb") as archivo:
+        archivo.write(datos)
+    os.replace(temporal, ruta)
+
+
+def leer_carpetas_tiendas(carpeta, local, recibidos):
+    """Aplica los archivos nuevos de las subcarpetas de las demás tiendas y deja en cada una el acuse.
+
+    Devuelve (cambios recibidos, tiendas encontradas).
+    """
+    total_recibidos = 0
+    otras = []
+    for nodo in sorted(os.listdir(carpeta)):
+        directorio = os.path.join(carpeta, nodo)
+        if nodo == local or not os.path.isdir(directorio):
+            continue
+        otras.append(nodo)
+        recibido = recibidos.get(nodo, 0)
+        # Se lee antes que la lista de archivos: la otra tienda lo actualiza después de escribir el archivo
+        exportado = 0
+        if os.path.exists(os.path.join(directorio, "exportado")):
+            with open(os.path.join(directorio, "exportado"), "rb") as archivo:
+                exportado = int(archivo.read() or 0)
+        for nombre in sorted(os.listdir(directorio)):
+            if not (nombre.startswith("cambios_") and nombre.endswith(".json.gz")):
+                continue
+            if int(nombre[:-len(".json.gz")].rsplit("_", 1)[1]) <= recibido:
+                continue
+            with open(os.path.join(directorio, nombre), "rb") as archivo:
+                nuevos, recibido = aplicar_cambios(descomprimir_cambios(archivo.read()))
+            total_recibidos += nuevos
+        if exportado > recibido:  # Los archivos que faltan ya se borraron
+            raise error_faltan_cambios(nodo, recibido, exportado)
+        if recibido:
+            escribir_atomico(os.path.join(directorio, f"acuse_{local}"), str(recibido).encode("ascii"))
+    return total_recibidos, otras
+
+
+def sincronizar_carpeta(carpeta):
+    """Intercambia cambios con las demás tiendas a través de una carpeta compartida. Devuelve (recibidos, enviados).
+
+    Cada tienda escribe sus cambios en su subcarpeta, un archivo comprimido por envío, y lee los
+    de las demás desde la última secuencia recibida. Después deja un acuse con esa secuencia en
+    la subcarpeta de origen. Cada subcarpeta es una tienda: los archivos y el registro de cambios
+    propios solo se borran cuando todas han dejado acuse (podar_cambios). Una tienda nueva se crea
+    copiando la base de datos de otra (nuevo-nodo), porque lo ya borrado no se puede volver a leer.
+    """
+    carpeta = os.path.expanduser(carpeta)
+    conn = conectar_db()
+    cursor = conn.cursor()
+    local = id_nodo_local(cursor)
+    cursor.execute("SELECT id_nodo, recibido FROM nodos_remotos")
+    recibidos = dict(cursor.fetchall())
+    conn.close()
+    # La subcarpeta propia se crea antes de nada: desde ahora las demás tiendas esperan su acuse
+    propia = os.path.join(carpeta, local)
+    creada = not os.path.isdir(propia)
+    os.makedirs(propia, exist_ok=True)
+
+    try:
+        total_recibidos, otras = leer_carpetas_tiendas(carpeta, local, recibidos)
+    except ValueError:
+        if creada:  # Una tienda que no ha podido ponerse al día no debe frenar la poda de las demás
+            os.rmdir(propia)
+        raise
+
+    # Acuses de las demás tiendas; una tienda que aún no lo ha dejado no ha leído nada
+    acuses = {}
+    for nodo in otras:
+        ruta = os.path.join(propia, f"acuse_{nodo}")
+        if os.path.exists(ruta):
+            with open(ruta, "rb") as archivo:
+                acuses[nodo] = int(archivo.read() or 0)
+        else:
+            acuses[nodo] = 0
+
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT exportado FROM nodo_sincronizacion")
+    conjunto = conjunto_cambios(cursor, cursor.fetchone()[0])
+    if conjunto["cambios"]:
+        nombre = f"cambios_{conjunto['desde'] + 1:012d}_{conjunto['hasta']:012d}.json.gz"
+        escribir_atomico(os.path.join(propia, nombre), comprimir_cambios(conjunto))
+        escribir_atomico(os.path.join(propia, "exportado"), str(conjunto["hasta"]).encode("ascii"))
+        cursor.execute("UPDATE nodo_sincronizacion SET exportado = ?", (conjunto["hasta"],))
+    for nodo, acuse in acuses.items():
+        confirmar_recibido(cursor, nodo, acuse)
+    podar_cambios(cursor)
+    conn.commit()
+    conn.close()
+
+    if acuses:
+        leido_por_todas = min(acuses.values())
+        for nombre in os.listdir(propia):
+            if nombre.startswith("cambios_") and nombre.endswith(".json.gz") \
+                    and int(nombre[:-len(".json.gz")].rsplit("_", 1)[1]) <= leido_por_todas:
+                os.remove(os.path.join(propia, nombre))
+    return total_recibidos, len(conjunto["cambios"])
+
+
+def enviar_mensaje(conexion, mensaje):
+    """Envía un mensaje JSON comprimido precedido de su longitud."""
+    datos = comprimir_cambios(mensaje)
+    conexion.sendall(struct.pack("!I", len(datos)) + datos)
+
+
+def recibir_mensaje(conexion, maximo=TAMAÑO_SALUDO):
+    """Recibe un mensaje enviado con enviar_mensaje. Rechaza los que pasan de maximo bytes, comprimido o descomprimido."""
+    def leer(tamaño):
+        partes = []
+        while tamaño:
+            parte = conexion.recv(min(tamaño, 65536))
+            if not parte:
+                raise ConnectionError("La otra tienda cerró la conexión.")
+            partes.append(parte)
+            tamaño -= len(parte)
+        return b"".join(partes)
+    tamaño = struct.unpack("!I", leer(4))[0]
+    if tamaño > maximo:
+        raise ValueError(f"Mensaje de {tamaño} bytes, el máximo es {maximo}.")
+    descompresor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip
+    datos = descompresor.decompress(leer(tamaño), maximo)
+    if not descompresor.eof:
+        raise ValueError(f"Mensaje incompleto o de más de {maximo} bytes descomprimido.")
+    return json.loads(datos)
+
+
+def clave_sincronizacion():
+    """Secreto compartido de la sincronización por red; sin él no se sincroniza por red."""
+    clave = str(ajuste("clave_sincronizacion")).strip()
+    if not clave:
+        raise ValueError("Falta la clave de sincronización en los ajustes (la misma en todas las tiendas).")
+    return clave.encode("utf-8")
+
+
+def prueba_clave(clave, lado, reto_cliente, reto_servidor):
+    """Prueba de que un lado conoce la clave, ligada a los retos de esta conexión para que no se pueda reutilizar."""
+    return hmac.new(clave, f"{lado}:{reto_cliente}:{reto_servidor}".encode("ascii"), hashlib.sha256).hexdigest()
+
+
+def comprobar_prueba(clave, lado, reto_cliente, reto_servidor, prueba):
+    if not isinstance(prueba, str) or not hmac.compare_digest(prueba, prueba_clave(clave, lado, reto_cliente, reto_servidor)):
+        raise ValueError("La otra tienda no tiene la misma clave de sincronización.")
+
+
+def comprobar_pareja_red(cursor, nodo):
+    """La red solo sincroniza dos tiendas entre sí: lo recibido de una no se reenvía a una tercera."""
+    cursor.execute("SELECT id_nodo FROM nodos_remotos WHERE id_nodo != ? LIMIT 1", (nodo,))
+    otra = cursor.fetchone()
+    if otra:
+        raise ValueError(f"Esta base ya sincroniza con la tienda {otra[0]}. Por red solo se sincronizan dos "
+                         "tiendas; con más, usad una carpeta compartida.")
+
+
+def sincronizar_con(host, puerto=PUERTO_SINCRONIZACION, tiempo_espera=30):
+    """Sincroniza en los dos sentidos con una tienda que atiende por red (servir_sincronizacion). Devuelve (recibidos, enviados).
+
+    Cada lado indica la última secuencia que tiene del otro, así que solo viajan los cambios pendientes.
+    Los dos lados demuestran conocer la clave de sincronización antes de intercambiar cambios. Los
+    cambios recibidos no se reenvían: por red solo se sincronizan dos tiendas (comprobar_pareja_red).
+    """
+    clave = clave_sincronizacion()
+    conn = conectar_db()
+    cursor = conn.cursor()
+    local = id_nodo_local(cursor)
+    conn.close()
+    reto = uuid.uuid4().hex
+    with socket.create_connection((host, puerto), timeout=tiempo_espera) as conexion:
+        enviar_mensaje(conexion, {"nodo": local, "reto": reto})
+        saludo = recibir_mensaje(conexion)
+        comprobar_prueba(clave, "servidor", reto, saludo["reto"], saludo["prueba"])
+        enviar_mensaje(conexion, {"prueba": prueba_clave(clave, "cliente", reto, saludo["reto"])})
+        conn = conectar_db()
+        cursor = conn.cursor()
+        try:
+            comprobar_pareja_red(cursor, saludo["nodo"])
+            conjunto = conjunto_cambios(cursor, saludo["recibido"])
+            enviar_mensaje(conexion, {"recibido": recibido_de(cursor, saludo["nodo"]), "cambios": conjunto})
+        finally:
+            conn.close()
+        respuesta = recibir_mensaje(conexion, TAMAÑO_MAXIMO_MENSAJE)
+        if "error" in respuesta:
+            raise ValueError(f"La tienda {saludo['nodo']} rechazó los cambios: {respuesta['error']}")
+        nuevos, _ = aplicar_cambios(respuesta["cambios"])
+    # La respuesta llega después de que la otra tienda haya aplicado lo enviado
+    podar_tras_confirmar(saludo["nodo"], conjunto["hasta"])
+    return nuevos, len(conjunto["cambios"])
+
+
+def atender_sincronizacion(conexion):
+    """Lado servidor de sincronizar_con. Devuelve (tienda, recibidos, enviados).
+
+    Hasta que el cliente demuestra conocer la clave solo se aceptan mensajes de TAMAÑO_SALUDO.
+    """
+    clave = clave_sincronizacion()
+    saludo = recibir_mensaje(conexion)
+    nodo, reto_cliente = saludo["nodo"], str(saludo["reto"])
+    reto = uuid.uuid4().hex
+    conn = conectar_db()
+    cursor = conn.cursor()
+    try:
+        comprobar_pareja_red(cursor, nodo)
+        enviar_mensaje(conexion, {"nodo": id_nodo_local(cursor), "recibido": recibido_de(cursor, nodo), "reto": reto,
+                                  "prueba": prueba_clave(clave, "servidor", reto_cliente, reto)})
+    finally:
+        conn.close()
+    comprobar_prueba(clave, "cliente", reto_cliente, reto, recibir_mensaje(conexion)["prueba"])
+    peticion = recibir_mensaje(conexion, TAMAÑO_MAXIMO_MENSAJE)
+    try:
+        nuevos, _ = aplicar_cambios(peticion["cambios"])
+    except (sqlite3.Error, ValueError) as e:
+        enviar_mensaje(conexion, {"error": str(e)})
+        raise
+    podar_tras_confirmar(nodo, peticion["recibido"])
+    conn = conectar_db()
+    conjunto = conjunto_cambios(conn.cursor(), peticion["recibido"])
+    conn.close()
+    enviar_mensaje(conexion, {"cambios": conjunto})
+    return nodo, nuevos, len(conjunto["cambios"])
+
+
+
+def servir_sincronizacion(puerto=PUERTO_SINCRONIZACION, host="127.0.0.1", avisar=None, conexiones=None):
+    """Atiende por TCP las sincronizaciones de otras tiendas, de una en una.
+
+    avisar(direccion, resultado, error) se llama tras cada conexión; conexiones limita cuántas se
+    atienden antes de volver (None = sin límite). Por defecto solo escucha en este equipo: para
+    otras tiendas hay que indicar host ("" = todas las interfaces). Exige la clave de sincronización.
+    """
+    clave_sincronizacion()  # Sin clave no se abre el puerto
+    with socket.create_server((host, puerto)) as servidor:
+        atendidas = 0
+        while conexiones is None or atendidas < conexiones:
+            conexion, direccion = servidor.accept()
+            atendidas += 1
+            with conexion:
+                conexion.settimeout(30)
+                try:
+                    resultado, error = atender_sincronizacion(conexion), None
+                except (OSError, ValueError, KeyError, TypeError, zlib.error, sqlite3.Error) as e:
+                    resultado, error = None, e
+            if avisar:
+                avisar(direccion, resultado, error)
+
+
+def sincronizar(destino=None):
+    """Sincroniza con la carpeta compartida o la tienda host:puerto indicada (por defecto, el ajuste sincronizacion)."""
+    destino = (destino or ajuste("sincronizacion")).strip()
+    if not destino:
+        raise ValueError("No hay carpeta ni tienda de sincronización en los ajustes.")
+    if os.path.isdir(os.path.expanduser(destino)):
+        return sincronizar_carpeta(destino)
+    host, _, puerto = destino.rpartition(":")
+    if host and puerto.isdigit():
+        return sincronizar_con(host, int(puerto))
+    raise ValueError(f"{destino} no es una carpeta ni una dirección host:puerto.")
+
+
+def nuevo_nodo():
+    """Da una identidad nueva a esta base de datos, para la segunda tienda creada copiando la de la primera.
+
+    Los cambios que ya estaban en la copia pasan a ser de la tienda original y se dan por recibidos.
+    """
+    conn = conectar_db()
+    cursor = conn.cursor()
+    anterior = id_nodo_local(cursor)
+    nodo = uuid.uuid4().hex
+    cursor.execute("UPDATE cambios SET nodo = ? WHERE nodo IS NULL", (anterior,))
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios")
+    ultimo = cursor.fetchone()[0]
+    cursor.execute("INSERT OR REPLACE INTO nodos_remotos (id_nodo, recibido, actualizado) VALUES (?, ?, ?)",
+                   (anterior, ultimo, datetime.now().strftime(FORMATO_FECHA)))
+    # Las confirmaciones y la poda copiadas eran de los cambios de la tienda original
+    cursor.execute("UPDATE nodos_remotos SET confirmado = 0")
+    cursor.execute("UPDATE nodo_sincronizacion SET id_nodo = ?, exportado = ?, podado = 0", (nodo, ultimo))
+    conn.commit()
+    conn.close()
+    return nodo
+
+
+def estado_sincronizacion():
+    """(ID de esta tienda, cambios propios sin exportar a la carpeta, [(tienda, secuencia recibida, fecha)])."""
+    conn = conectar_db()
+    cursor = conn.cursor()
+    local = id_nodo_local(cursor)
+    cursor.execute("SELECT COUNT(*) FROM cambios WHERE nodo IS NULL AND seq > (SELECT exportado FROM nodo_sincronizacion)")
+    pendientes = cursor.fetchone()[0]
+    cursor.execute("SELECT id_nodo, recibido, actualizado FROM nodos_remotos ORDER BY id_nodo")
+    remotos = cursor.fetchall()
+    conn.close()
+    return local, pendientes, remotos
+
+
+# =================== COHERENCIA DE LOS DATOS =================== #
+# (clave, descripción, consulta que devuelve (referencia, detalle) por problema, sentencias de reparación o None)
+# Cada consulta es un anti-join sobre columnas indexadas; las que no tienen reparación segura solo se informan
+COMPROBACIONES_COHERENCIA = (
+    ("facturas_sin_lineas", "Facturas sin líneas en el historial", '''
+        SELECT f.id_factura, f.fecha || ' · ' || f.cliente || ' · ' || f.total FROM facturas f
+        WHERE NOT EXISTS (SELECT 1 FROM historial h WHERE h.id_factura = f.id_factura)
+          AND NOT EXISTS (SELECT 1 FROM albaranes a WHERE a.id_factura = f.id_factura)
+          AND f.id_factura NOT IN (SELECT id_factura FROM coherencia_archivadas)
+        ORDER BY f.id_factura
+    ''', None),
+    ("lineas_sin_producto", "Líneas del historial cuyo producto no existe", '''
+        SELECT producto, COUNT(*) || ' líneas' FROM historial
+        WHERE producto NOT IN (SELECT nombre FROM productos)
+        GROUP BY producto ORDER BY COUNT(*) DESC
+    ''', None),
+    ("lineas_sin_factura", "Líneas de factura o devolución sin su factura", '''
+        SELECT id_factura, COUNT(*) || ' líneas' FROM historial
+        WHERE tipo IN ('Venta', 'Devolución') AND id_factura NOT IN (SELECT id_factura FROM facturas)
+        GROUP BY id_factura ORDER BY id_factura
+    ''', None),
+    ("stock_negativo", "Productos con stock negativo (se reparan dejándolo a 0)", '''
+        SELECT id, nombre || ' · ' || cantidad FROM productos WHERE cantidad < 0 ORDER BY id
+    ''', ("UPDATE productos SET cantidad = 0 WHERE cantidad < 0",)),
+    ("codigos_duplicados", "Códigos de barras repetidos", '''
+        SELECT codigo, COUNT(*) || ' productos: ' || group_concat(nombre, ', ') FROM productos
+        GROUP BY codigo HAVING COUNT(*) > 1 ORDER BY codigo
+    ''', None),
+    ("nombres_duplicados", "Nombres de producto repetidos (el historial enlaza por nombre)", '''
+        SELECT nombre, COUNT(*) || ' productos: ' || group_concat(codigo, ', ') FROM productos
+        GROUP BY nombre HAVING COUNT(*) > 1 ORDER BY nombre
+    ''', None),
+    ("clientes_inexistentes", "Facturas, albaranes o vales de clientes eliminados (se desvinculan)", '''
+        SELECT 'factura ' || id_factura, 'cliente ' || id_cliente FROM facturas
+        WHERE id_cliente IS NOT NULL AND id_cliente NOT IN (SELECT id_cliente FROM clientes)
+        UNION ALL
+        SELECT 'albarán ' || id_albaran, 'cliente ' || id_cliente FROM albaranes
+        WHERE id_cliente IS NOT NULL AND id_cliente NOT IN (SELECT id_cliente FROM clientes)
+        UNION ALL
+        SELECT 'vale ' || id_vale, 'cliente ' || id_cliente FROM vales
+        WHERE id_cliente IS NOT NULL AND id_cliente NOT IN (SELECT id_cliente FROM clientes)
+    ''', tuple(f"UPDATE {tabla} SET id_cliente = NULL WHERE id_cliente IS NOT NULL"
+               f" AND id_cliente NOT IN (SELECT id_cliente FROM clientes)" for tabla in ("facturas", "albaranes", "vales"))),
+    ("albaranes_factura_inexistente", "Albaranes facturados en una factura que no existe (vuelven a pendientes)", '''
+        SELECT id_albaran, 'factura ' || id_factura FROM albaranes
+        WHERE id_factura IS NOT NULL AND id_factura NOT IN (SELECT id_factura FROM facturas)
+        ORDER BY id_albaran
+    ''', ("UPDATE albaranes SET id_factura = NULL WHERE id_factura IS NOT NULL"
+          " AND id_factura NOT IN (SELECT id_factura FROM facturas)",)),
+    ("tarifas_huerfanas", "Precios y descuentos de tarifas, familias o productos eliminados (se borran)", '''
+        SELECT 'precio fijo', id_tarifa || '/' || id_producto FROM tarifa_precios
+        WHERE id_tarifa NOT IN (SELECT id_tarifa FROM tarifas) OR id_producto NOT IN (SELECT id FROM productos)
+        UNION ALL
+        SELECT 'precio efectivo', id_tarifa || '/' || id_producto FROM precios_efectivos
+        WHERE id_tarifa NOT IN (SELECT id_tarifa FROM tarifas) OR id_producto NOT IN (SELECT id FROM productos)
+        UNION ALL
+        SELECT 'descuento de familia', id_tarifa || '/' || id_familia FROM tarifa_familias
+        WHERE id_tarifa NOT IN (SELECT id_tarifa FROM tarifas) OR id_familia NOT IN (SELECT id_familia FROM familias)
+        UNION ALL
+        SELECT 'cliente ' || id_cliente, 'tarifa ' || id_tarifa FROM clientes
+        WHERE id_tarifa IS NOT NULL AND id_tarifa NOT IN (SELECT id_tarifa FROM tarifas)
+        UNION ALL
+        SELECT 'producto ' || id, 'familia ' || id_familia FROM productos
+        WHERE id_familia IS NOT NULL AND id_familia NOT IN (SELECT id_familia FROM familias)
+    ''', ("DELETE FROM tarifa_precios WHERE id_tarifa NOT IN (SELECT id_tarifa FROM tarifas)"
+          " OR id_producto NOT IN (SELECT id FROM productos)",
+          "DELETE FROM precios_efectivos WHERE id_tarifa NOT IN (SELECT id_tarifa FROM tarifas)"
+          " OR id_producto NOT IN (SELECT id FROM productos)",
+          "DELETE FROM tarifa_familias WHERE id_tarifa NOT IN (SELECT id_tarifa FROM tarifas)"
+          " OR id_familia NOT IN (SELECT id_familia FROM familias)",
+          "UPDATE clientes SET id_tarifa = NULL WHERE id_tarifa IS NOT NULL AND id_tarifa NOT IN (SELECT id_tarifa FROM tarifas)",
+          "UPDATE productos SET id_familia = NULL WHERE id_familia IS NOT NULL"
+          " AND id_familia NOT IN (SELECT id_familia FROM familias)")),
+)
+
+
+def comprobar_coherencia(reparar=False):
+    """Comprueba la coherencia de facturas, historial, productos, clientes y tarifas.
+
+    Todas las comprobaciones (y, si se pide, las reparaciones) se hacen en una sola transacción,
+    así que el informe y lo reparado corresponden al mismo estado de la base de datos. Devuelve
+    una lista de (clave, descripción, filas (referencia, detalle), reparada).
+    """
+    conn = conectar_db()
+    cursor = conn.cursor()
+    resultados = []
+    try:
+        cursor.execute("BEGIN IMMEDIATE" if reparar else "BEGIN")
+        # Las facturas de ejercicios archivados tienen sus líneas en el archivo, no en el historial
+        cursor.execute("CREATE TEMP TABLE coherencia_archivadas (id_factura INTEGER PRIMARY KEY)")
+        for año in ejercicios_archivados():
+            cursor.execute("INSERT OR IGNORE INTO coherencia_archivadas SELECT id_factura FROM facturas WHERE dia BETWEEN ? AND ?",
+                           (dia_desde_fecha(date(año, 1, 1)), dia_desde_fecha(date(año, 12, 31))))
+
+        for clave, descripcion, consulta, reparaciones in COMPROBACIONES_COHERENCIA:
+            cursor.execute(consulta)
+            filas = cursor.fetchall()
+            reparada = bool(reparar and filas and reparaciones)
+            if reparada:
+                for sentencia in reparaciones:
+                    cursor.execute(sentencia)
+            resultados.append((clave, descripcion, filas, reparada))
+
+        erroneos = verificar_cadena_registros(cursor)
+        resultados.append(("cadena_registros", "Registros de facturación cuya huella no cuadra",
+                           [(id_factura, "") for id_factura in erroneos], False))
+        cursor.execute("DROP TABLE coherencia_archivadas")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for clave, _, filas, reparada in resultados:
+        if reparada and clave == "stock_negativo":
+            bus_eventos.publicar(EVENTO_PRODUCTO, [fila[0] for fila in filas])
+    return resultados
+
+
+# =================== COPIAS DE SEGURIDAD =================== #
+PAGINAS_POR_PASO_COPIA = 64      # Páginas copiadas en cada paso; entre pasos la base queda libre para las ventas
+PAUSA_ENTRE_PASOS_COPIA = 0.005  # Segundos de pausa entre pasos
+CONSERVAR_COPIAS = 10            # Copias más recientes que se conservan siempre
+CONSERVAR_COPIAS_MENSUALES = 12  # Además, la primera copia de cada uno de los últimos meses
+HORAS_ENTRE_COPIAS = 24
+
+
+def ruta_copias_seguridad():
+    """Directorio donde se guardan las copias de seguridad comprimidas."""
+    return os.path.join(directorio_datos(), "ferreteria_copias")
+
+
+def comprobar_integridad(ruta):
+    """Ejecuta PRAGMA integrity_check sobre una base de datos. Devuelve (correcta, mensaje)."""
+    conn = sqlite3.connect(ruta)
+    try:
+        resultado = [fila[0] for fila in conn.execute("PRAGMA integrity_check").fetchall()]
+    except sqlite3.DatabaseError as e:
+        return False, str(e)
+    finally:
+        conn.close()
+    return resultado == ["ok"], "; ".join(resultado)
+
+
+class CopiaReiniciada(Exception):
+    """La copia se ha reiniciado porque otra conexión ha escrito en la base durante la copia."""
+
+
+def copiar_por_pasos(origen, copia, paginas, pausa, progreso=None):
+    """Copia con la API de backup en pasos de pocas páginas, soltando el bloqueo entre pasos.
+
+    Si otra conexión escribe durante la copia, SQLite la reinicia desde el principio. Para que
+    una caja con muchas ventas no impida terminarla nunca, cada reinicio multiplica el tamaño
+    del paso hasta copiarlo todo de una vez.
+    """
+    while True:
+        restantes_anterior = None
+
+        def vigilar(estado, restantes, total):
+            nonlocal restantes_anterior
+            if restantes_anterior is not None and restantes > restantes_anterior:
+                raise CopiaReiniciada()
+            restantes_anterior = restantes
+            if progreso:
+                progreso(estado, restantes, total)
+
+        try:
+            origen.backup(copia, pages=paginas, progress=vigilar, sleep=pausa)
+            return
+        except CopiaReiniciada:
+            paginas = -1 if paginas < 0 or paginas >= 4096 else paginas * 4
+
+
+def hacer_copia_seguridad(directorio=None, paginas=PAGINAS_POR_PASO_COPIA, pausa=PAUSA_ENTRE_PASOS_COPIA, progreso=None, prefijo="ferreteria"):
+    """Copia la base de datos en caliente por pasos, la verifica, la comprime y rota las antiguas. Devuelve la ruta."""
+    directorio = directorio or ruta_copias_seguridad()
+    os.makedirs(directorio, exist_ok=True)
+    marca = datetime.now().strftime("%Y%m%d_%H%M%S")
+    ruta_final = os.path.join(directorio, f"{prefijo}_{marca}.db.gz")
+    numero = 1
+    while os.path.exists(ruta_final):  # Dos copias en el mismo segundo
+        numero += 1
+        ruta_final = os.path.join(directorio, f"{prefijo}_{marca}_{numero}.db.gz")
+    descriptor, temporal = tempfile.mkstemp(suffix=".db", dir=directorio)
+    os.close(descriptor)
+
+    try:
+        origen = conectar_db()
+        copia = sqlite3.connect(temporal)
+        try:
+            copiar_por_pasos(origen, copia, paginas, pausa, progreso)
+        finally:
+            copia.close()
+            origen.close()
+
+        correcta, mensaje = comprobar_integridad(temporal)
+        if not correcta:
+            raise sqlite3.DatabaseError(f"La copia no supera integrity_check: {mensaje}")
+
+        with open(temporal, "rb") as f_origen, gzip.open(ruta_final + ".tmp", "wb") as f_destino:
+            shutil.copyfileobj(f_origen, f_destino)
+        os.replace(ruta_final + ".tmp", ruta_final)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+    rotar_copias(directorio, prefijo=prefijo)
+    return ruta_final
+
+
+def listar_copias(directorio=None, prefijo="ferreteria"):
+    """Lista las copias comprimidas del directorio, de la más reciente a la más antigua."""
+    directorio = directorio or ruta_copias_seguridad()
+    if not os.path.isdir(directorio):
+        return []
+    copias = [os.path.join(directorio, nombre) for nombre in os.listdir(directorio)
+              if nombre.startswith(prefijo + "_") and nombre.endswith(".db.gz")]
+    return sorted(copias, reverse=True)
+
+
+def rotar_copias(directorio=None, conservar=CONSERVAR_COPIAS, conservar_mensuales=CONSERVAR_COPIAS_MENSUALES, prefijo="ferreteria"):
+    """Borra las copias antiguas conservando las más recientes y la primera de cada mes. Devuelve las borradas."""
+    copias = listar_copias(directorio, prefijo)
+    conservadas = set(copias[:conservar])
+    primera_del_mes = {}
+    for ruta in reversed(copias):  # De la más antigua a la más reciente
+        mes = os.path.basename(ruta)[len(prefijo) + 1:len(prefijo) + 7]
+        primera_del_mes.setdefault(mes, ruta)
+    for mes in sorted(primera_del_mes, reverse=True)[:conservar_mensuales]:
+        conservadas.add(primera_del_mes[mes])
+
+    borradas = [ruta for ruta in copias if ruta not in conservadas]
+    for ruta in borradas:
+        os.remove(ruta)
+    return borradas
+
+
+def descomprimir_copia(ruta_copia, destino):
+    """Descomprime una copia .db.gz en la ruta indicada."""
+    with gzip.open(ruta_copia, "rb") as f_origen, open(destino, "wb") as f_destino:
+        shutil.copyfileobj(f_origen, f_destino)
+
+
+def verificar_copia(ruta_copia):
+    """Descomprime una copia en un temporal y ejecuta integrity_check. Devuelve (correcta, mensaje)."""
+    descriptor, temporal = tempfile.mkstemp(suffix=".db")
+    os.close(descriptor)
+    try:
+        descomprimir_copia(ruta_copia, temporal)
+        return comprobar_integridad(temporal)
+    finally:
+        os.remove(temporal)
+
+
+def restaurar_copia(ruta_copia):
+    """Restaura la base de datos desde una copia verificada. Antes guarda una copia del estado actual."""
+    descriptor, temporal = tempfile.mkstemp(suffix=".db")
+    os.close(descriptor)
+    try:
+        descomprimir_copia(ruta_copia, temporal)
+        correcta, mensaje = comprobar_integridad(temporal)
+        if not correcta:
+            raise sqlite3.DatabaseError(f"La copia está dañada: {mensaje}")
+
+        if os.path.exists(ruta_base_datos()):
+            hacer_copia_seguridad(prefijo="antes_de_restaurar")
+
+        # Se restaura con la API de backup para que la escritura sea atómica para el resto de conexiones
+        origen = sqlite3.connect(temporal)
+        destino = conectar_db()
+        try:
+            origen.backup(destino)
+        finally:
+            destino.close()
+            origen.close()
+    finally:
+        os.remove(temporal)
+
+
+def copia_pendiente(horas=HORAS_ENTRE_COPIAS):
+    """Indica si la última copia es más antigua que el intervalo indicado (o si no hay ninguna)."""
+    copias = listar_copias()
+    if not copias:
+        return True
+    return time.time() - os.path.getmtime(copias[0]) > horas * 3600
+
+
+def iniciar_copia_en_segundo_plano(al_terminar=None, directorio=None):
+    """Lanza una copia de seguridad en un hilo. al_terminar(ruta, error) se llama desde ese hilo al acabar."""
+    def trabajo():
+        try:
+            ruta = hacer_copia_seguridad(directorio)
+        except Exception as e:
+            if al_terminar:
+                al_terminar(None, e)
+        else:
+            if al_terminar:
+                al_terminar(ruta, None)
+
+    hilo = threading.Thread(target=trabajo, name="copia_seguridad", daemon=True)
+    hilo.start()
+    return hilo
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) de una lista de valores por el método del rango más cercano."""
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = max(0, min(len(ordenados) - 1, math.ceil(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def venta_de_prueba(producto_id, nombre):
+    """Simula el cobro de una línea igual que generar_factura. Devuelve la latencia en milisegundos."""
+    inicio = time.perf_counter()
+    id_factura = generar_id_factura()
+    fecha_actual = datetime.now().strftime(FORMATO_FECHA)
+    registrar_factura(id_factura, "Prueba", fecha_actual, 1.0)
+    registrar_transaccion(id_factura, "Venta", nombre, 1, 1.0, 1.0, fecha_actual)
+    actualizar_stock(producto_id, 1)
+    return (time.perf_counter() - inicio) * 1000
+
+
+def medir_impacto_copia(ventas=200, filas_relleno=200000):
+    """Mide la latencia de cobro sin copia y durante una copia en segundo plano, sobre una base temporal."""
+    ruta_original = os.environ.get("FERRETERIA_DB")
+    directorio = tempfile.mkdtemp(prefix="bench_copia_")
+    try:
+        os.environ["FERRETERIA_DB"] = os.path.join(directorio, "bench.db")
+        crear_tablas()
+        conn = conectar_db()
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO productos (nombre, codigo, precio, cantidad) VALUES ('Bench', 'BENCH', 1.0, 1000000000)")
+        producto_id = cursor.lastrowid
+        fecha = datetime.now().strftime(FORMATO_FECHA)
+        cursor.executemany(
+            "INSERT INTO historial (id_factura, tipo, producto, cantidad, precio, total, fecha, dia) VALUES (?, 'Venta', ?, 1, 1.0, 1.0, ?, ?)",
+            ((i, f"Relleno {i % 5000}", fecha, dia_desde_fecha(fecha)) for i in range(filas_relleno)))
+        conn.commit()
+        conn.close()
+
+        sin_copia = [venta_de_prueba(producto_id, "Bench") for _ in range(ventas)]
+
+        inicio_copia = time.perf_counter()
+        hilo = iniciar_copia_en_segundo_plano(directorio=os.path.join(directorio, "copias"))
+        con_copia = []
+        while hilo.is_alive():
+            con_copia.append(venta_de_prueba(producto_id, "Bench"))
+        hilo.join()
+        duracion_copia = time.perf_counter() - inicio_copia
+
+        resultado = {"duracion_copia_s": duracion_copia}
+        for nombre, muestras in (("sin_copia", sin_copia), ("durante_copia", con_copia)):
+            resultado[nombre] = {
+                "ventas": len(muestras),
+                "p50_ms": percentil(muestras, 50),
+                "p95_ms": percentil(muestras, 95),
+                "max_ms": max(muestras, default=0.0),
+            }
+        return resultado
+    finally:
+        if ruta_original is None:
+            os.environ.pop("FERRETERIA_DB", None)
+        else:
+            os.environ["FERRETERIA_DB"] = ruta_original
+        shutil.rmtree(directorio, ignore_errors=True)
+
+
+# =================== CARRITOS PERSISTENTES =================== #
+INTERVALO_SINCRONIZACION_CARRITOS = 0.2  # Segundos máximos entre fsync del diario de carritos
+REGISTROS_PARA_COMPACTAR = 5000           # Se reescribe el diario cuando acumula más registros que esto
+
+
+def nombre_caja():
+    """Nombre de la caja (variable FERRETERIA_CAJA); cada caja tiene su propio diario de carritos."""
+    return os.environ.get("FERRETERIA_CAJA") or "caja1"
+
+
+def ruta_diario_carritos(caja=None):
+    """Ruta del diario de carritos de una caja."""
+    return os.path.join(directorio_datos(), "ferreteria_carritos", f"{caja or nombre_caja()}.log")
+
+
+class DiarioCarritos:
+    """Carritos de venta que sobreviven a un cierre inesperado del programa.
+
+    Cada cambio se añade como una línea JSON a un diario que solo crece y que se
+    vuelve a aplicar al arrancar. La escritura solo pasa por el búfer del sistema
+    operativo (sobrevive a un fallo del programa); el fsync a disco lo hace un hilo
+    aparte como mucho cada INTERVALO_SINCRONIZACION_CARRITOS segundos, agrupando
+    todas las escrituras de ese intervalo, para no frenar el escaneo de productos.
+    """
+
+    def __init__(self, ruta=None, intervalo=INTERVALO_SINCRONIZACION_CARRITOS):
+        self.ruta = ruta or ruta_diario_carritos()
+        self.intervalo = intervalo
+        self.carritos = {}    # id_carrito -> {"nombre": str, "lineas": [tuplas]}
+        self.registros = 0
+        self.pendiente = False
+        self.cerrado = False
+        self.archivo = None
+        self.lock = threading.Lock()
+        self.evento = threading.Event()
+        os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+        self.reproducir()
+        self.compactar()
+        self.hilo = threading.Thread(target=self.bucle_sincronizacion, name="diario_carritos", daemon=True)
+        self.hilo.start()
+
+    def aplicar(self, registro):
+        """Aplica un registro del diario al estado en memoria."""
+        op, id_carrito = registro["op"], registro["c"]
+        if op == "estado":
+            self.carritos[id_carrito] = {"nombre": registro.get("n", ""), "lineas": [tuple(l) for l in registro["l"]]}
+            return
+        carrito = self.carritos.setdefault(id_carrito, {"nombre": "", "lineas": []})
+        if op == "añadir":
+            carrito["lineas"].append(tuple(registro["l"]))
+        elif op == "quitar":
+            if 0 <= registro["i"] < len(carrito["lineas"]):
+                del carrito["lineas"][registro["i"]]
+        elif op == "cambiar":
+            if 0 <= registro["i"] < len(carrito["lineas"]):
+                carrito["lineas"][registro["i"]] = tuple(registro["l"])
+        elif op == "nombre":
+            carrito["nombre"] = registro["n"]
+        elif op == "mover":
+            self.carritos[registro["d"]] = self.carritos.pop(id_carrito)
+        elif op == "borrar":
+            self.carritos.pop(id_carrito, None)
+
+    def reproducir(self):
+        """Reconstruye los carritos leyendo el diario. Ignora una última línea a medio escribir."""
+        if not os.path.exists(self.ruta):
+            return
+        with open(self.ruta, "r", encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    registro = json.loads(linea)
+                except ValueError:
+                    break  # Escritura interrumpida por el cierre: lo anterior es válido
+                self.aplicar(registro)
+                self.registros += 1
+
+    def compactar(self):
+        """Reescribe el diario con solo el estado actual de cada carrito, de forma atómica."""
+        with self.lock:
+            if self.archivo:
+                self.archivo.close()
+            temporal = self.ruta + ".tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                for id_carrito, carrito in self.carritos.items():
+                    f.write(json.dumps({"op": "estado", "c": id_carrito, "n": carrito["nombre"],
+                                        "l": carrito["lineas"]}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporal, self.ruta)
+            self.registros = len(self.carritos)
+            self.archivo = open(self.ruta, "a", encoding="utf-8")
+
+    def escribir(self, registro):
+        """Aplica un cambio y lo añade al diario. El fsync queda para el hilo de sincronización."""
+        with self.lock:
+            self.aplicar(registro)
+            self.archivo.write(json.dumps(registro, ensure_ascii=False) + "\n")
+            self.archivo.flush()
+            self.registros += 1
+            self.pendiente = True
+        self.evento.set()
+        if self.registros > REGISTROS_PARA_COMPACTAR:
+            self.compactar()
+
+    def sincronizar(self):
+        """Fuerza el fsync de lo escrito hasta ahora."""
+        with self.lock:
+            if self.pendiente and not self.archivo.closed:
+                os.fsync(self.archivo.fileno())
+                self.pendiente = False
+
+    def bucle_sincronizacion(self):
+        while not self.cerrado:
+            self.evento.wait()
+            self.evento.clear()
+            time.sleep(self.intervalo)  # Agrupa las escrituras del intervalo en un solo fsync
+            self.sincronizar()
+
+    def cerrar(self):
+        self.cerrado = True
+        self.evento.set()
+        self.sincronizar()
+        with self.lock:
+            self.archivo.close()
+
+    # Operaciones sobre los carritos
+    def lineas(self, id_carrito):
+        return list(self.carritos.get(id_carrito, {"lineas": []})["lineas"])
+
+    def añadir_linea(self, id_carrito, linea):
+        self.escribir({"op": "añadir", "c": id_carrito, "l": list(linea)})
+
+    def quitar_linea(self, id_carrito, indice):
+        self.escribir({"op": "quitar", "c": id_carrito, "i": indice})
+
+    def cambiar_linea(self, id_carrito, indice, linea):
+        self.escribir({"op": "cambiar", "c": id_carrito, "i": indice, "l": list(linea)})
+
+    def vaciar(self, id_carrito):
+        if id_carrito in self.carritos:
+            self.escribir({"op": "borrar", "c": id_carrito})
+
+    def aparcar(self, id_carrito, nombre):
+        """Aparca el carrito con un nombre y deja vacío el activo. Devuelve el ID del carrito aparcado."""
+        id_aparcado = f"aparcado-{time.time_ns()}"
+        self.escribir({"op": "mover", "c": id_carrito, "d": id_aparcado})
+        self.escribir({"op": "nombre", "c": id_aparcado, "n": nombre})
+        return id_aparcado
+
+    def recuperar(self, id_aparcado, id_carrito):
+        """Convierte un carrito aparcado en el carrito activo (que debe estar vacío)."""
+        self.vaciar(id_carrito)
+        self.escribir({"op": "mover", "c": id_aparcado, "d": id_carrito})
+        self.escribir({"op": "nombre", "c": id_carrito, "n": ""})
+
+    def aparcados(self):
+        """Lista de (id, nombre, número de líneas, total) de los carritos aparcados."""
+        return [(id_carrito, carrito["nombre"], len(carrito["lineas"]), sum(l[3] for l in carrito["lineas"]))
+                for id_carrito, carrito in self.carritos.items() if id_carrito.startswith("aparcado-")]
+
+
+# =================== ANÁLISIS DE VENTAS =================== #
+TIPOS_VENTA = ("Venta", "Ticket", "Albarán", "Devolución")  # Las devoluciones restan (importes negativos)
+TAMAÑO_BLOQUE_ANALISIS = 50000           # Filas leídas del cursor en cada bloque
+LIMITE_CLASE_A = 0.80                    # Porcentaje acumulado de ingresos hasta el que un producto es A
+LIMITE_CLASE_B = 0.95                    # ... y hasta el que es B; el resto es C
+
+
+def ruta_instantaneas_analisis():
+    """Directorio de las instantáneas .npy del historial."""
+    return os.path.join(directorio_datos(), "ferreteria_analitica")
+
+
+def clave_instantanea_historial(tienda=None):
+    """Clave que identifica el contenido del historial: id máximo, número de filas, revisión y archivos de ejercicios.
+
+    Con otras tiendas también cuenta cuántas ventas han llegado de ellas (historial_tiendas solo crece).
+    """
+    conn = conectar_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(id), COUNT(*), (SELECT revision FROM revision_historial) FROM historial")
+    max_id, filas, revision = cursor.fetchone()
+    if tienda is not None:
+        cursor.execute("SELECT COUNT(*) FROM historial_tiendas")
+        filas = f"{filas}+{cursor.fetchone()[0]}"
     conn.close()
-
-def obtener_productos():
-    """Obtiene todos los productos de la base de datos."""
+    firma = hashlib.sha1()
+    for año in ejercicios_archivados():
+        ruta = ruta_ejercicio_archivado(año)
+        firma.update(f"{año}:{os.path.getmtime(ruta)}:{os.path.getsize(ruta)};".encode())
+    return f"{max_id or 0}_{filas}_{revision or 0}_{firma.hexdigest()[:12]}"
+
+
+def columnas_desde_filas(filas, productos, tipos):
+    """Convierte un bloque de filas (dia, tipo, producto, cantidad, total) en arrays, codificando los textos.
+
+    Las filas sin día se descartan: no se pueden situar en el tiempo (contarlas como día 0 las llevaría a 1970).
+    """
+    filas = [f for f in filas if f[0] is not None]
+    n = len(filas)
+    dias = np.fromiter((f[0] for f in filas), dtype=np.int32, count=n)
+    cod_tipos = np.fromiter((tipos.setdefault(f[1], len(tipos)) for f in filas), dtype=np.int16, count=n)
+    cod_productos = np.fromiter((productos.setdefault(f[2], len(productos)) for f in filas), dtype=np.int32, count=n)
+    cantidades = np.fromiter((f[3] or 0 for f in filas), dtype=np.float64, count=n)
+    totales = np.fromiter((f[4] or 0 for f in filas), dtype=np.float64, count=n)
+    return dias, cod_tipos, cod_productos, cantidades, totales
+
+
+def cargar_historial_numpy(tamaño_bloque=TAMAÑO_BLOQUE_ANALISIS, tienda=None):
+    """Carga el historial (tabla y ejercicios archivados) en arrays de NumPy.
+
+    La tabla se lee por bloques con fetchmany para no tener todas las tuplas en memoria a la vez.
+    El resultado se guarda como instantánea .npy y las siguientes llamadas la abren con mmap
+    mientras no cambie el historial. Devuelve un dict con los arrays y los diccionarios de textos.
+    tienda funciona como en obtener_historial; cada filtro tiene su propia instantánea.
+    """
+    if np is None:
+        raise RuntimeError("El análisis de ventas necesita NumPy (pip install numpy).")
+    clave = clave_instantanea_historial(tienda)
+    etiqueta = {None: "local", TODAS_LAS_TIENDAS: "todas"}.get(tienda, tienda)
+    directorio = os.path.join(ruta_instantaneas_analisis(), f"historial_{etiqueta}_{clave}")
+    nombres = ("dia", "tipo", "producto", "cantidad", "total")
+
+    if os.path.exists(os.path.join(directorio, "diccionarios.json")):
+        with open(os.path.join(directorio, "diccionarios.json"), encoding="utf-8") as f:
+            datos = json.load(f)
+        for nombre in nombres:
+            datos[nombre] = np.load(os.path.join(directorio, f"{nombre}.npy"), mmap_mode="r")
+        return datos
+
+    productos, tipos = {}, {}
+    bloques = []
+
+    # Ejercicios archivados: ya están en columnas
+    for año in (ejercicios_archivados() if tienda in (None, TODAS_LAS_TIENDAS) else []):
+        columnas = leer_archivo_columnar(ruta_ejercicio_archivado(año), ["dia", "tipo", "producto", "cantidad", "total"])
+        filas = list(zip(columnas["dia"], valores_columna(columnas["tipo"]), valores_columna(columnas["producto"]),
+                         columnas["cantidad"], columnas["total"]))
+        if filas:
+            bloques.append(columnas_desde_filas(filas, productos, tipos))
+
+    consultas = []
+    if tienda in (None, TODAS_LAS_TIENDAS):
+        consultas.append(("SELECT dia, tipo, producto, cantidad, total FROM historial WHERE dia IS NOT NULL ORDER BY id", ()))
+    if tienda == TODAS_LAS_TIENDAS:
+        consultas.append(("SELECT dia, tipo, producto, cantidad, total FROM historial_tiendas WHERE dia IS NOT NULL", ()))
+    elif tienda is not None:
+        consultas.append(("SELECT dia, tipo, producto, cantidad, total FROM historial_tiendas WHERE dia IS NOT NULL AND nodo = ?",
+                          (tienda,)))
     conn = conectar_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM productos")
-    productos = cursor.fetchall()
+    for consulta, params in consultas:
+        cursor.execute(consulta, params)
+        while True:
+            filas = cursor.fetchmany(tamaño_bloque)
+            if not filas:
+                break
+            bloques.append(columnas_desde_filas(filas, productos, tipos))
     conn.close()
-    return productos
-
-# =================== FUNCIONES PARA CLIENTES =================== #
 
-def añadir_cliente(identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion, codigo_postal, poblacion, provincia, pais, telefono):
-    """Añade un cliente a la base de datos."""
+    if bloques:
+        arrays = [np.concatenate([bloque[i] for bloque in bloques]) for i in range(len(nombres))]
+    else:
+        arrays = [np.zeros(0, dtype=t) for t in (np.int32, np.int16, np.int32, np.float64, np.float64)]
+
+    # Se guarda la instantánea nueva y se borran las anteriores del mismo filtro (y las de antes de haber filtros)
+    if os.path.isdir(ruta_instantaneas_analisis()):
+        for nombre in os.listdir(ruta_instantaneas_analisis()):
+            filtro = (nombre.split("_") + [""])[1]  # Las de antes de haber filtros llevan aquí el id máximo
+            if filtro == etiqueta or filtro.isdigit():
+                shutil.rmtree(os.path.join(ruta_instantaneas_analisis(), nombre), ignore_errors=True)
+    os.makedirs(directorio, exist_ok=True)
+    for nombre, valores in zip(nombres, arrays):
+        np.save(os.path.join(directorio, f"{nombre}.npy"), valores)
+    datos = {"productos": list(productos), "tipos": list(tipos)}
+    with open(os.path.join(directorio, "diccionarios.json"), "w", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False)
+
+    datos.update(zip(nombres, arrays))
+    return datos
+
+
+def mascara_ventas(datos):
+    """Filas del historial que son ventas (excluye otros movimientos)."""
+    codigos = [i for i, tipo in enumerate(datos["tipos"]) if tipo in TIPOS_VENTA]
+    return np.isin(datos["tipo"], codigos)
+
+
+def clasificacion_abc(datos):
+    """Clasificación ABC de productos por ingresos. Devuelve filas (producto, ingresos, unidades, % acumulado, clase)."""
+    ventas = mascara_ventas(datos)
+    num_productos = len(datos["productos"])
+    ingresos = np.bincount(datos["producto"][ventas], weights=datos["total"][ventas], minlength=num_productos)
+    unidades = np.bincount(datos["producto"][ventas], weights=datos["cantidad"][ventas], minlength=num_productos)
+
+    orden = np.argsort(-ingresos, kind="stable")
+    orden = orden[ingresos[orden] > 0]
+    total = ingresos[orden].sum()
+    acumulado = np.cumsum(ingresos[orden]) / total if total else np.zeros(len(orden))
+    # Un producto es A si antes de sumarlo no se había llegado al límite (así el primero siempre es A)
+    previo = acumulado - (ingresos[orden] / total if total else 0)
+    clases = np.where(previo < LIMITE_CLASE_A, "A", np.where(previo < LIMITE_CLASE_B, "B", "C"))
+
+    return [(datos["productos"][i], float(ingresos[i]), float(unidades[i]), float(a) * 100, str(c))
+            for i, a, c in zip(orden, acumulado, clases)]
+
+
+def iva_por_dia(dias, cursor):
+    """IVA vigente cada día, según el guardado con las facturas emitidas (los tickets no lo guardan).
+
+    Cada día toma el de la última factura emitida hasta ese día; los anteriores a la primera, el de
+    esa primera. Sin facturas se usa el de los ajustes.
+    """
+    cursor.execute("SELECT dia, iva FROM facturas WHERE dia IS NOT NULL AND iva IS NOT NULL ORDER BY dia, id_factura")
+    cambios = cursor.fetchall()
+    if not cambios:
+        return np.full(len(dias), ajuste("iva"), dtype=np.float64)
+    dias_cambio = np.array([dia for dia, _ in cambios], dtype=np.int64)
+    tipos = np.array([iva for _, iva in cambios], dtype=np.float64)
+    return tipos[np.maximum(np.searchsorted(dias_cambio, dias, side="right") - 1, 0)]
+
+
+def margen_por_familia(datos, iva=None):
+    """Ingresos sin IVA, coste y margen por familia. Los productos sin coste conocido se cuentan aparte.
+
+    Sin iva, cada venta se descuenta con el IVA vigente su día (iva_por_dia).
+    """
     conn = conectar_db()
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO clientes (identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion, codigo_postal, poblacion, provincia, pais, telefono) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion, codigo_postal, poblacion, provincia, pais, telefono))
-    conn.commit()
+        SELECT p.nombre, COALESCE(f.nombre, 'Sin familia'), p.coste FROM productos p
+        LEFT JOIN familias f ON f.id_familia = p.id_familia
+    ''')
+    catalogo = {nombre: (familia, coste) for nombre, familia, coste in cursor.fetchall()}
+    ventas = mascara_ventas(datos)
+    # IVA incluido en los precios de venta del historial
+    iva = iva_por_dia(datos["dia"][ventas], cursor) if iva is None else iva
     conn.close()
 
-def obtener_clientes():
-    """Obtiene todos los clientes de la base de datos."""
-    conn = conectar_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM clientes")
-    clientes = cursor.fetchall()
-    conn.close()
-    return clientes
+    # Por cada código de producto del historial: código de familia y coste unitario (NaN si no se conoce)
+    familias = {}
+    familia_producto = np.array([familias.setdefault(catalogo.get(p, ("Sin familia", None))[0], len(familias))
+                                 for p in datos["productos"]], dtype=np.int32)
+    coste_producto = np.array([np.nan if catalogo.get(p, (None, None))[1] is None else catalogo[p][1]
+                               for p in datos["productos"]], dtype=np.float64)
+
+    productos_venta = datos["producto"][ventas]
+    cod_familia = familia_producto[productos_venta]
+    ingresos_sin_iva = datos["total"][ventas] / (1 + iva / 100)
+    costes = datos["cantidad"][ventas] * coste_producto[productos_venta]
+    con_coste = ~np.isnan(costes)
+
+    n = len(familias)
+    ingresos = np.bincount(cod_familia, weights=ingresos_sin_iva, minlength=n)
+    ingresos_con_coste = np.bincount(cod_familia[con_coste], weights=ingresos_sin_iva[con_coste], minlength=n)
+    coste_total = np.bincount(cod_familia[con_coste], weights=costes[con_coste], minlength=n)
+    margen = ingresos_con_coste - coste_total
+
+    resultado = []
+    for familia, i in sorted(familias.items()):
+        porcentaje = margen[i] / ingresos_con_coste[i] * 100 if ingresos_con_coste[i] else 0.0
+        resultado.append((familia, float(ingresos[i]), float(coste_total[i]), float(margen[i]), float(porcentaje),
+                          float(ingresos[i] - ingresos_con_coste[i])))
+    return resultado
+
+
+def estacionalidad(datos):
+    """Ingresos por año y mes. Devuelve (años, matriz años x 12)."""
+    ventas = mascara_ventas(datos)
+    fechas = datos["dia"][ventas].astype("datetime64[D]")
+    años = fechas.astype("datetime64[Y]").astype(np.int64) + 1970
+    meses = fechas.astype("datetime64[M]").astype(np.int64) % 12
+    if len(años) == 0:
+        return [], np.zeros((0, 12))
+    año_min = int(años.min())
+    num_años = int(años.max()) - año_min + 1
+    matriz = np.bincount((años - año_min) * 12 + meses, weights=datos["total"][ventas],
+                         minlength=num_años * 12).reshape(num_años, 12)
+    return list(range(año_min, año_min + num_años)), matriz
+
+
+def exportar_analisis(directorio, abc, margenes, años, matriz):
+    """Exporta los resultados del análisis a tres CSV (separador ';' para Excel en español). Devuelve las rutas."""
+    rutas = []
+    tablas = (
+        ("analisis_abc.csv", ["Producto", "Ingresos", "Unidades", "% acumulado", "Clase"], abc),
+        ("analisis_margenes.csv", ["Familia", "Ingresos sin IVA", "Coste", "Margen", "% margen", "Ingresos sin coste"], margenes),
+        ("analisis_estacionalidad.csv", ["Año"] + MESES,
+         [[año] + [round(float(v), 2) for v in fila] for año, fila in zip(años, matriz)]),
+    )
+    for nombre, cabecera, filas in tablas:
+        ruta = os.path.join(directorio, nombre)
+        with open(ruta, "w", newline="", encoding="utf-8-sig") as f:
+            escritor = csv.writer(f, delimiter=";")
+            escritor.writerow(cabecera)
+            escritor.writerows(filas)
+        rutas.append(ruta)
+    return rutas
+
+
+# =================== PRUEBA DE CARGA =================== #
+OPERACIONES_PRUEBA = ("escaneo", "cobro", "busqueda", "informe")
+MODOS_DIARIO = ("delete", "truncate", "persist", "wal")
+MODOS_SINCRONIZACION = ("off", "normal", "full")
+
+
+class ConexionReutilizada:
+    """Conexión única de un proceso para todas las llamadas: close() solo deshace lo que no se haya confirmado."""
+
+    def __init__(self, conexion):
+        self.conexion = conexion
+
+    def __getattr__(self, nombre):
+        return getattr(self.conexion, nombre)
+
+    def __enter__(self):
+        return self.conexion.__enter__()
+
+    def __exit__(self, *excepcion):
+        return self.conexion.__exit__(*excepcion)
+
+    def close(self):
+        self.conexion.rollback()
+
+
+def preparar_conexiones_prueba(estrategia="por-llamada", espera=5.0, diario=None, sincronizacion=None):
+    """Cambia conectar_db en un proceso de prueba.
+
+    'por-llamada' abre una conexión en cada función, como el programa; 'persistente' reutiliza
+    una sola por proceso. diario y sincronizacion se aplican con PRAGMA a cada conexión abierta.
+    """
+    global conectar_db
+
+    def abrir():
+        conexion = sqlite3.connect(ruta_base_datos(), timeout=espera)
+        if diario:
+            conexion.execute(f"PRAGMA journal_mode={diario}")
+        if sincronizacion:
+            conexion.execute(f"PRAGMA synchronous={sincronizacion}")
+        return conexion
+
+    if estrategia == "persistente":
+        compartida = ConexionReutilizada(abrir())
+        conectar_db = lambda: compartida
+    else:
+        conectar_db = abrir
+
+
+def ticket_por_lineas(lineas, fecha):
+    """Cobra un ticket igual que generar_ticket: número aparte y una conexión y un commit por cada paso."""
+    id_ticket = generar_id_factura()
+    for _, nombre, cantidad, precio, total in lineas:
+        registrar_transaccion(id_ticket, 'Ticket', nombre, cantidad, precio, total, fecha)
+        conn = conectar_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM productos WHERE nombre=?", (nombre,))
+        producto_id = cursor.fetchone()[0]
+        conn.close()
+        actualizar_stock(producto_id, cantidad)
+    return id_ticket
 
-def eliminar_cliente(id_cliente):
-    """Elimina un cliente de la base de datos por su ID."""
+
+def preparar_base_prueba(productos=2000, clientes=200):
+    """Rellena la base de prueba con productos y clientes ficticios si no tiene catálogo."""
     conn = conectar_db()
     cursor = conn.cursor()
-    cursor.execute('DELETE FROM clientes WHERE id_cliente=?', (id_cliente,))
-    conn.commit()
+    cursor.execute("SELECT COUNT(*) FROM productos")
+    if cursor.fetchone()[0] < 10:
+        cursor.executemany("INSERT INTO productos (nombre, codigo, descripcion, precio, cantidad, coste) VALUES (?, ?, '', ?, 1000000, ?)",
+                           ((f"Prueba {i:05d}", f"PC{i:06d}", round(0.5 + i % 97, 2), round((0.5 + i % 97) * 0.6, 2)) for i in range(productos)))
+        cursor.executemany("INSERT INTO clientes (identificacion_fiscal, nombre_fiscal, direccion) VALUES (?, ?, '')",
+                           ((f"{i:08d}P", f"Cliente prueba {i:04d}") for i in range(clientes)))
+        conn.commit()
     conn.close()
 
 
+def terminal_de_prueba(numero, opciones, barrera, salida):
+    """Proceso de una caja simulada: escanea líneas, cobra y de vez en cuando busca o saca un informe.
+
+    Envía por salida las latencias en milisegundos de cada operación, los fallos por base de datos
+    bloqueada, los demás errores y los números de documento cobrados.
+    """
+    resultado = {"terminal": numero, "latencias": {operacion: [] for operacion in OPERACIONES_PRUEBA},
+                 "bloqueos": dict.fromkeys(OPERACIONES_PRUEBA, 0), "errores": dict.fromkeys(OPERACIONES_PRUEBA, 0),
+                 "mensajes": {}, "documentos": [], "segundos": 0.0, "fallo": None}
+    aleatorio = random.Random(opciones["semilla"] * 1000 + numero)
+
+    def medir(operacion, funcion, *args):
+        inicio = time.perf_counter()
+        try:
+            valor = funcion(*args)
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                resultado["bloqueos"][operacion] += 1
+            else:
+                resultado["errores"][operacion] += 1
+                resultado["mensajes"].setdefault(operacion, str(e))
+            return None
+        except Exception as e:
+            resultado["errores"][operacion] += 1
+            resultado["mensajes"].setdefault(operacion, repr(e))
+            return None
+        resultado["latencias"][operacion].append((time.perf_counter() - inicio) * 1000)
+        return valor
+
+    def pausar():
+        if opciones["pausa_ms"]:
+            time.sleep(aleatorio.uniform(0.5, 1.5) * opciones["pausa_ms"] / 1000)
+
+    try:
+        preparar_conexiones_prueba(opciones["conexion"], opciones["espera"], opciones["diario"], opciones["sincronizacion"])
+        # El catálogo se lee una vez al arrancar la caja, fuera de la medición
+        catalogo = [(producto[0], producto[1], producto[2]) for producto in obtener_productos()]
+        clientes = [cliente[0] for cliente in obtener_clientes()]
+        desde_informe = (date.today() - timedelta(days=7)).strftime("%Y-%m-%d")
+        barrera.wait()
+        inicio = time.perf_counter()
+        fin = inicio + opciones["duracion"]
+        while time.perf_counter() < fin:
+            id_cliente = aleatorio.choice(clientes) if clientes and aleatorio.random() < 0.2 else None
+            lineas = []
+            for _ in range(aleatorio.randint(1, opciones["lineas"])):
+                id_producto, nombre, _ = aleatorio.choice(catalogo)
+                precio = medir("escaneo", precio_para_cliente, id_producto, id_cliente)
+                if precio is not None:
+                    cantidad = aleatorio.randint(1, 3)
+                    lineas.append((id_producto, nombre, cantidad, precio, round(cantidad * precio, 2)))
+                pausar()
+            if lineas:
+                fecha = datetime.now().strftime(FORMATO_FECHA)
+                if opciones["cobro"] == "transaccion":
+                    id_documento = medir("cobro", registrar_venta, lineas, "Ticket", "", None, fecha)
+                else:
+                    id_documento = medir("cobro", ticket_por_lineas, lineas, fecha)
+                if id_documento is not None:
+                    resultado["documentos"].append(id_documento)
+            if aleatorio.random() < opciones["busquedas"]:
+                if aleatorio.random() < 0.5:
+                    medir("busqueda", buscar_ventas_por_codigo, aleatorio.choice(catalogo)[2])
+                else:
+                    medir("busqueda", obtener_facturas, "", aleatorio.choice(catalogo)[1])
+            if aleatorio.random() < opciones["informes"]:
+                medir("informe", obtener_historial, desde_informe)
+            pausar()
+        resultado["segundos"] = time.perf_counter() - inicio
+    except threading.BrokenBarrierError:
+        resultado["fallo"] = "Otra caja no pudo arrancar"
+    except Exception as e:
+        barrera.abort()
+        resultado["fallo"] = repr(e)
+    salida.put(resultado)
+
+
+def prueba_de_carga(terminales=4, duracion=30.0, conexion="por-llamada", diario=None, sincronizacion=None, espera=5.0,
+                    cobro="lineas", lineas=10, busquedas=0.2, informes=0.05, pausa_ms=0, productos=2000, base=None, semilla=1):
+    """Lanza varias cajas simuladas, cada una en su proceso, contra la misma base de datos.
+
+    Sin base se trabaja sobre una copia temporal de la base de la tienda (con catálogo ficticio si
+    está vacía), así que la prueba no deja ventas en la real. Devuelve un diccionario con la
+    configuración, el rendimiento y los percentiles de cada operación.
+    """
+    opciones = {"terminales": terminales, "duracion": duracion, "conexion": conexion, "diario": diario,
+                "sincronizacion": sincronizacion, "espera": espera, "cobro": cobro, "lineas": max(1, lineas),
+                "busquedas": busquedas, "informes": informes, "pausa_ms": pausa_ms, "semilla": semilla}
+    ruta_original = os.environ.get("FERRETERIA_DB")
+    directorio = None
+    try:
+        if base is None:
+            directorio = tempfile.mkdtemp(prefix="prueba_carga_")
+            ruta = os.path.join(directorio, "carga.db")
+            if os.path.exists(ruta_base_datos()):
+                origen = sqlite3.connect(ruta_base_datos())
+                destino = sqlite3.connect(ruta)
+                origen.backup(destino)
+                destino.close()
+                origen.close()
+        else:
+            ruta = base
+        os.environ["FERRETERIA_DB"] = ruta
+        crear_tablas()
+        preparar_base_prueba(productos)
+        if diario == "wal":  # WAL queda guardado en el archivo; los demás modos se ponen en cada conexión
+            conn = sqlite3.connect(ruta)
+            conn.execute("PRAGMA journal_mode=wal")
+            conn.close()
+
+        barrera = multiprocessing.Barrier(terminales + 1)
+        salida = multiprocessing.Queue()
+        procesos = [multiprocessing.Process(target=terminal_de_prueba, args=(numero, opciones, barrera, salida), daemon=True)
+                    for numero in range(terminales)]
+        for proceso in procesos:
+            proceso.start()
+        try:
+            barrera.wait()
+        except threading.BrokenBarrierError:
+            pass
+        resultados = [salida.get() for _ in procesos]
+        for proceso in procesos:
+            proceso.join()
+    finally:
+        if ruta_original is None:
+            os.environ.pop("FERRETERIA_DB", None)
+        else:
+            os.environ["FERRETERIA_DB"] = ruta_original
+        if directorio:
+            shutil.rmtree(directorio, ignore_errors=True)
+    return resumen_prueba_carga(opciones, resultados)
+
+
+def resumen_prueba_carga(opciones, resultados):
+    """Junta los resultados de todas las cajas: operaciones por segundo, p50/p95/p99, bloqueos y errores."""
+    segundos = max((resultado["segundos"] for resultado in resultados), default=0.0) or opciones["duracion"]
+    operaciones = {}
+    for operacion in OPERACIONES_PRUEBA + ("total",):
+        nombres = OPERACIONES_PRUEBA if operacion == "total" else (operacion,)
+        muestras = [latencia for resultado in resultados for nombre in nombres for latencia in resultado["latencias"][nombre]]
+        operaciones[operacion] = {
+            "total": len(muestras),
+            "por_segundo": len(muestras) / segundos,
+            "p50_ms": percentil(muestras, 50),
+            "p95_ms": percentil(muestras, 95),
+            "p99_ms": percentil(muestras, 99),
+            "max_ms": max(muestras, default=0.0),
+            "bloqueos": sum(resultado["bloqueos"][nombre] for resultado in resultados for nombre in nombres),
+            "errores": sum(resultado["errores"][nombre] for resultado in resultados for nombre in nombres),
+        }
+    # Con el cobro por líneas dos cajas pueden llevarse el mismo número de documento
+    documentos = [id_documento for resultado in resultados for id_documento in resultado["documentos"]]
+    mensajes = {}
+    for resultado in resultados:
+        for operacion, mensaje in resultado["mensajes"].items():
+            mensajes.setdefault(operacion, mensaje)
+    return {
+        "opciones": opciones,
+        "segundos": segundos,
+        "operaciones": operaciones,
+        "documentos_repetidos": len(documentos) - len(set(documentos)),
+        "mensajes": mensajes,
+        "fallos": [f"Caja {resultado['terminal']}: {resultado['fallo']}" for resultado in resultados if resultado["fallo"]],
+    }
+
+
+# =================== SELECTOR DE FECHAS =================== #
+MESES = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
+
+
+def abrir_calendario(entry):
+    """Abre un calendario emergente y escribe la fecha elegida (YYYY-MM-DD) en el campo indicado."""
+    fecha_inicial = interpretar_fecha(entry.get())
+    actual = (fecha_inicial or datetime.now()).date().replace(day=1)
+
+    ventana_cal = tk.Toplevel(entry)
+    ventana_cal.title("Seleccionar fecha")
+    ventana_cal.transient(entry.winfo_toplevel())
+    ventana_cal.grab_set()
+
+    cabecera = tk.Frame(ventana_cal)
+    cabecera.pack(pady=5)
+    etiqueta_mes = tk.Label(cabecera, width=18)
+    dias_frame = tk.Frame(ventana_cal)
+    dias_frame.pack(padx=5, pady=5)
+
+    def elegir(dia):
+        entry.delete(0, tk.END)
+        entry.insert(0, actual.replace(day=dia).strftime("%Y-%m-%d"))
+        ventana_cal.destroy()
+
+    def pintar_mes():
+        etiqueta_mes.config(text=f"{MESES[actual.month - 1]} {actual.year}")
+        for widget in dias_frame.winfo_children():
+            widget.destroy()
+        for columna, nombre in enumerate(["Lu", "Ma", "Mi", "Ju", "Vi", "Sá", "Do"]):
+            tk.Label(dias_frame, text=nombre).grid(row=0, column=columna)
+        for fila, semana in enumerate(calendar.monthcalendar(actual.year, actual.month), start=1):
+            for columna, dia in enumerate(semana):
+                if dia:
+                    tk.Button(dias_frame, text=str(dia), width=3, command=lambda d=dia: elegir(d)).grid(row=fila, column=columna)
+
+    def cambiar_mes(delta):
+        nonlocal actual
+        mes = actual.month - 1 + delta
+        actual = actual.replace(year=actual.year + mes // 12, month=mes % 12 + 1)
+        pintar_mes()
+
+    tk.Button(cabecera, text="<", command=lambda: cambiar_mes(-1)).pack(side="left")
+    etiqueta_mes.pack(side="left")
+    tk.Button(cabecera, text=">", command=lambda: cambiar_mes(1)).pack(side="left")
+    pintar_mes()
+
+
+def crear_selector_rango(frame, fila, al_cambiar=None):
+    """Crea los campos Desde/Hasta con calendario y rangos predefinidos. Devuelve una función que lee (desde, hasta)."""
+    tk.Label(frame, text="Desde (YYYY-MM-DD):").grid(row=fila, column=0)
+    entry_desde = tk.Entry(frame)
+    entry_desde.grid(row=fila, column=1)
+    tk.Button(frame, text="📅", command=lambda: abrir_calendario(entry_desde)).grid(row=fila, column=2)
+
+    tk.Label(frame, text="Hasta (YYYY-MM-DD):").grid(row=fila + 1, column=0)
+    entry_hasta = tk.Entry(frame)
+    entry_hasta.grid(row=fila + 1, column=1)
+    tk.Button(frame, text="📅", command=lambda: abrir_calendario(entry_hasta)).grid(row=fila + 1, column=2)
+
+    combo_rango = ttk.Combobox(frame, state="readonly", width=18,
+                               values=["Hoy", "Últimos 7 días", "Este mes", "Mes anterior", "Último trimestre", "Este año"])
+    combo_rango.grid(row=fila, column=3, rowspan=2, padx=5)
+
+    def aplicar_rango(event=None):
+        desde, hasta = rango_predefinido(combo_rango.get())
+        for entry, valor in ((entry_desde, desde), (entry_hasta, hasta)):
+            entry.delete(0, tk.END)
+            if valor:
+                entry.insert(0, valor.strftime("%Y-%m-%d"))
+        if al_cambiar:
+            al_cambiar()
+
+    combo_rango.bind("<<ComboboxSelected>>", aplicar_rango)
+
+    def leer_rango():
+        desde = entry_desde.get().strip() or None
+        hasta = entry_hasta.get().strip() or None
+        for valor in (desde, hasta):
+            if valor and interpretar_fecha(valor) is None:
+                raise ValueError(f"Fecha no válida: {valor}")
+        return desde, hasta
+
+    return leer_rango
+
+
+def crear_selector_tienda(frame, fila, al_cambiar=None):
+    """Crea el desplegable de tienda. Devuelve una función que lee la tienda elegida (como en obtener_historial)."""
+    opciones = {"Esta tienda": None, "Todas las tiendas": TODAS_LAS_TIENDAS}
+    tk.Label(frame, text="Tienda:").grid(row=fila, column=0)
+    # Las tiendas se consultan al abrir el desplegable: pueden llegar ventas de una nueva al sincronizar
+    combo_tienda = ttk.Combobox(frame, state="readonly", width=34,
+                                postcommand=lambda: combo_tienda.configure(values=list(opciones) + tiendas_historial()))
+    combo_tienda.set("Esta tienda")
+    combo_tienda.grid(row=fila, column=1)
+    if al_cambiar:
+        combo_tienda.bind("<<ComboboxSelected>>", lambda event: al_cambiar())
+
+    def leer_tienda():
+        elegida = combo_tienda.get()
+        return opciones[elegida] if elegida in opciones else elegida
+
+    return leer_tienda
+
+
+# =================== ACTUALIZACIÓN DE TABLAS =================== #
+INTERVALO_AVISOS_MS = 100  # Cada cuánto entrega la interfaz los avisos del bus
+
+
+def actualizar_filas(tree, filas, al_principio=False, valores=None):
+    """Actualiza en su sitio las filas de un Treeview cuyo iid es el ID (primera columna) e inserta las que falten."""
+    for fila in filas:
+        iid = str(fila[0])
+        datos = valores(fila) if valores else fila
+        if tree.exists(iid):
+            tree.item(iid, values=datos)
+        else:
+            tree.insert('', 0 if al_principio else 'end', iid=iid, values=datos)
+
+
+def quitar_filas(tree, ids):
+    """Quita de un Treeview las filas de esos IDs que estén a la vista."""
+    presentes = [str(i) for i in ids if tree.exists(str(i))]
+    if presentes:
+        tree.delete(*presentes)
+
+
+# =================== VENTANA DE COLA DE IMPRESIÓN =================== #
+def abrir_cola_impresion(ventana):
+    """Muestra los trabajos de impresión y permite reintentar los fallidos."""
+    ventana_cola = tk.Toplevel(ventana)
+    ventana_cola.title(f"Cola de impresión de {nombre_caja()}")
+    ventana_cola.geometry("800x400")
+
+    columnas_cola = ('ID', 'Documento', 'Formato', 'Destino', 'Estado', 'Intentos', 'Error', 'Creado')
+    tree_cola = ttk.Treeview(ventana_cola, columns=columnas_cola, show='headings')
+    for col in columnas_cola:
+        tree_cola.heading(col, text=col)
+        tree_cola.column(col, width=60 if col in ('ID', 'Formato', 'Intentos') else 120)
+    tree_cola.pack(expand=True, fill='both')
+
+    def cargar_cola():
+        tree_cola.delete(*tree_cola.get_children())
+        for trabajo in obtener_cola_impresion():
+            tree_cola.insert('', 'end', values=trabajo)
+
+    def reintentar_seleccionado():
+        selected_item = tree_cola.selection()
+        if not selected_item:
+            messagebox.showwarning("Error", "Por favor, selecciona un trabajo para reintentar.", parent=ventana_cola)
+            return
+        reintentar_impresion(tree_cola.item(selected_item[0], 'values')[0])
+        cargar_cola()
+
+    botones = tk.Frame(ventana_cola)
+    botones.pack(pady=5)
+    tk.Button(botones, text="Actualizar", command=cargar_cola).pack(side="left", padx=5)
+    tk.Button(botones, text="Reintentar", command=reintentar_seleccionado).pack(side="left", padx=5)
+    cargar_cola()
+
+
+# =================== VENTANA DE COHERENCIA DE LOS DATOS =================== #
+def abrir_comprobacion_integridad(ventana):
+    """Muestra el resultado de las comprobaciones de integridad y permite reparar lo que se puede reparar."""
+    ventana_integridad = tk.Toplevel(ventana)
+    ventana_integridad.title("Comprobación de integridad")
+    ventana_integridad.geometry("800x400")
+
+    columnas_integridad = ('Comprobación', 'Encontrados', 'Reparable', 'Ejemplos')
+    tree_integridad = ttk.Treeview(ventana_integridad, columns=columnas_integridad, show='headings')
+    for col in columnas_integridad:
+        tree_integridad.heading(col, text=col)
+        tree_integridad.column(col, width=80 if col in ('Encontrados', 'Reparable') else 300)
+    tree_integridad.pack(expand=True, fill='both')
+    etiqueta_estado = tk.Label(ventana_integridad, text="")
+    etiqueta_estado.pack(pady=5)
+    reparables = {clave for clave, _, _, reparaciones in COMPROBACIONES_COHERENCIA if reparaciones}
+    resultado = []
+
+    def comprobar(reparar=False):
+        def trabajo():
+            try:
+                resultado.append((comprobar_coherencia(reparar), None))
+            except sqlite3.Error as e:
+                resultado.append((None, e))
+
+        etiqueta_estado.config(text="Reparando..." if reparar else "Comprobando...")
+        boton_reparar.config(state="disabled")
+        threading.Thread(target=trabajo, name="integridad", daemon=True).start()
+        ventana_integridad.after(200, mostrar)
+
+    def mostrar():
+        if not resultado:
+            ventana_integridad.after(200, mostrar)
+            return
+        resultados, error = resultado.pop()
+        if error:
+            etiqueta_estado.config(text=f"Error: {error}")
+            return
+        tree_integridad.delete(*tree_integridad.get_children())
+        pendientes = 0
+        for clave, descripcion, filas, reparada in resultados:
+            ejemplos = "; ".join(f"{referencia} {detalle}".strip() for referencia, detalle in filas[:5])
+            tree_integridad.insert('', 'end', values=(descripcion, len(filas),
+                                                      "Reparado" if reparada else ("Sí" if clave in reparables else "No"), ejemplos))
+            if filas and not reparada and clave in reparables:
+                pendientes += 1
+        problemas = sum(1 for _, _, filas, reparada in resultados if filas and not reparada)
+        etiqueta_estado.config(text=f"{problemas} comprobaciones con problemas" if problemas else "Sin problemas pendientes")
+        boton_reparar.config(state="normal" if pendientes else "disabled")
+
+    def reparar():
+        if messagebox.askyesno("Reparar", "Se repararán en una sola operación los problemas marcados como reparables. ¿Continuar?",
+                               parent=ventana_integridad):
+            comprobar(reparar=True)
+
+    botones = tk.Frame(ventana_integridad)
+    botones.pack(pady=5)
+    tk.Button(botones, text="Comprobar", command=comprobar).pack(side="left", padx=5)
+    boton_reparar = tk.Button(botones, text="Reparar", command=reparar, state="disabled")
+    boton_reparar.pack(side="left", padx=5)
+    comprobar()
+
+
+# =================== VENTANA DE AJUSTES =================== #
+ETIQUETAS_AJUSTES = (
+    ("nombre", "Nombre de la tienda"),
+    ("nif", "NIF"),
+    ("direccion", "Dirección"),
+    ("codigo_postal", "Código postal"),
+    ("poblacion", "Población"),
+    ("provincia", "Provincia"),
+    ("telefono", "Teléfono"),
+    ("email", "Email"),
+    ("iva", "IVA (%)"),
+    ("serie_factura", "Serie de facturas"),
+    ("serie_rectificativa", "Serie de rectificativas"),
+    ("serie_albaran", "Serie de albaranes"),
+    ("serie_ticket", "Serie de tickets"),
+    ("impresora_tickets", "Impresora de tickets"),
+    ("salida", "Carpeta de documentos"),
+    ("sincronizacion", "Sincronización (carpeta o host:puerto)"),
+    ("clave_sincronizacion", "Clave de sincronización por red"),
+)
+PIES_AJUSTES = (("pie_factura", "Pie de factura"), ("pie_albaran", "Pie de albarán"), ("pie_ticket", "Pie de ticket"))
+
+
+def abrir_ajustes(ventana):
+    """Permite cambiar los datos de la tienda, el IVA, las series y los pies de los documentos."""
+    ventana_ajustes = tk.Toplevel(ventana)
+    ventana_ajustes.title(f"Ajustes de la tienda {ajuste('tienda')}")
+    valores = recargar_ajustes()
+
+    frame_campos = tk.Frame(ventana_ajustes)
+    frame_campos.pack(padx=10, pady=10)
+    campos = {}
+    for fila, (clave, etiqueta) in enumerate(ETIQUETAS_AJUSTES):
+        tk.Label(frame_campos, text=f"{etiqueta}:").grid(row=fila, column=0, sticky="e")
+        entry = tk.Entry(frame_campos, width=50, show="*" if clave == "clave_sincronizacion" else "")
+        entry.insert(0, str(valores[clave]))
+        entry.grid(row=fila, column=1, sticky="w")
+        campos[clave] = entry
+    for fila, (clave, etiqueta) in enumerate(PIES_AJUSTES, start=len(ETIQUETAS_AJUSTES)):
+        tk.Label(frame_campos, text=f"{etiqueta}:").grid(row=fila, column=0, sticky="ne")
+        texto = tk.Text(frame_campos, width=60, height=3)
+        texto.insert("1.0", valores[clave])
+        texto.grid(row=fila, column=1, sticky="w", pady=2)
+        campos[clave] = texto
+
+    def guardar():
+        nuevos = {}
+        for clave, campo in campos.items():
+            valor = campo.get("1.0", "end-1c") if isinstance(campo, tk.Text) else campo.get().strip()
+            if str(valores[clave]) != valor:
+                nuevos[clave] = valor
+        if not nuevos:
+            ventana_ajustes.destroy()
+            return
+        try:
+            guardar_ajustes(nuevos)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e), parent=ventana_ajustes)
+            return
+        messagebox.showinfo("Ajustes", "Ajustes guardados. Se aplican a los próximos documentos.", parent=ventana_ajustes)
+        ventana_ajustes.destroy()
+
+    tk.Label(ventana_ajustes, text=f"Archivo de configuración: {ruta_configuracion()}\nBase de datos: {valores['base_datos']}",
+             justify="left").pack(padx=10, anchor="w")
+    tk.Button(ventana_ajustes, text="Guardar", command=guardar).pack(pady=10)
+
 
 # =================== INTERFAZ GRÁFICA =================== #
 def crear_ventana_principal():
     """Crea la ventana principal de la aplicación."""
     crear_tablas()
+    iniciar_hilo_impresion()
+    diario_carritos = DiarioCarritos()
     ventana = ThemedTk(theme="breeze")  # Puedes probar otros temas como 'arc', 'clam', etc.
-    ventana.title("Sistema de Facturación Profesional")
+    ventana.title(f"Sistema de Facturación Profesional - {ajuste('nombre')} ({ajuste('tienda')})")
     ventana.geometry("1024x768")
     style = ttk.Style()
     style.configure("TButton", padding=8, font=('Arial', 12, 'bold'), background='#4CAF50', foreground='white')
@@ -253,9 +4946,39 @@ def crear_ventana_principal():
     ventana.config(menu=menu_bar)
 
     file_menu = tk.Menu(menu_bar, tearoff=0)
+    file_menu.add_command(label="Cola de impresión", command=lambda: abrir_cola_impresion(ventana))
+    file_menu.add_command(label="Archivar ejercicios cerrados", command=lambda: archivar_ejercicios_cerrados())
+    file_menu.add_command(label="Copia de seguridad ahora", command=lambda: copia_seguridad())
+    file_menu.add_command(label="Restaurar copia de seguridad...", command=lambda: restaurar_copia_seleccionada())
+    file_menu.add_command(label="Exportar factura electrónica...", command=lambda: exportar_factura_electronica())
+    file_menu.add_command(label="Sincronizar tiendas", command=lambda: sincronizar_tiendas())
+    file_menu.add_command(label="Comprobar integridad de los datos...", command=lambda: abrir_comprobacion_integridad(ventana))
+    file_menu.add_command(label="Ajustes de la tienda...", command=lambda: abrir_ajustes(ventana))
+    file_menu.add_separator()
     file_menu.add_command(label="Salir", command=ventana.quit)
     menu_bar.add_cascade(label="Archivo", menu=file_menu)
 
+    # Cambiar de tienda reinicia el programa con la base de datos y los directorios de la otra tienda
+    cambio_tienda = {"nombre": None}
+    tiendas = tiendas_configuradas()
+    if len(tiendas) > 1:
+        tienda_menu = tk.Menu(menu_bar, tearoff=0)
+        tienda_elegida = tk.StringVar(value=ajuste("tienda"))
+
+        def cambiar_tienda():
+            nombre = tienda_elegida.get()
+            if nombre == ajuste("tienda"):
+                return
+            if not messagebox.askyesno("Cambiar de tienda", f"Se reiniciará el programa con la tienda {nombre}. ¿Continuar?"):
+                tienda_elegida.set(ajuste("tienda"))
+                return
+            cambio_tienda["nombre"] = nombre
+            ventana.destroy()
+
+        for nombre in tiendas:
+            tienda_menu.add_radiobutton(label=nombre, variable=tienda_elegida, value=nombre, command=cambiar_tienda)
+        menu_bar.add_cascade(label="Tienda", menu=tienda_menu)
+
     help_menu = tk.Menu(menu_bar, tearoff=0)
     help_menu.add_command(label="Acerca de", command=lambda: messagebox.showinfo("Acerca de", "Sistema de Facturación Profesional v2.0"))
     menu_bar.add_cascade(label="Ayuda", menu=help_menu)
@@ -266,6 +4989,103 @@ def crear_ventana_principal():
     def update_status(text):
         status_bar.config(text=text)
 
+    bus_eventos.suscribir(EVENTO_MENSAJE, update_status)
+
+    def exportar_factura_electronica():
+        """Exporta las facturas de un mes en Facturae y los registros Verifactu encadenados."""
+        mes_anterior = date.today().replace(day=1) - timedelta(days=1)
+        periodo = simpledialog.askstring("Factura electrónica", "Mes a exportar (YYYY-MM):", initialvalue=mes_anterior.strftime("%Y-%m"))
+        if not periodo:
+            return
+        rango = rango_fechas(periodo)
+        if not rango:
+            messagebox.showerror("Error", f"Periodo no válido: {periodo}")
+            return
+        directorio = filedialog.askdirectory(title="Carpeta de destino", initialdir=ruta_exportaciones())
+        if not directorio:
+            return
+        desde, hasta = (fecha_desde_dia(dia).isoformat() for dia in rango)
+        erroneos = verificar_cadena_registros()
+        if erroneos and not messagebox.askyesno("Factura electrónica",
+                                                f"La cadena de registros no cuadra en {len(erroneos)} facturas "
+                                                f"(primera: {erroneos[0]}). ¿Exportar de todos modos?"):
+            return
+        archivos_facturae = exportar_facturae(desde, hasta, directorio)
+        archivos_verifactu = exportar_verifactu(desde, hasta, directorio)
+        messagebox.showinfo("Factura electrónica", f"Generados {len(archivos_facturae)} archivos Facturae y "
+                                                   f"{len(archivos_verifactu)} de registros Verifactu en {directorio}")
+
+    def archivar_ejercicios_cerrados():
+        años = ejercicios_archivables()
+        if not años:
+            messagebox.showinfo("Archivo histórico", "No hay ejercicios cerrados pendientes de archivar.")
+            return
+        lista = ", ".join(str(a) for a in años)
+        if not messagebox.askyesno("Archivo histórico", f"Se moverán al archivo los ejercicios {lista}. ¿Continuar?"):
+            return
+        movidas = sum(archivar_ejercicio(a) for a in años)
+        update_status(f"Archivadas {movidas} líneas de historial ({lista}).")
+
+    resultado_sincronizacion = []
+
+    def sincronizar_tiendas():
+        """Sincroniza en segundo plano; las tablas se actualizan solas con los avisos de los cambios recibidos."""
+        if not ajuste("sincronizacion"):
+            messagebox.showinfo("Sincronización", "Indica la carpeta compartida o la tienda (host:puerto) en los ajustes.")
+            return
+
+        def trabajo():
+            try:
+                resultado_sincronizacion.append((sincronizar(), None))
+            except (OSError, ValueError, KeyError, TypeError, zlib.error, sqlite3.Error) as e:
+                resultado_sincronizacion.append((None, e))
+
+        update_status("Sincronizando con las demás tiendas...")
+        threading.Thread(target=trabajo, name="sincronizacion", daemon=True).start()
+        ventana.after(300, vigilar_sincronizacion)
+
+    def vigilar_sincronizacion():
+        if not resultado_sincronizacion:
+            ventana.after(300, vigilar_sincronizacion)
+            return
+        resultado, error = resultado_sincronizacion.pop()
+        if error:
+            update_status(f"Error al sincronizar: {error}")
+        else:
+            update_status(f"Sincronización terminada: {resultado[0]} cambios recibidos, {resultado[1]} enviados.")
+
+    resultado_copia = []
+
+    def copia_seguridad():
+        """Lanza la copia en segundo plano y vigila su final sin bloquear la caja."""
+        update_status("Copia de seguridad en curso...")
+        iniciar_copia_en_segundo_plano(lambda ruta, error: resultado_copia.append((ruta, error)))
+        ventana.after(500, vigilar_copia)
+
+    def vigilar_copia():
+        if not resultado_copia:
+            ventana.after(500, vigilar_copia)
+            return
+        ruta, error = resultado_copia.pop()
+        if error:
+            update_status(f"Error en la copia de seguridad: {error}")
+        else:
+            update_status(f"Copia de seguridad guardada: {ruta}")
+
+    def restaurar_copia_seleccionada():
+        ruta = filedialog.askopenfilename(title="Restaurar copia de seguridad", initialdir=ruta_copias_seguridad(),
+                                          filetypes=[("Copias de seguridad", "*.db.gz")])
+        if not ruta:
+            return
+        if not messagebox.askyesno("Restaurar copia", "Se sustituirán todos los datos actuales por los de la copia. ¿Continuar?"):
+            return
+        try:
+            restaurar_copia(ruta)
+        except sqlite3.DatabaseError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        messagebox.showinfo("Éxito", "Copia restaurada. Reinicia la aplicación para ver los datos restaurados.")
+
 
 
     # =================== PESTAÑA DE HISTORIAL DE FACTURAS =================== #
@@ -290,6 +5110,8 @@ def crear_ventana_principal():
     entry_fecha = tk.Entry(search_frame)
     entry_fecha.grid(row=2, column=1)
 
+    leer_rango_facturas = crear_selector_rango(search_frame, 3)
+
     # Tabla para mostrar facturas
     columnas_facturas = ('ID Factura', 'Cliente', 'Fecha', 'Total')
     tree_facturas = ttk.Treeview(tab_historial_facturas, columns=columnas_facturas, show='headings')
@@ -298,40 +5120,83 @@ def crear_ventana_principal():
         tree_facturas.column(col, width=150)
     tree_facturas.pack(expand=True, fill='both')
 
+    filtro_facturas = {}  # Filtro de la última búsqueda, para añadir las facturas nuevas que lo cumplan
+
     # Función de búsqueda
     def buscar_facturas():
         cliente = entry_cliente.get().strip()
         producto = entry_producto.get().strip()
         fecha = entry_fecha.get().strip()
+        try:
+            desde, hasta = leer_rango_facturas()
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
 
-        facturas = obtener_facturas(cliente, producto, fecha)
+        filtro_facturas.update(cliente=cliente, producto=producto, fecha=fecha, desde=desde, hasta=hasta)
+        facturas = obtener_facturas(**filtro_facturas)
 
         # Limpiar la tabla
         tree_facturas.delete(*tree_facturas.get_children())
 
         # Mostrar resultados
-        for factura in facturas:
-            tree_facturas.insert('', 'end', values=factura)
+        actualizar_filas(tree_facturas, facturas)
+
+    def refrescar_facturas(ids):
+        if filtro_facturas:
+            actualizar_filas(tree_facturas, reversed(obtener_facturas(**filtro_facturas, ids=ids)), al_principio=True)
+
+    bus_eventos.suscribir(EVENTO_FACTURA, refrescar_facturas)
 
     btn_buscar = tk.Button(search_frame, text="Buscar", command=buscar_facturas)
-    btn_buscar.grid(row=3, column=1, pady=10)
+    btn_buscar.grid(row=5, column=1, pady=10)
     
     
     # =================== PESTAÑA DE HISTORIAL =================== #
     tab_historial = ttk.Frame(notebook)
     notebook.add(tab_historial, text="Historial de Transacciones")
 
-    columnas_historial = ('ID Factura', 'Tipo', 'Producto', 'Cantidad', 'Precio', 'Total', 'Fecha')
+    filtro_historial_frame = tk.Frame(tab_historial)
+    filtro_historial_frame.pack(pady=10)
+
+    columnas_historial = ('ID Factura', 'Tipo', 'Producto', 'Cantidad', 'Precio', 'Total', 'Fecha', 'Tienda')
     tree_historial = ttk.Treeview(tab_historial, columns=columnas_historial, show='headings')
     for col in columnas_historial:
         tree_historial.heading(col, text=col)
         tree_historial.column(col, width=100 if col == 'ID Factura' else 150)
     tree_historial.pack(expand=True, fill='both')
 
+    filtro_historial = {}  # Rango y tienda mostrados, para añadir solo las líneas nuevas que cumplan el filtro
+
+    def valores_historial(transaccion):
+        # La última columna es la tienda de origen: vacía para las ventas de esta
+        return transaccion[:-1] + (transaccion[-1] or "",)
+
     def cargar_historial():
+        try:
+            desde, hasta = leer_rango_historial()
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        filtro_historial.update(desde=desde, hasta=hasta, tienda=leer_tienda_historial())
         tree_historial.delete(*tree_historial.get_children())
-        for transaccion in obtener_historial():
-            tree_historial.insert('', 'end', values=transaccion)
+        for transaccion in obtener_historial(**filtro_historial):
+            tree_historial.insert('', 'end', values=valores_historial(transaccion))
+
+    def añadir_lineas_historial(ids):
+        # Sin una carga previa no hay filtro que respetar: la primera carga ya las traerá
+        if not filtro_historial:
+            return
+        # El historial solo crece: las líneas nuevas van arriba, sin tocar las que ya están
+        for transaccion in reversed(obtener_historial(**filtro_historial, ids=ids)):
+            tree_historial.insert('', 0, values=valores_historial(transaccion))
+
+    bus_eventos.suscribir(EVENTO_HISTORIAL, añadir_lineas_historial)
+
+    leer_rango_historial = crear_selector_rango(filtro_historial_frame, 0, al_cambiar=cargar_historial)
+    leer_tienda_historial = crear_selector_tienda(filtro_historial_frame, 2, al_cambiar=cargar_historial)
+    btn_filtrar_historial = tk.Button(filtro_historial_frame, text="Filtrar", command=cargar_historial)
+    btn_filtrar_historial.grid(row=3, column=1, pady=10)
 
     cargar_historial()
     # =================== PESTAÑA DE PRODUCTOS =================== #
@@ -348,13 +5213,17 @@ def crear_ventana_principal():
     entry_busqueda = tk.Entry(search_frame, font=('Arial', 12), width=25)
     entry_busqueda.grid(row=0, column=1, padx=5)
 
+    busqueda_productos = {"termino": ""}  # Búsqueda aplicada a la tabla de productos
+
+    def coincide_busqueda_producto(producto):
+        termino = busqueda_productos["termino"]
+        return termino.lower() in producto[1].lower() or termino in producto[2]
+
     # Función de búsqueda
     def buscar_productos():
-        search_term = entry_busqueda.get().strip()
+        busqueda_productos["termino"] = entry_busqueda.get().strip()
         tree.delete(*tree.get_children())
-        for producto in obtener_productos():
-            if search_term.lower() in producto[1].lower() or search_term in producto[2]:
-                tree.insert('', 'end', values=producto)
+        actualizar_filas(tree, filter(coincide_busqueda_producto, obtener_productos()), valores=valores_producto)
 
     # Botón "Buscar" mejorado
     btn_buscar = tk.Button(search_frame, text="Buscar", command=buscar_productos, font=('Arial', 12, 'bold'),
@@ -364,7 +5233,7 @@ def crear_ventana_principal():
 
 
     # =================== Tabla de Productos =================== #
-    columnas = ('ID', 'Nombre', 'Código', 'Descripción', 'Precio', 'Cantidad')
+    columnas = ('ID', 'Nombre', 'Código', 'Descripción', 'Precio', 'Cantidad', 'Coste')
     tree = ttk.Treeview(tab_productos, columns=columnas, show='headings')
     for col in columnas:
         tree.heading(col, text=col)
@@ -372,16 +5241,28 @@ def crear_ventana_principal():
     tree.pack(expand=True, fill='both')
 
     # Cargar productos en la tabla
+    def valores_producto(producto):
+        # El coste puede ser desconocido (NULL); se muestra vacío
+        return [("" if valor is None else valor) for valor in producto]
+
     def cargar_productos():
+        busqueda_productos["termino"] = ""
         tree.delete(*tree.get_children())
-        for producto in obtener_productos():
-            tree.insert('', 'end', values=producto)
+        actualizar_filas(tree, obtener_productos(), valores=valores_producto)
 
+    def refrescar_productos(ids):
+        """Actualiza solo los productos cambiados; los que dejan de cumplir la búsqueda se quitan."""
+        productos = obtener_productos(ids)
+        actualizar_filas(tree, filter(coincide_busqueda_producto, productos), valores=valores_producto)
+        quitar_filas(tree, [producto[0] for producto in productos if not coincide_busqueda_producto(producto)])
+
+    bus_eventos.suscribir(EVENTO_PRODUCTO, refrescar_productos)
+    bus_eventos.suscribir(EVENTO_PRODUCTO_ELIMINADO, lambda ids: quitar_filas(tree, ids))
     cargar_productos()
 
 
     # Crear campos de entrada para los detalles del producto
-    labels = ["Nombre", "Código", "Descripción", "Precio", "Cantidad"]
+    labels = ["Nombre", "Código", "Descripción", "Precio", "Cantidad", "Coste"]
     entries = {}
     for i, text in enumerate(labels):
         tk.Label(form_frame, text=text + ":", font=('Arial', 12)).grid(row=i, column=0, padx=5, pady=5)
@@ -397,12 +5278,12 @@ def crear_ventana_principal():
             descripcion = entries["Descripción"].get().strip()
             precio = float(entries["Precio"].get().strip())
             cantidad = int(entries["Cantidad"].get().strip())
+            coste = float(entries["Coste"].get().strip()) if entries["Coste"].get().strip() else None
             if not nombre or not codigo:
                 messagebox.showerror("Error", "El nombre y código no pueden estar vacíos.")
                 return
-            añadir_producto(nombre, codigo, descripcion, precio, cantidad)
+            añadir_producto(nombre, codigo, descripcion, precio, cantidad, coste)
             messagebox.showinfo("Éxito", "Producto añadido correctamente.")
-            cargar_productos()
         except ValueError:
             messagebox.showerror("Error", "Revisa los campos de precio y cantidad.")
     def modificar_producto_seleccionado():
@@ -418,10 +5299,10 @@ def crear_ventana_principal():
             descripcion = entries['Descripción'].get().strip()
             precio = float(entries['Precio'].get().strip())
             cantidad = int(entries['Cantidad'].get().strip())
-            modificar_producto(producto[0], nombre, codigo, descripcion, precio, cantidad)
+            coste = float(entries['Coste'].get().strip()) if entries['Coste'].get().strip() else None
+            modificar_producto(producto[0], nombre, codigo, descripcion, precio, cantidad, coste)
             messagebox.showinfo("Éxito", "Producto modificado correctamente.")
             limpiar_campos()
-            cargar_productos()
         except ValueError:
             messagebox.showwarning("Error", "Revisa los campos, el precio y la cantidad deben ser números.")
 
@@ -436,7 +5317,6 @@ def crear_ventana_principal():
         if respuesta:
             eliminar_producto(producto[0])
             messagebox.showinfo("Éxito", "Producto eliminado correctamente.")
-            cargar_productos()
             update_status("Producto eliminado.")
 
 
@@ -507,27 +5387,17 @@ def crear_ventana_principal():
         entries['Descripción'].delete(0, tk.END)
         entries['Precio'].delete(0, tk.END)
         entries['Cantidad'].delete(0, tk.END)
+        entries['Coste'].delete(0, tk.END)
 
         entries['Nombre'].insert(0, producto[1])
         entries['Código'].insert(0, producto[2])
         entries['Descripción'].insert(0, producto[3])
         entries['Precio'].insert(0, producto[4])
         entries['Cantidad'].insert(0, producto[5])
+        entries['Coste'].insert(0, producto[6])
 
     tree.bind('<ButtonRelease-1>', seleccionar_producto)
     
-    # =================== FUNCIONES PARA ACTUALIZACIÓN DE STOCK =================== #
-    def actualizar_stock(producto_id, cantidad_vendida):
-        """Actualiza el stock de un producto tras una venta."""
-        conn = conectar_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT cantidad FROM productos WHERE id=?", (producto_id,))
-        cantidad_actual = cursor.fetchone()[0]
-        nueva_cantidad = cantidad_actual - cantidad_vendida
-        cursor.execute("UPDATE productos SET cantidad=? WHERE id=?", (nueva_cantidad, producto_id))
-        conn.commit()
-        conn.close()
-        
     # =================== PESTAÑA DE FACTURACIÓN =================== #
     tab_factura = ttk.Frame(notebook)
     notebook.add(tab_factura, text="Generar Factura")
@@ -539,16 +5409,54 @@ def crear_ventana_principal():
     tk.Label(frame_cliente, text="Nombre Cliente:").grid(row=0, column=0)
     tk.Label(frame_cliente, text="Dirección:").grid(row=1, column=0)
 
-    entry_cliente_nombre = tk.Entry(frame_cliente)
-    entry_cliente_direccion = tk.Entry(frame_cliente)
+    # El nombre se autocompleta con el índice de clientes (NIF, nombre fiscal o comercial)
+    entry_cliente_nombre = ttk.Combobox(frame_cliente, width=40)
+    entry_cliente_direccion = tk.Entry(frame_cliente, width=40)
 
     entry_cliente_nombre.grid(row=0, column=1)
     entry_cliente_direccion.grid(row=1, column=1)
 
+    cliente_factura = {"id": None}  # Cliente registrado elegido para la factura
+    sugerencias_cliente = {}
+
+    def poner_cliente_factura(cliente):
+        """Rellena el formulario de facturación con un cliente registrado."""
+        cliente_factura["id"] = int(cliente[0])
+        entry_cliente_nombre.set(cliente[2])  # Nombre Fiscal
+        entry_cliente_direccion.delete(0, tk.END)
+        entry_cliente_direccion.insert(0, cliente[4])  # Dirección
+
+    def autocompletar_cliente(event):
+        if event.keysym in ("Up", "Down", "Return", "Escape", "Tab"):
+            return
+        cliente_factura["id"] = None  # El texto ya no corresponde al cliente elegido
+        sugerencias_cliente.clear()
+        for cliente in indice_clientes.buscar(entry_cliente_nombre.get()):
+            sugerencias_cliente[descripcion_cliente(cliente)] = cliente
+        entry_cliente_nombre["values"] = list(sugerencias_cliente)
+
+    def elegir_sugerencia_cliente(event=None):
+        cliente = sugerencias_cliente.get(entry_cliente_nombre.get())
+        if cliente:
+            poner_cliente_factura(cliente)
+
+    entry_cliente_nombre.bind("<KeyRelease>", autocompletar_cliente)
+    entry_cliente_nombre.bind("<<ComboboxSelected>>", elegir_sugerencia_cliente)
+
     # Seleccionar productos para la factura
     tk.Label(tab_factura, text="Seleccionar Productos:").pack(pady=10)
 
-    productos_seleccionados = []
+    # El carrito se recupera del diario si el programa se cerró a mitad de una venta
+    productos_seleccionados = diario_carritos.lineas("factura")
+
+    def añadir_linea_factura(linea):
+        productos_seleccionados.append(linea)
+        diario_carritos.añadir_linea("factura", linea)
+
+    def vaciar_carrito_factura():
+        productos_seleccionados.clear()
+        diario_carritos.vaciar("factura")
+        cargar_productos_factura()
 
     def agregar_producto_factura():
         selected_item = tree.selection()
@@ -559,8 +5467,14 @@ def crear_ventana_principal():
         producto = tree.item(selected_item[0], 'values')
         cantidad = simpledialog.askinteger("Cantidad", "Introduce la cantidad del producto:")
         if cantidad and cantidad > 0:
-            total = cantidad * float(producto[4])  # Asegurando que el precio es float
-            productos_seleccionados.append((producto[1], cantidad, float(producto[4]), total))
+            # Precio según la tarifa y el descuento del cliente elegido (precio base si no hay cliente)
+            try:
+                precio = precio_para_cliente(int(producto[0]), cliente_factura["id"])
+            except ValueError as e:
+                messagebox.showwarning("Error", str(e))
+                return
+            total = round(cantidad * precio, 2)
+            añadir_linea_factura((producto[1], cantidad, precio, total))
             cargar_productos_factura()
         else:
             messagebox.showwarning("Error", "La cantidad debe ser un número mayor que 0.")
@@ -581,9 +5495,64 @@ def crear_ventana_principal():
         for item in productos_seleccionados:
             tree_factura.insert('', 'end', values=item)
 
-    def obtener_ruta_escritorio():
-        """Obtiene la ruta del escritorio del usuario."""
-        return os.path.join(os.path.expanduser("~"), "Desktop")
+    def quitar_linea_factura():
+        selected_item = tree_factura.selection()
+        if not selected_item:
+            messagebox.showwarning("Error", "Por favor, selecciona una línea para quitar.")
+            return
+        indice = tree_factura.index(selected_item[0])
+        del productos_seleccionados[indice]
+        diario_carritos.quitar_linea("factura", indice)
+        cargar_productos_factura()
+
+    def aparcar_carrito():
+        if not productos_seleccionados:
+            messagebox.showwarning("Error", "El carrito está vacío.")
+            return
+        nombre = simpledialog.askstring("Aparcar carrito", "Nombre para identificar el carrito:",
+                                        initialvalue=entry_cliente_nombre.get() or datetime.now().strftime("%H:%M"))
+        if nombre is None:
+            return
+        diario_carritos.aparcar("factura", nombre)
+        productos_seleccionados.clear()
+        cargar_productos_factura()
+        update_status(f"Carrito '{nombre}' aparcado.")
+
+    def recuperar_carrito():
+        aparcados = diario_carritos.aparcados()
+        if not aparcados:
+            messagebox.showinfo("Recuperar carrito", "No hay carritos aparcados.")
+            return
+
+        ventana_aparcados = tk.Toplevel(ventana)
+        ventana_aparcados.title("Carritos aparcados")
+        lista = tk.Listbox(ventana_aparcados, width=50)
+        lista.pack(padx=10, pady=10)
+        for id_aparcado, nombre, num_lineas, total in aparcados:
+            lista.insert(tk.END, f"{nombre} - {num_lineas} líneas - {total:.2f} €")
+
+        def recuperar_seleccionado(event=None):
+            seleccion = lista.curselection()
+            if not seleccion:
+                return
+            # El carrito activo, si tiene líneas, se aparca para no perderlo
+            if productos_seleccionados:
+                diario_carritos.aparcar("factura", f"Aparcado {datetime.now().strftime('%H:%M')}")
+            diario_carritos.recuperar(aparcados[seleccion[0]][0], "factura")
+            productos_seleccionados[:] = diario_carritos.lineas("factura")
+            cargar_productos_factura()
+            ventana_aparcados.destroy()
+
+        lista.bind("<Double-Button-1>", recuperar_seleccionado)
+        tk.Button(ventana_aparcados, text="Recuperar", command=recuperar_seleccionado).pack(pady=5)
+
+    frame_carrito = tk.Frame(tab_factura)
+    frame_carrito.pack(pady=5)
+    tk.Button(frame_carrito, text="Quitar Línea", command=quitar_linea_factura).pack(side="left", padx=5)
+    tk.Button(frame_carrito, text="Aparcar Carrito", command=aparcar_carrito).pack(side="left", padx=5)
+    tk.Button(frame_carrito, text="Recuperar Carrito", command=recuperar_carrito).pack(side="left", padx=5)
+
+    cargar_productos_factura()
 
 
     def generar_factura():
@@ -601,7 +5570,8 @@ def crear_ventana_principal():
         total_con_iva = sum([item[3] for item in productos_seleccionados])
 
         # Registrar la factura en la base de datos
-        registrar_factura(id_factura, nombre_cliente, fecha_actual, total_con_iva)
+        cliente = obtener_cliente(cliente_factura["id"]) if cliente_factura["id"] else None
+        registrar_factura(id_factura, nombre_cliente, fecha_actual, total_con_iva, cliente[0] if cliente else None)
 
         # Registrar cada producto como una transacción en el historial y actualizar stock
         for producto in productos_seleccionados:
@@ -616,11 +5586,8 @@ def crear_ventana_principal():
             conn.close()
             actualizar_stock(producto_id, cantidad)  # Llama a la función de actualización de stock
 
-        # Obtener la ruta del escritorio
-        ruta_escritorio = obtener_ruta_escritorio()
-
-        # Crear PDF de la factura en el escritorio con tamaño A5 (cuartilla)
-        pdf_filename = os.path.join(ruta_escritorio, f"factura_{id_factura}.pdf")
+        # Crear PDF de la factura en el directorio de salida con tamaño A5 (cuartilla)
+        pdf_filename = os.path.join(ruta_salida_documentos(), f"factura_{id_factura}.pdf")
         c = canvas.Canvas(pdf_filename, pagesize=A5)
 
         # Ajustar el contenido para estar cerca del borde superior
@@ -628,24 +5595,33 @@ def crear_ventana_principal():
 
         # Estilos de la cabecera
         c.setFont("Helvetica-Bold", 9)
-        c.drawString(20, top_position, f"Factura ID: {id_factura}")
+        c.drawString(20, top_position, f"Factura ID: {numero_documento('factura', id_factura)}")
         c.setFont("Helvetica", 8)
-        c.drawString(20, top_position - 15, f"Cliente: {nombre_cliente}")
-        c.drawString(20, top_position - 25, f"Dirección: {direccion_cliente}")
-        c.drawString(20, top_position - 35, f"Fecha: {fecha_actual}")
-        c.drawString(200, top_position - 8, "C/San Maximiliano 57")
-        c.drawString(200, top_position - 18, "28017 MADRID")
-        c.drawString(200, top_position - 28, "juanjobarja@gmail.com")
-        c.drawString(200, top_position - 38, "33338853P")
-        c.drawString(200, top_position - 48, "Telf. 688 902 949")
+        if cliente:
+            # Datos fiscales completos del cliente registrado
+            lineas_cliente = [f"Cliente: {cliente[2]}", f"NIF: {cliente[1]}", f"Dirección: {direccion_cliente}"]
+            localidad = " ".join(parte for parte in (cliente[5], cliente[6]) if parte)
+            if cliente[7]:
+                localidad += f" ({cliente[7]})"
+            if localidad:
+                lineas_cliente.append(localidad)
+            if cliente[8] and cliente[8].lower() not in ("españa", "espana"):
+                lineas_cliente.append(cliente[8])
+        else:
+            lineas_cliente = [f"Cliente: {nombre_cliente}", f"Dirección: {direccion_cliente}"]
+        lineas_cliente.append(f"Fecha: {fecha_actual}")
+        for i, linea in enumerate(lineas_cliente):
+            c.drawString(20, top_position - 15 - 10 * i, linea)
+        for i, linea in enumerate(lineas_cabecera_emisor()):
+            c.drawString(200, top_position - 8 - 10 * i, linea)
 
         # Nombre de la ferretería centrado
         c.setFont("Helvetica-Bold", 12)
-        c.drawCentredString(150, top_position - 60, "FERRETERIA JJBARJA")
+        c.drawCentredString(150, min(top_position - 60, top_position - 27 - 10 * len(lineas_cliente)), ajuste("nombre"))
 
         # Crear tabla de productos
         data = [['Descripción / Producto', 'Cantidad', 'Precio', 'Total']]  # Encabezado de la tabla
-        iva_porcentaje = 21  # IVA del 21%
+        iva_porcentaje = ajuste("iva")
 
         for item in productos_seleccionados:
             descripcion, cantidad, precio, total = item[0], item[1], item[2], item[3]
@@ -691,17 +5667,13 @@ def crear_ventana_principal():
         # Observaciones, ajustando su posición para evitar superposición
         c.setFont("Helvetica", 7)
         c.drawString(20, y_position - 50, "Observaciones:")
-        c.drawString(20, y_position - 60, "Para cambios y devoluciones, dispone de 15 días; el artículo debe estar en perfecto estado y con su ticket.")
-        c.drawString(20, y_position - 70, "Las devoluciones se efectuarán mediante vale sin fecha de caducidad. No se admiten cambios en herramientas,")
-        c.drawString(20, y_position - 80, "salvo defecto de fábrica. Todos los artículos tienen garantía según RDL 1/2007 del 16 de noviembre.")
+        for i, linea in enumerate(ajuste("pie_factura").splitlines()):
+            c.drawString(20, y_position - 60 - 10 * i, linea)
 
         # Guardar el PDF
         c.save()
-        messagebox.showinfo("Éxito", f"Factura generada en el escritorio: {pdf_filename}")
-
-        # Actualizar el historial y lista de productos
-        cargar_historial()
-        cargar_productos()  # Refresca la tabla de productos en la interfaz para reflejar el nuevo stock
+        messagebox.showinfo("Éxito", f"Factura generada: {pdf_filename}")
+        vaciar_carrito_factura()
 
 
 
@@ -729,7 +5701,7 @@ def crear_ventana_principal():
     # Seleccionar productos para el albarán
     tk.Label(tab_albaran, text="Seleccionar Productos:").pack(pady=10)
 
-    productos_seleccionados_albaran = []
+    productos_seleccionados_albaran = diario_carritos.lineas("albaran")
 
     def agregar_producto_albaran():
         selected_item = tree.selection()
@@ -741,7 +5713,9 @@ def crear_ventana_principal():
         cantidad = simpledialog.askinteger("Cantidad", "Introduce la cantidad del producto:")
         if cantidad and cantidad > 0:
             total = cantidad * float(producto[4])  # Asegurando que el precio es float
-            productos_seleccionados_albaran.append((producto[1], cantidad, float(producto[4]), total))
+            linea = (producto[1], cantidad, float(producto[4]), total)
+            productos_seleccionados_albaran.append(linea)
+            diario_carritos.añadir_linea("albaran", linea)
             cargar_productos_albaran()
         else:
             messagebox.showwarning("Error", "La cantidad debe ser un número mayor que 0.")
@@ -762,6 +5736,8 @@ def crear_ventana_principal():
         for item in productos_seleccionados_albaran:
             tree_albaran.insert('', 'end', values=item)
 
+    cargar_productos_albaran()
+
     def generar_albaran():
         nombre_cliente = entry_cliente_nombre_albaran.get()
         direccion_cliente = entry_cliente_direccion_albaran.get()
@@ -773,39 +5749,34 @@ def crear_ventana_principal():
         id_albaran = generar_id_factura()  # Puedes crear una función separada para generar ID de albarán si prefieres
         fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # Registrar cada producto como una transacción en el historial
-        for producto in productos_seleccionados_albaran:
-            descripcion, cantidad, precio, total = producto[0], producto[1], producto[2], producto[3]
-            registrar_transaccion(id_albaran, 'Albarán', descripcion, cantidad, precio, total, fecha_actual)
+        # Registrar el albarán con sus líneas (queda pendiente de facturar) y descontar el stock
+        registrar_albaran(id_albaran, nombre_cliente, direccion_cliente, fecha_actual,
+                          [tuple(item[:4]) for item in productos_seleccionados_albaran])
 
         # Calcular el total del albarán (IVA incluido)
         total_albaran = sum([item[3] for item in productos_seleccionados_albaran])
 
         # Crear PDF del albarán
-        ruta_escritorio = obtener_ruta_escritorio()
-        pdf_filename = os.path.join(ruta_escritorio, f"albaran_{id_albaran}.pdf")
+        pdf_filename = os.path.join(ruta_salida_documentos(), f"albaran_{id_albaran}.pdf")
         c = canvas.Canvas(pdf_filename, pagesize=A5)
 
         top_position = 570
 
         # Encabezado del albarán
         c.setFont("Helvetica-Bold", 9)
-        c.drawString(20, top_position, f"Albarán ID: {id_albaran}")
+        c.drawString(20, top_position, f"Albarán ID: {numero_documento('albaran', id_albaran)}")
         c.setFont("Helvetica", 8)
         c.drawString(20, top_position - 15, f"Cliente: {nombre_cliente}")
         c.drawString(20, top_position - 25, f"Dirección: {direccion_cliente}")
         c.drawString(20, top_position - 35, f"Fecha: {fecha_actual}")
 
         # Información del emisor en el PDF del albarán
-        c.drawString(200, top_position - 15, "C/San Maximiliano 57")
-        c.drawString(200, top_position - 25, "28017 MADRID")
-        c.drawString(200, top_position - 35, "juanjobarja@gmail.com")
-        c.drawString(200, top_position - 45, "33338853P")
-        c.drawString(200, top_position - 55, "Telf. 688 902 949")
+        for i, linea in enumerate(lineas_cabecera_emisor()):
+            c.drawString(200, top_position - 15 - 10 * i, linea)
 
         # Título de la ferretería
         c.setFont("Helvetica-Bold", 12)
-        c.drawCentredString(150, top_position - 70, "FERRETERIA JJBARJA - ALBARÁN")
+        c.drawCentredString(150, top_position - 70, f"{ajuste('nombre')} - ALBARÁN")
 
         # Tabla de productos
         data = [['Descripción / Producto', 'Cantidad', 'Precio', 'Total']]
@@ -839,15 +5810,92 @@ def crear_ventana_principal():
         # Observaciones específicas para el albarán
         c.setFont("Helvetica", 7)
         c.drawString(20, top_position - 140 - table_height, "Observaciones:")
-        c.drawString(20, top_position - 150 - table_height, "No se admiten reclamaciones ni devoluciones pasados 7 días.")
+        for i, linea in enumerate(ajuste("pie_albaran").splitlines()):
+            c.drawString(20, top_position - 150 - table_height - 10 * i, linea)
 
         c.save()
-        messagebox.showinfo("Éxito", f"Albarán generado en el escritorio: {pdf_filename}")
+        messagebox.showinfo("Éxito", f"Albarán generado: {pdf_filename}")
+        productos_seleccionados_albaran.clear()
+        diario_carritos.vaciar("albaran")
+        cargar_productos_albaran()
 
 
     btn_generar_albaran = tk.Button(tab_albaran, text="Generar Albarán", command=generar_albaran)
     btn_generar_albaran.pack(pady=10)
 
+    # Facturación mensual: una factura por cliente con todos sus albaranes pendientes del periodo
+    frame_facturar_albaranes = tk.LabelFrame(tab_albaran, text="Facturar albaranes pendientes")
+    frame_facturar_albaranes.pack(fill='x', padx=10, pady=10)
+    frame_rango_albaranes = tk.Frame(frame_facturar_albaranes)
+    frame_rango_albaranes.pack(pady=5)
+    leer_rango_albaranes = crear_selector_rango(frame_rango_albaranes, 0, lambda: cargar_albaranes_pendientes())
+
+    tree_albaranes_pendientes = ttk.Treeview(frame_facturar_albaranes, columns=('Cliente', 'Albaranes', 'Desde', 'Hasta', 'Total'),
+                                             show='headings', height=6)
+    for col in ('Cliente', 'Albaranes', 'Desde', 'Hasta', 'Total'):
+        tree_albaranes_pendientes.heading(col, text=col)
+        tree_albaranes_pendientes.column(col, width=130)
+    tree_albaranes_pendientes.pack(fill='x', padx=5)
+
+    def cargar_albaranes_pendientes():
+        try:
+            desde, hasta = leer_rango_albaranes()
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        tree_albaranes_pendientes.delete(*tree_albaranes_pendientes.get_children())
+        for fila in resumen_albaranes_pendientes(desde, hasta):
+            tree_albaranes_pendientes.insert('', 'end', values=fila)
+
+    resultado_facturacion = []
+    progreso_facturacion = []
+
+    def facturar_albaranes_pendientes():
+        try:
+            desde, hasta = leer_rango_albaranes()
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        clientes = len(tree_albaranes_pendientes.get_children())
+        if not clientes:
+            messagebox.showinfo("Facturación", "No hay albaranes pendientes en el periodo.")
+            return
+        if not messagebox.askyesno("Facturación", f"Se generará una factura para cada uno de los {clientes} clientes. ¿Continuar?"):
+            return
+
+        def trabajo():
+            try:
+                resultado_facturacion.append((facturar_albaranes(desde, hasta, progreso=lambda hechas, total: progreso_facturacion.append((hechas, total))), None))
+            except Exception as e:
+                resultado_facturacion.append((None, e))
+
+        btn_facturar_albaranes.config(state="disabled")
+        threading.Thread(target=trabajo, name="facturacion_albaranes", daemon=True).start()
+        ventana.after(300, vigilar_facturacion)
+
+    def vigilar_facturacion():
+        if progreso_facturacion:
+            hechas, total = progreso_facturacion[-1]
+            update_status(f"Generando facturas: {hechas} de {total}...")
+        if not resultado_facturacion:
+            ventana.after(300, vigilar_facturacion)
+            return
+        resultado, error = resultado_facturacion.pop()
+        progreso_facturacion.clear()
+        btn_facturar_albaranes.config(state="normal")
+        if error:
+            messagebox.showerror("Error", f"No se pudieron facturar los albaranes: {error}")
+            return
+        ids_facturas, rutas = resultado
+        if rutas:
+            update_status(f"{len(ids_facturas)} facturas generadas en {os.path.dirname(rutas[0])}")
+
+    btn_facturar_albaranes = tk.Button(frame_facturar_albaranes, text="Facturar Albaranes", command=facturar_albaranes_pendientes)
+    btn_facturar_albaranes.pack(pady=5)
+    # El resumen agrupa por cliente: se recalcula entero, pero solo cuando cambian albaranes
+    bus_eventos.suscribir(EVENTO_ALBARAN, lambda ids: cargar_albaranes_pendientes())
+    cargar_albaranes_pendientes()
+
 
     
 # =================== PESTAÑA DE CLIENTES =================== #
@@ -884,7 +5932,6 @@ def crear_ventana_principal():
                 return
             añadir_cliente(identificacion_fiscal, nombre_fiscal, nombre_comercial, direccion, codigo_postal, poblacion, provincia, pais, telefono)
             messagebox.showinfo("Éxito", "Cliente añadido correctamente.")
-            cargar_clientes()  # Refresca la tabla después de agregar
         except ValueError:
             messagebox.showerror("Error", "Revisa los campos.")
 
@@ -899,13 +5946,17 @@ def crear_ventana_principal():
     entry_busqueda_cliente.grid(row=0, column=1, padx=5)
 
     # Función para buscar clientes en la base de datos
+    busqueda_clientes = {"termino": ""}  # Búsqueda aplicada a la tabla de clientes
+
+    def coincide_busqueda_cliente(cliente):
+        # Buscamos en nombre fiscal, nombre comercial y dirección
+        term = busqueda_clientes["termino"]
+        return term in cliente[2].lower() or term in cliente[3].lower() or term in cliente[4].lower()
+
     def buscar_clientes():
-        term = entry_busqueda_cliente.get().strip().lower()
+        busqueda_clientes["termino"] = entry_busqueda_cliente.get().strip().lower()
         tree_clientes.delete(*tree_clientes.get_children())
-        for cliente in obtener_clientes():
-            # Buscamos en nombre fiscal, nombre comercial y dirección
-            if term in cliente[2].lower() or term in cliente[3].lower() or term in cliente[4].lower():
-                tree_clientes.insert('', 'end', values=cliente)
+        actualizar_filas(tree_clientes, filter(coincide_busqueda_cliente, obtener_clientes()))
 
     btn_buscar_cliente = tk.Button(search_frame_clientes, text="Buscar", command=buscar_clientes)
     btn_buscar_cliente.grid(row=0, column=2, padx=5)
@@ -920,9 +5971,17 @@ def crear_ventana_principal():
 
     # Función para cargar clientes en la tabla
     def cargar_clientes():
+        busqueda_clientes["termino"] = ""
         tree_clientes.delete(*tree_clientes.get_children())
-        for cliente in obtener_clientes():
-            tree_clientes.insert('', 'end', values=cliente)
+        actualizar_filas(tree_clientes, obtener_clientes())
+
+    def refrescar_clientes(ids):
+        clientes = obtener_clientes(ids)
+        actualizar_filas(tree_clientes, filter(coincide_busqueda_cliente, clientes))
+        quitar_filas(tree_clientes, [cliente[0] for cliente in clientes if not coincide_busqueda_cliente(cliente)])
+
+    bus_eventos.suscribir(EVENTO_CLIENTE, refrescar_clientes)
+    bus_eventos.suscribir(EVENTO_CLIENTE_ELIMINADO, lambda ids: quitar_filas(tree_clientes, ids))
 
     btn_cargar_clientes = tk.Button(tab_clientes, text="Cargar Clientes", command=cargar_clientes)
     btn_cargar_clientes.pack(pady=5)
@@ -936,10 +5995,7 @@ def crear_ventana_principal():
         cliente = tree_clientes.item(selected_item[0], 'values')
 
         # Pasa los datos del cliente seleccionado a los campos de facturación
-        entry_cliente_nombre.delete(0, tk.END)
-        entry_cliente_nombre.insert(0, cliente[2])  # Nombre Comercial
-        entry_cliente_direccion.delete(0, tk.END)
-        entry_cliente_direccion.insert(0, cliente[3])  # Dirección
+        poner_cliente_factura(cliente)
 
         # Cambiar a la pestaña de "Generar Factura"
         notebook.select(tab_factura)
@@ -960,7 +6016,6 @@ def crear_ventana_principal():
         if respuesta:
             eliminar_cliente(cliente[0])  # Elimina el cliente usando el ID
             messagebox.showinfo("Éxito", "Cliente eliminado correctamente.")
-            cargar_clientes()  # Refresca la tabla de clientes
 
     # Botón para eliminar cliente
     btn_eliminar_cliente = tk.Button(tab_clientes, text="Eliminar Cliente", command=eliminar_cliente_seleccionado)
@@ -969,11 +6024,443 @@ def crear_ventana_principal():
     # Cargar todos los clientes al iniciar la pestaña
     cargar_clientes()
 
+    # =================== PESTAÑA DE TARIFAS =================== #
+    tab_tarifas = ttk.Frame(notebook)
+    notebook.add(tab_tarifas, text="Tarifas")
+
+    # Familias de productos
+    frame_familias = tk.LabelFrame(tab_tarifas, text="Familias")
+    frame_familias.pack(fill="x", padx=10, pady=5)
+
+    tk.Label(frame_familias, text="Nueva familia:").grid(row=0, column=0, padx=5, pady=5)
+    entry_familia = tk.Entry(frame_familias)
+    entry_familia.grid(row=0, column=1, padx=5, pady=5)
+
+    tk.Label(frame_familias, text="Familia:").grid(row=1, column=0, padx=5, pady=5)
+    combo_familia = ttk.Combobox(frame_familias, state="readonly")
+    combo_familia.grid(row=1, column=1, padx=5, pady=5)
+
+    familias_por_nombre = {}
+
+    def cargar_familias():
+        familias_por_nombre.clear()
+        for id_familia, nombre, num_productos in obtener_familias():
+            familias_por_nombre[nombre] = id_familia
+        combo_familia["values"] = list(familias_por_nombre)
+        combo_familia_subida["values"] = ["Todas"] + list(familias_por_nombre)
+        combo_familia_tarifa["values"] = list(familias_por_nombre)
+
+    def crear_familia():
+        nombre = entry_familia.get().strip()
+        if not nombre:
+            messagebox.showerror("Error", "El nombre de la familia no puede estar vacío.")
+            return
+        añadir_familia(nombre)
+        entry_familia.delete(0, tk.END)
+        cargar_familias()
+
+    def asignar_familia_seleccionados():
+        selected_items = tree.selection()
+        if not selected_items or not combo_familia.get():
+            messagebox.showwarning("Error", "Selecciona productos en la pestaña Productos y una familia.")
+            return
+        ids = [int(tree.item(item, 'values')[0]) for item in selected_items]
+        asignar_familia(ids, familias_por_nombre[combo_familia.get()])
+        cargar_familias()
+        update_status(f"{len(ids)} productos asignados a {combo_familia.get()}.")
+
+    tk.Button(frame_familias, text="Crear Familia", command=crear_familia).grid(row=0, column=2, padx=5)
+    tk.Button(frame_familias, text="Asignar a Productos Seleccionados", command=asignar_familia_seleccionados).grid(row=1, column=2, padx=5)
+
+    # Subida o bajada de precios en bloque
+    frame_subida = tk.LabelFrame(tab_tarifas, text="Cambio de precios en bloque")
+    frame_subida.pack(fill="x", padx=10, pady=5)
+
+    tk.Label(frame_subida, text="Familia:").grid(row=0, column=0, padx=5, pady=5)
+    combo_familia_subida = ttk.Combobox(frame_subida, state="readonly")
+    combo_familia_subida.grid(row=0, column=1, padx=5, pady=5)
+    tk.Label(frame_subida, text="Porcentaje (+/-):").grid(row=0, column=2, padx=5, pady=5)
+    entry_porcentaje = tk.Entry(frame_subida, width=8)
+    entry_porcentaje.grid(row=0, column=3, padx=5, pady=5)
+
+    def aplicar_subida():
+        try:
+            porcentaje = float(entry_porcentaje.get().strip().replace(",", "."))
+        except ValueError:
+            messagebox.showerror("Error", "El porcentaje debe ser un número.")
+            return
+        familia = combo_familia_subida.get()
+        if not familia:
+            messagebox.showwarning("Error", "Selecciona una familia o 'Todas'.")
+            return
+        if not messagebox.askyesno("Confirmar", f"¿Aplicar un {porcentaje:+.2f}% a los precios de {familia}?"):
+            return
+        cambiados = aplicar_reglas_precio([(familias_por_nombre.get(familia), porcentaje)])
+        update_status(f"Precios actualizados: {cambiados} productos.")
+
+    tk.Button(frame_subida, text="Aplicar", command=aplicar_subida).grid(row=0, column=4, padx=5)
+
+    # Tarifas de clientes
+    frame_tarifas = tk.LabelFrame(tab_tarifas, text="Tarifas de clientes")
+    frame_tarifas.pack(expand=True, fill="both", padx=10, pady=5)
+
+    frame_nueva_tarifa = tk.Frame(frame_tarifas)
+    frame_nueva_tarifa.pack(pady=5)
+    tk.Label(frame_nueva_tarifa, text="Nombre:").grid(row=0, column=0, padx=5)
+    entry_tarifa_nombre = tk.Entry(frame_nueva_tarifa)
+    entry_tarifa_nombre.grid(row=0, column=1, padx=5)
+    tk.Label(frame_nueva_tarifa, text="Descuento general %:").grid(row=0, column=2, padx=5)
+    entry_tarifa_descuento = tk.Entry(frame_nueva_tarifa, width=8)
+    entry_tarifa_descuento.grid(row=0, column=3, padx=5)
+
+    tree_tarifas = ttk.Treeview(frame_tarifas, columns=('ID', 'Nombre', 'Descuento %'), show='headings', height=6)
+    for col in ('ID', 'Nombre', 'Descuento %'):
+        tree_tarifas.heading(col, text=col)
+        tree_tarifas.column(col, width=150)
+    tree_tarifas.pack(expand=True, fill='both')
+
+    def cargar_tarifas():
+        tree_tarifas.delete(*tree_tarifas.get_children())
+        for tarifa in obtener_tarifas():
+            tree_tarifas.insert('', 'end', values=tarifa)
+
+    def crear_tarifa():
+        nombre = entry_tarifa_nombre.get().strip()
+        try:
+            descuento = float(entry_tarifa_descuento.get().strip().replace(",", ".") or 0)
+        except ValueError:
+            messagebox.showerror("Error", "El descuento debe ser un número.")
+            return
+        if not nombre:
+            messagebox.showerror("Error", "El nombre de la tarifa no puede estar vacío.")
+            return
+        try:
+            añadir_tarifa(nombre, descuento)
+        except sqlite3.IntegrityError:
+            messagebox.showerror("Error", "Ya existe una tarifa con ese nombre.")
+            return
+        cargar_tarifas()
+
+    def tarifa_seleccionada():
+        selected_item = tree_tarifas.selection()
+        if not selected_item:
+            messagebox.showwarning("Error", "Por favor, selecciona una tarifa.")
+            return None
+        return int(tree_tarifas.item(selected_item[0], 'values')[0])
+
+    def eliminar_tarifa_seleccionada():
+        id_tarifa = tarifa_seleccionada()
+        if id_tarifa and messagebox.askyesno("Confirmar eliminación", "¿Eliminar la tarifa seleccionada?"):
+            eliminar_tarifa(id_tarifa)
+            cargar_tarifas()
+
+    tk.Button(frame_nueva_tarifa, text="Crear Tarifa", command=crear_tarifa).grid(row=0, column=4, padx=5)
+    tk.Button(frame_nueva_tarifa, text="Eliminar Tarifa", command=eliminar_tarifa_seleccionada).grid(row=0, column=5, padx=5)
+
+    frame_descuentos = tk.Frame(frame_tarifas)
+    frame_descuentos.pack(pady=5)
+    tk.Label(frame_descuentos, text="Familia:").grid(row=0, column=0, padx=5)
+    combo_familia_tarifa = ttk.Combobox(frame_descuentos, state="readonly")
+    combo_familia_tarifa.grid(row=0, column=1, padx=5)
+    tk.Label(frame_descuentos, text="Descuento %:").grid(row=0, column=2, padx=5)
+    entry_descuento_familia = tk.Entry(frame_descuentos, width=8)
+    entry_descuento_familia.grid(row=0, column=3, padx=5)
+
+    def aplicar_descuento_familia():
+        id_tarifa = tarifa_seleccionada()
+        if not id_tarifa:
+            return
+        familia = combo_familia_tarifa.get()
+        if not familia:
+            messagebox.showwarning("Error", "Selecciona una familia.")
+            return
+        texto = entry_descuento_familia.get().strip().replace(",", ".")
+        try:
+            descuento = float(texto) if texto else None  # Vacío quita el descuento de la familia
+        except ValueError:
+            messagebox.showerror("Error", "El descuento debe ser un número.")
+            return
+        descuento_familia_tarifa(id_tarifa, familias_por_nombre[familia], descuento)
+        update_status("Descuento de familia actualizado.")
+
+    def asignar_tarifa_cliente_seleccionado():
+        id_tarifa = tarifa_seleccionada()
+        if not id_tarifa:
+            return
+        selected_item = tree_clientes.selection()
+        if not selected_item:
+            messagebox.showwarning("Error", "Selecciona un cliente en la pestaña Clientes.")
+            return
+        cliente = tree_clientes.item(selected_item[0], 'values')
+        descuento = simpledialog.askfloat("Descuento del cliente", f"Descuento propio de {cliente[2]} (%):", initialvalue=0)
+        if descuento is None:
+            return
+        asignar_tarifa_cliente(int(cliente[0]), id_tarifa, descuento)
+        update_status(f"Tarifa asignada a {cliente[2]}.")
+
+    tk.Button(frame_descuentos, text="Descuento de Familia en Tarifa", command=aplicar_descuento_familia).grid(row=0, column=4, padx=5)
+    tk.Button(frame_descuentos, text="Asignar Tarifa al Cliente Seleccionado", command=asignar_tarifa_cliente_seleccionado).grid(row=0, column=5, padx=5)
+
+    cargar_familias()
+    cargar_tarifas()
+
+    # =================== PESTAÑA DE ANÁLISIS =================== #
+    tab_analisis = ttk.Frame(notebook)
+    notebook.add(tab_analisis, text="Análisis")
+
+    frame_botones_analisis = tk.Frame(tab_analisis)
+    frame_botones_analisis.pack(pady=10)
+
+    notebook_analisis = ttk.Notebook(tab_analisis)
+    notebook_analisis.pack(expand=True, fill='both')
+
+    def crear_tabla_analisis(titulo, columnas_tabla_analisis):
+        marco = ttk.Frame(notebook_analisis)
+        notebook_analisis.add(marco, text=titulo)
+        tabla = ttk.Treeview(marco, columns=columnas_tabla_analisis, show='headings')
+        for col in columnas_tabla_analisis:
+            tabla.heading(col, text=col)
+            tabla.column(col, width=90 if len(columnas_tabla_analisis) > 8 else 150)
+        tabla.pack(expand=True, fill='both')
+        return tabla
+
+    tree_abc = crear_tabla_analisis("Clasificación ABC", ('Producto', 'Ingresos', 'Unidades', '% Acumulado', 'Clase'))
+    tree_margenes = crear_tabla_analisis("Margen por familia", ('Familia', 'Ingresos sin IVA', 'Coste', 'Margen', '% Margen', 'Ingresos sin coste'))
+    tree_estacionalidad = crear_tabla_analisis("Estacionalidad", ['Año'] + [mes[:3] for mes in MESES])
+
+    resultado_analisis = {}
+    calculo_analisis = []  # Lo deja el hilo de cálculo: ((líneas, abc, márgenes, años, matriz), error)
+
+    def calcular_analisis():
+        """Calcula en segundo plano: con mucho historial, la carga y las métricas tardan y la caja no debe congelarse."""
+        if np is None:
+            messagebox.showerror("Error", "El análisis de ventas necesita NumPy (pip install numpy).")
+            return
+        tienda = leer_tienda_analisis()
+
+        def trabajo():
+            try:
+                datos = cargar_historial_numpy(tienda=tienda)
+                calculo_analisis.append(((len(datos["total"]), clasificacion_abc(datos), margen_por_familia(datos),
+                                          *estacionalidad(datos)), None))
+            except (OSError, ValueError, KeyError, RuntimeError, sqlite3.Error) as e:
+                calculo_analisis.append((None, e))
+
+        update_status("Calculando análisis de ventas...")
+        btn_calcular_analisis.config(state="disabled")
+        threading.Thread(target=trabajo, name="analisis", daemon=True).start()
+        ventana.after(300, mostrar_analisis)
+
+    def mostrar_analisis():
+        if not calculo_analisis:
+            ventana.after(300, mostrar_analisis)
+            return
+        btn_calcular_analisis.config(state="normal")
+        resultado, error = calculo_analisis.pop()
+        if error:
+            update_status(f"Error al calcular el análisis: {error}")
+            return
+        lineas, abc, margenes, años, matriz = resultado
+        resultado_analisis.update(abc=abc, margenes=margenes, años=años, matriz=matriz)
+
+        tree_abc.delete(*tree_abc.get_children())
+        for producto, ingresos, unidades, acumulado, clase in abc:
+            tree_abc.insert('', 'end', values=(producto, f"{ingresos:.2f}", f"{unidades:g}", f"{acumulado:.1f}", clase))
+        tree_margenes.delete(*tree_margenes.get_children())
+        for fila in margenes:
+            tree_margenes.insert('', 'end', values=(fila[0],) + tuple(f"{v:.2f}" for v in fila[1:]))
+        tree_estacionalidad.delete(*tree_estacionalidad.get_children())
+        for año, fila in zip(años, matriz):
+            tree_estacionalidad.insert('', 'end', values=[año] + [f"{v:.0f}" for v in fila])
+        update_status(f"Análisis calculado sobre {lineas} líneas de historial.")
+
+    def exportar_analisis_seleccionado():
+        if not resultado_analisis:
+            messagebox.showwarning("Error", "Primero calcula el análisis.")
+            return
+        directorio = filedialog.askdirectory(title="Carpeta para exportar el análisis", initialdir=ruta_salida_documentos())
+        if not directorio:
+            return
+        rutas = exportar_analisis(directorio, resultado_analisis["abc"], resultado_analisis["margenes"],
+                                  resultado_analisis["años"], resultado_analisis["matriz"])
+        messagebox.showinfo("Éxito", "Análisis exportado:\n" + "\n".join(rutas))
+
+    frame_tienda_analisis = tk.Frame(frame_botones_analisis)
+    frame_tienda_analisis.pack(side="left", padx=5)
+    leer_tienda_analisis = crear_selector_tienda(frame_tienda_analisis, 0)
+    btn_calcular_analisis = tk.Button(frame_botones_analisis, text="Calcular", command=calcular_analisis)
+    btn_calcular_analisis.pack(side="left", padx=5)
+    tk.Button(frame_botones_analisis, text="Exportar CSV", command=exportar_analisis_seleccionado).pack(side="left", padx=5)
+
+    # =================== PESTAÑA DE DEVOLUCIONES =================== #
+    tab_devoluciones = ttk.Frame(notebook)
+    notebook.add(tab_devoluciones, text="Devoluciones")
+
+    frame_buscar_venta = tk.Frame(tab_devoluciones)
+    frame_buscar_venta.pack(pady=10)
+
+    tk.Label(frame_buscar_venta, text="Nº Ticket / Factura:").grid(row=0, column=0, padx=5)
+    entry_numero_venta = tk.Entry(frame_buscar_venta)
+    entry_numero_venta.grid(row=0, column=1, padx=5)
+    tk.Label(frame_buscar_venta, text="Código de barras:").grid(row=1, column=0, padx=5)
+    entry_codigo_devolucion = tk.Entry(frame_buscar_venta)
+    entry_codigo_devolucion.grid(row=1, column=1, padx=5)
+
+    # Ventas encontradas por código de barras
+    tree_ventas_codigo = ttk.Treeview(tab_devoluciones, columns=('Nº', 'Fecha', 'Tipo', 'Producto', 'Cantidad', 'Total'), show='headings', height=5)
+    for col in ('Nº', 'Fecha', 'Tipo', 'Producto', 'Cantidad', 'Total'):
+        tree_ventas_codigo.heading(col, text=col)
+        tree_ventas_codigo.column(col, width=120)
+    tree_ventas_codigo.pack(fill='x', padx=10)
+
+    # Líneas de la venta elegida
+    tk.Label(tab_devoluciones, text="Líneas de la venta:").pack(pady=5)
+    tree_lineas_venta = ttk.Treeview(tab_devoluciones, columns=('Producto', 'Vendida', 'Devuelta', 'Precio', 'A devolver'), show='headings', height=6)
+    for col in ('Producto', 'Vendida', 'Devuelta', 'Precio', 'A devolver'):
+        tree_lineas_venta.heading(col, text=col)
+        tree_lineas_venta.column(col, width=120)
+    tree_lineas_venta.pack(fill='x', padx=10)
+
+    venta_devolucion = {"id": None}
+
+    def cargar_lineas_venta(id_factura):
+        aviso = f"Venta {id_factura} cargada."
+        id_consolidada = factura_de_albaran(id_factura)
+        if id_consolidada is not None:
+            aviso = f"El albarán {id_factura} está facturado: se ha cargado su factura {id_consolidada}."
+            id_factura = id_consolidada
+        lineas = lineas_devolubles(id_factura)
+        if not lineas:
+            messagebox.showwarning("Error", f"No existe ninguna venta con número {id_factura}.")
+            return
+        venta_devolucion["id"] = id_factura
+        tree_lineas_venta.delete(*tree_lineas_venta.get_children())
+        for producto, vendida, devuelta, precio in lineas:
+            tree_lineas_venta.insert('', 'end', values=(producto, vendida, devuelta, f"{precio:.2f}", 0))
+        update_status(aviso)
+
+    def buscar_venta_numero(event=None):
+        try:
+            cargar_lineas_venta(int(entry_numero_venta.get().strip()))
+        except ValueError:
+            messagebox.showerror("Error", "El número de ticket o factura debe ser un número.")
+
+    def buscar_venta_codigo(event=None):
+        codigo = entry_codigo_devolucion.get().strip()
+        tree_ventas_codigo.delete(*tree_ventas_codigo.get_children())
+        for venta in buscar_ventas_por_codigo(codigo):
+            tree_ventas_codigo.insert('', 'end', values=venta)
+
+    def elegir_venta_codigo(event=None):
+        selected_item = tree_ventas_codigo.selection()
+        if selected_item:
+            cargar_lineas_venta(int(tree_ventas_codigo.item(selected_item[0], 'values')[0]))
+
+    entry_numero_venta.bind("<Return>", buscar_venta_numero)
+    entry_codigo_devolucion.bind("<Return>", buscar_venta_codigo)
+    tree_ventas_codigo.bind("<Double-Button-1>", elegir_venta_codigo)
+    tk.Button(frame_buscar_venta, text="Buscar", command=buscar_venta_numero).grid(row=0, column=2, padx=5)
+    tk.Button(frame_buscar_venta, text="Buscar", command=buscar_venta_codigo).grid(row=1, column=2, padx=5)
+
+    def marcar_cantidad_devolver(event=None):
+        selected_item = tree_lineas_venta.selection()
+        if not selected_item:
+            messagebox.showwarning("Error", "Por favor, selecciona una línea de la venta.")
+            return
+        valores = list(tree_lineas_venta.item(selected_item[0], 'values'))
+        maximo = int(valores[1]) - int(valores[2])
+        cantidad = simpledialog.askinteger("Devolver", f"Unidades de {valores[0]} a devolver (máx. {maximo}):",
+                                           minvalue=0, maxvalue=maximo)
+        if cantidad is None:
+            return
+        valores[4] = cantidad
+        tree_lineas_venta.item(selected_item[0], values=valores)
+
+    tree_lineas_venta.bind("<Double-Button-1>", marcar_cantidad_devolver)
+
+    frame_registrar_devolucion = tk.Frame(tab_devoluciones)
+    frame_registrar_devolucion.pack(pady=10)
+    tk.Label(frame_registrar_devolucion, text="Reembolso:").grid(row=0, column=0, padx=5)
+    combo_reembolso = ttk.Combobox(frame_registrar_devolucion, state="readonly", values=["Vale", "Efectivo"], width=10)
+    combo_reembolso.set("Vale")
+    combo_reembolso.grid(row=0, column=1, padx=5)
+
+    def registrar_devolucion_seleccionada():
+        if venta_devolucion["id"] is None:
+            messagebox.showwarning("Error", "Primero busca la venta original.")
+            return
+        lineas = []
+        for item in tree_lineas_venta.get_children():
+            valores = tree_lineas_venta.item(item, 'values')
+            if int(valores[4]) > 0:
+                lineas.append((valores[0], int(valores[4])))
+        if not lineas:
+            messagebox.showwarning("Error", "Indica las unidades a devolver (doble clic en la línea).")
+            return
+        reembolso = "vale" if combo_reembolso.get() == "Vale" else "efectivo"
+        try:
+            id_rectificativa, id_vale = registrar_devolucion(venta_devolucion["id"], lineas, reembolso)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        mensaje = f"Devolución registrada con la factura rectificativa {id_rectificativa}."
+        if id_vale:
+            mensaje += f"\nVale número {id_vale}."
+        messagebox.showinfo("Éxito", mensaje)
+        cargar_lineas_venta(venta_devolucion["id"])
+
+    tk.Button(frame_registrar_devolucion, text="Registrar Devolución", command=registrar_devolucion_seleccionada).grid(row=0, column=2, padx=10)
+    tk.Button(frame_registrar_devolucion, text="Marcar Unidades", command=marcar_cantidad_devolver).grid(row=0, column=3, padx=5)
+
+    # Vales pendientes
+    tk.Label(tab_devoluciones, text="Vales con saldo:").pack(pady=5)
+    tree_vales = ttk.Treeview(tab_devoluciones, columns=('Vale', 'Cliente', 'Rectificativa', 'Fecha', 'Importe', 'Saldo'), show='headings', height=5)
+    for col in ('Vale', 'Cliente', 'Rectificativa', 'Fecha', 'Importe', 'Saldo'):
+        tree_vales.heading(col, text=col)
+        tree_vales.column(col, width=120)
+    tree_vales.pack(expand=True, fill='both', padx=10)
+
+    def cargar_vales():
+        tree_vales.delete(*tree_vales.get_children())
+        actualizar_filas(tree_vales, obtener_vales())
+
+    def refrescar_vales(ids):
+        # Los vales nuevos van arriba (la lista va del más reciente al más antiguo); los agotados se quitan
+        vales = obtener_vales(solo_pendientes=False, ids=ids)
+        actualizar_filas(tree_vales, [vale for vale in reversed(vales) if vale[5] > 0], al_principio=True)
+        quitar_filas(tree_vales, [vale[0] for vale in vales if vale[5] <= 0])
+
+    bus_eventos.suscribir(EVENTO_VALE, refrescar_vales)
+
+    def canjear_vale_seleccionado():
+        selected_item = tree_vales.selection()
+        if not selected_item:
+            messagebox.showwarning("Error", "Por favor, selecciona un vale.")
+            return
+        vale = tree_vales.item(selected_item[0], 'values')
+        importe = simpledialog.askfloat("Canjear vale", f"Importe a descontar del vale {vale[0]} (saldo {vale[5]} €):",
+                                        minvalue=0.01, maxvalue=float(vale[5]))
+        if importe is None:
+            return
+        try:
+            saldo = canjear_vale(int(vale[0]), importe)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        update_status(f"Vale {vale[0]} canjeado. Saldo restante: {saldo:.2f} €")
+
+    tk.Button(tab_devoluciones, text="Canjear Vale", command=canjear_vale_seleccionado).pack(pady=5)
+    cargar_vales()
+
 
 
     
     # =================== FUNCIONES PARA GENERAR TICKETS =================== #
     def generar_ticket():
+        if not productos_seleccionados:
+            messagebox.showwarning("Error", "Por favor, selecciona productos.")
+            return
+
         # Crear un ID único para el ticket
         id_ticket = generar_id_factura()
         fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -991,74 +6478,594 @@ def crear_ventana_principal():
             conn.close()
             actualizar_stock(producto_id, cantidad)  # Llama a la función de actualización de stock
 
-        # Configurar el tamaño dinámico del ticket según la cantidad de productos
-        ticket_width = 3 * inch
-        ticket_height = 1.5 * inch + (len(productos_seleccionados) * 0.3 * inch) + 2 * inch  # Ajustar altura dinámica
-
-        # Obtener la ruta del escritorio y definir el nombre del archivo para el ticket
-        ruta_escritorio = obtener_ruta_escritorio()
-        pdf_filename = os.path.join(ruta_escritorio, f"ticket_{id_ticket}.pdf")
-
-        # Crear el PDF con el tamaño personalizado
-        c = canvas.Canvas(pdf_filename, pagesize=(ticket_width, ticket_height))
-
-        # Encabezado del ticket con los datos de la tienda
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(10, ticket_height - 20, "FERRETERIA JJBARJA")
-        c.setFont("Helvetica", 10)
-        c.drawString(10, ticket_height - 40, "C/San Maximiliano 57, 28017 Madrid")
-        c.drawString(10, ticket_height - 60, "Teléfono: 688 902 949")
-
-        # Fecha
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(10, ticket_height - 100, f"Fecha: {fecha_actual}")
-
-        # Encabezado de productos
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(10, ticket_height - 130, "Producto")
-        c.drawString(120, ticket_height - 130, "Cant.")
-        c.drawString(170, ticket_height - 130, "Precio")
-        c.drawString(220, ticket_height - 130, "Total")
-
-        # Detalle de productos y acumulación del total
-        y_position = ticket_height - 150
-        total_con_iva = 0
-
-        for item in productos_seleccionados:
-            c.setFont("Helvetica", 10)
-            c.drawString(10, y_position, item[0])
-            c.drawString(120, y_position, str(item[1]))
-            c.drawString(170, y_position, f"{item[2]:.2f} €")
-            c.drawString(220, y_position, f"{item[3]:.2f} €")
-            total_con_iva += item[3]  # Acumula el total aquí
-            y_position -= 20
-
-        # Mostrar el total final
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(10, y_position - 20, "TOTAL: " + f"{total_con_iva:.2f} €")
-
-        # Mensaje de agradecimiento
-        c.setFont("Helvetica", 8)
-        c.drawCentredString(ticket_width / 2, y_position - 50, "¡Gracias por su visita!")
+        # Enviar el ticket a la cola de impresión; el hilo de impresión lo imprime en segundo plano
+        id_trabajo = imprimir_ticket(id_ticket, fecha_actual, list(productos_seleccionados))
+        update_status(f"Ticket {id_ticket} enviado a la cola de impresión.")
+        vigilar_impresion(id_trabajo, f"Ticket {id_ticket}")
+        vaciar_carrito_factura()
 
-        # Guardar el PDF
-        c.save()
-        messagebox.showinfo("Éxito", f"Ticket generado en el escritorio: {pdf_filename}")
-
-        # Actualizar la lista de productos en la interfaz
-        cargar_productos()  # Refresca la tabla de productos en la interfaz para reflejar el nuevo stock
 
 
+    def vigilar_impresion(id_trabajo, documento):
+        """Consulta periódicamente el estado del trabajo y lo muestra en la barra de estado."""
+        estado = estado_trabajo_impresion(id_trabajo)
+        if estado is None:
+            return
+        if estado[0] == "impreso":
+            update_status(f"{documento} impreso.")
+        elif estado[0] == "error":
+            update_status(f"Error al imprimir {documento}: {estado[2]}")
+        else:
+            if estado[1]:
+                update_status(f"{documento}: reintentando impresión ({estado[1]} intentos). {estado[2] or ''}")
+            ventana.after(500, vigilar_impresion, id_trabajo, documento)
 
     # Luego creas el botón para generar ticket
     btn_generar_ticket = tk.Button(tab_factura, text="Generar Ticket", command=generar_ticket)
     btn_generar_ticket.pack(pady=10)
    
     
+    # =================== PESTAÑA DE CAJA RÁPIDA =================== #
+    # Venta con teclado: el código se busca en el catálogo en memoria y solo se redibujan las filas cambiadas
+    tab_caja = ttk.Frame(notebook)
+    notebook.add(tab_caja, text="Caja Rápida")
+
+    catalogo_caja = CatalogoVenta()
+    bus_eventos.suscribir(EVENTO_PRODUCTO, catalogo_caja.actualizar)
+    bus_eventos.suscribir(EVENTO_PRODUCTO_ELIMINADO, catalogo_caja.eliminar)
+
+    frame_caja_cliente = tk.Frame(tab_caja)
+    frame_caja_cliente.pack(fill="x", padx=10, pady=5)
+    tk.Label(frame_caja_cliente, text="Cliente (para factura):").pack(side="left")
+    entry_caja_cliente = ttk.Combobox(frame_caja_cliente, width=40)
+    entry_caja_cliente.pack(side="left", padx=5)
+
+    frame_caja_entrada = tk.Frame(tab_caja)
+    frame_caja_entrada.pack(fill="x", padx=10, pady=5)
+    tk.Label(frame_caja_entrada, text="Código (cantidad*código):").pack(side="left")
+    entry_caja_codigo = tk.Entry(frame_caja_entrada, width=30, font=("Helvetica", 14))
+    entry_caja_codigo.pack(side="left", padx=5)
+    label_caja_sugerencia = tk.Label(frame_caja_entrada, text="", anchor="w", fg="grey")
+    label_caja_sugerencia.pack(side="left", fill="x", expand=True)
+
+    columnas_caja = ('Código', 'Descripción', 'Cantidad', 'Precio', 'Total')
+    tree_caja = ttk.Treeview(tab_caja, columns=columnas_caja, show='headings', selectmode='browse')
+    for columna in columnas_caja:
+        tree_caja.heading(columna, text=columna)
+    tree_caja.column('Descripción', width=300)
+    tree_caja.pack(expand=True, fill='both', padx=10)
+
+    frame_caja_totales = tk.Frame(tab_caja)
+    frame_caja_totales.pack(fill="x", padx=10, pady=5)
+    label_caja_totales = tk.Label(frame_caja_totales, text="", font=("Helvetica", 16, "bold"), anchor="e")
+    label_caja_totales.pack(side="right")
+    tk.Label(tab_caja, anchor="w", fg="grey",
+             text="Intro: añadir · ↑/↓: línea · +/-: cantidad · F2: cantidad · F3: precio · Supr: quitar · "
+                  "F9: ticket · F10: factura · Esc: vaciar").pack(fill="x", padx=10, pady=(0, 5))
+
+    # Líneas por id de producto: [código, nombre, cantidad, precio, total]; el orden del dict es el de la rejilla
+    venta_caja = {}
+    total_caja = {"total": 0.0}
+    cliente_caja = {"id": None}
+    sugerencias_caja = {}
+    filas_caja_cambiadas = set()
+    redibujo_caja = {"pendiente": False}
+
+    def linea_diario_caja(id_producto):
+        codigo, nombre, cantidad, precio, total = venta_caja[id_producto]
+        return (nombre, cantidad, precio, total, id_producto)
+
+    # La línea activa se recuerda aparte porque la fila puede no estar dibujada todavía
+    seleccion_caja = {"id": None}
+
+    # El carrito de la caja también se guarda en el diario para sobrevivir a un cierre inesperado
+    lineas_caja = diario_carritos.lineas("caja")
+    if lineas_caja:
+        catalogo_caja.cargar()
+    for nombre, cantidad, precio, total, id_producto in lineas_caja:
+        producto = catalogo_caja.productos.get(id_producto)
+        venta_caja[id_producto] = [producto[2] if producto else "", nombre, cantidad, precio, total]
+        total_caja["total"] += total
+        filas_caja_cambiadas.add(id_producto)
+
+    def redibujar_caja():
+        """Aplica a la rejilla solo las filas cambiadas desde el último redibujo y actualiza los totales."""
+        redibujo_caja["pendiente"] = False
+        for id_producto in filas_caja_cambiadas:
+            iid = str(id_producto)
+            if id_producto not in venta_caja:
+                if tree_caja.exists(iid):
+                    tree_caja.delete(iid)
+                continue
+            codigo, nombre, cantidad, precio, total = venta_caja[id_producto]
+            valores = (codigo, nombre, cantidad, f"{precio:.2f}", f"{total:.2f}")
+            if tree_caja.exists(iid):
+                tree_caja.item(iid, values=valores)
+            else:
+                tree_caja.insert('', 'end', iid=iid, values=valores)
+        filas_caja_cambiadas.clear()
+        if tree_caja.exists(str(seleccion_caja["id"])):
+            tree_caja.selection_set(str(seleccion_caja["id"]))
+            tree_caja.see(str(seleccion_caja["id"]))
+        total_con_iva = total_caja["total"]
+        base = total_con_iva / (1 + ajuste("iva") / 100)
+        label_caja_totales.config(text=f"{len(venta_caja)} líneas   Base: {base:.2f} €   "
+                                       f"IVA: {total_con_iva - base:.2f} €   TOTAL: {total_con_iva:.2f} €")
+
+    def programar_redibujo_caja():
+        """Agrupa en un solo redibujo todos los cambios hechos hasta que la ventana quede libre."""
+        if not redibujo_caja["pendiente"]:
+            redibujo_caja["pendiente"] = True
+            ventana.after_idle(redibujar_caja)
+
+    def marcar_fila_caja(id_producto):
+        filas_caja_cambiadas.add(id_producto)
+        programar_redibujo_caja()
+
+    def poner_linea_caja(id_producto, cantidad, precio):
+        """Crea o cambia una línea y la guarda en el diario."""
+        anterior = venta_caja.get(id_producto)
+        total = round(cantidad * precio, 2)
+        if anterior:
+            total_caja["total"] += total - anterior[4]
+            anterior[2:] = [cantidad, precio, total]
+            diario_carritos.cambiar_linea("caja", list(venta_caja).index(id_producto), linea_diario_caja(id_producto))
+        else:
+            producto = catalogo_caja.productos[id_producto]
+            venta_caja[id_producto] = [producto[2], producto[1], cantidad, precio, total]
+            total_caja["total"] += total
+            diario_carritos.añadir_linea("caja", linea_diario_caja(id_producto))
+        seleccion_caja["id"] = id_producto
+        marcar_fila_caja(id_producto)
+
+    def quitar_linea_caja(id_producto):
+        diario_carritos.quitar_linea("caja", list(venta_caja).index(id_producto))
+        total_caja["total"] -= venta_caja.pop(id_producto)[4]
+        marcar_fila_caja(id_producto)
+
+    def vaciar_caja():
+        filas_caja_cambiadas.update(venta_caja)
+        venta_caja.clear()
+        total_caja["total"] = 0.0
+        diario_carritos.vaciar("caja")
+        cliente_caja["id"] = None
+        entry_caja_cliente.set("")
+        programar_redibujo_caja()
+
+    def linea_activa_caja():
+        if seleccion_caja["id"] in venta_caja:
+            return seleccion_caja["id"]
+        return next(reversed(venta_caja), None)
+
+    def añadir_entrada_caja(event=None):
+        texto = entry_caja_codigo.get().strip()
+        if not texto:
+            return "break"
+        try:
+            cantidad, codigo = interpretar_entrada_caja(texto)
+        except ValueError:
+            update_status(f"Cantidad no válida: {texto}")
+            return "break"
+        producto = catalogo_caja.buscar_codigo(codigo)
+        if producto is None:
+            # Sin código exacto se toma la primera sugerencia por nombre o prefijo de código
+            encontrados = catalogo_caja.buscar(codigo, 1)
+            producto = encontrados[0] if encontrados else None
+        if producto is None:
+            update_status(f"No existe ningún producto con código '{codigo}'.")
+            entry_caja_codigo.select_range(0, tk.END)
+            return "break"
+        id_producto = producto[0]
+        if id_producto in venta_caja:
+            cantidad += venta_caja[id_producto][2]
+            precio = venta_caja[id_producto][3]  # Se respeta un precio ya modificado a mano
+        else:
+            # Precio según la tarifa del cliente elegido: una consulta por línea añadida, no por tecla
+            try:
+                precio = precio_para_cliente(id_producto, cliente_caja["id"]) if cliente_caja["id"] else producto[4]
+            except ValueError as e:
+                update_status(str(e))
+                entry_caja_codigo.select_range(0, tk.END)
+                return "break"
+        poner_linea_caja(id_producto, cantidad, precio)
+        if cantidad > producto[5]:
+            update_status(f"Atención: stock de {producto[1]} insuficiente ({producto[5]} disponibles).")
+        else:
+            update_status(f"{cantidad} x {producto[1]}")
+        entry_caja_codigo.delete(0, tk.END)
+        label_caja_sugerencia.config(text="")
+        return "break"
+
+    def sugerir_producto_caja(event):
+        if event.keysym in ("Return", "KP_Enter", "Up", "Down", "Escape") or (event.keysym[0] == "F" and event.keysym[1:].isdigit()):
+            return
+        _, _, codigo = entry_caja_codigo.get().strip().rpartition("*")
+        encontrados = catalogo_caja.buscar(codigo, 1) if codigo else []
+        if encontrados:
+            producto = encontrados[0]
+            label_caja_sugerencia.config(text=f"→ {producto[1]} ({producto[2]})  {producto[4]:.2f} €  stock {producto[5]}")
+        else:
+            label_caja_sugerencia.config(text="")
+
+    def mover_seleccion_caja(paso):
+        if redibujo_caja["pendiente"]:
+            redibujar_caja()
+        filas = tree_caja.get_children()
+        if not filas:
+            return "break"
+        actual = linea_activa_caja()
+        posicion = tree_caja.index(str(actual)) + paso if actual is not None and tree_caja.exists(str(actual)) else len(filas) - 1
+        iid = filas[max(0, min(len(filas) - 1, posicion))]
+        tree_caja.selection_set(iid)
+        tree_caja.see(iid)
+        seleccion_caja["id"] = int(iid)
+        return "break"
+
+    def cambiar_cantidad_caja(paso):
+        # Con texto en la entrada, + y - se escriben con normalidad
+        if entry_caja_codigo.get():
+            return None
+        id_producto = linea_activa_caja()
+        if id_producto is None:
+            return "break"
+        cantidad = venta_caja[id_producto][2] + paso
+        if cantidad <= 0:
+            quitar_linea_caja(id_producto)
+        else:
+            poner_linea_caja(id_producto, cantidad, venta_caja[id_producto][3])
+        return "break"
+
+    def quitar_seleccion_caja(event=None):
+        if event is not None and event.widget is entry_caja_codigo and entry_caja_codigo.get():
+            return None
+        id_producto = linea_activa_caja()
+        if id_producto is not None:
+            quitar_linea_caja(id_producto)
+        return "break"
+
+    def editar_celda_caja(columna):
+        """Abre un cuadro de edición sobre la celda (cantidad o precio) de la línea activa."""
+        id_producto = linea_activa_caja()
+        if id_producto is None:
+            return "break"
+        redibujar_caja()  # La fila tiene que existir para conocer su posición
+        iid = str(id_producto)
+        tree_caja.see(iid)
+        tree_caja.update_idletasks()
+        caja = tree_caja.bbox(iid, column=columna)
+        if not caja:
+            return "break"
+        x, y, ancho, alto = caja
+        editor = tk.Entry(tree_caja, justify="right")
+        editor.insert(0, tree_caja.set(iid, columna))
+        editor.select_range(0, tk.END)
+        editor.place(x=x, y=y, width=ancho, height=alto)
+        editor.focus_set()
+
+        def confirmar(event=None):
+            texto = editor.get().strip().replace(",", ".")
+            try:
+                if columna == 'Cantidad':
+                    cantidad, precio = int(texto), venta_caja[id_producto][3]
+                else:
+                    cantidad, precio = venta_caja[id_producto][2], round(float(texto), 2)
+                if cantidad <= 0 or precio < 0:
+                    raise ValueError
+            except (ValueError, KeyError):
+                update_status(f"Valor no válido para {columna.lower()}: {texto}")
+                return "break"
+            poner_linea_caja(id_producto, cantidad, precio)
+            cancelar()
+            return "break"
+
+        def cancelar(event=None):
+            editor.destroy()
+            entry_caja_codigo.focus_set()
+            return "break"
+
+        editor.bind("<Return>", confirmar)
+        editor.bind("<KP_Enter>", confirmar)
+        editor.bind("<Escape>", cancelar)
+        editor.bind("<FocusOut>", cancelar)
+        return "break"
+
+    def lineas_venta_caja():
+        return [(id_producto, nombre, cantidad, precio, total)
+                for id_producto, (codigo, nombre, cantidad, precio, total) in venta_caja.items()]
+
+    def cobrar_ticket_caja(event=None):
+        if not venta_caja:
+            update_status("La venta está vacía.")
+            return "break"
+        lineas = lineas_venta_caja()
+        fecha_actual = datetime.now().strftime(FORMATO_FECHA)
+        try:
+            id_ticket = registrar_venta(lineas, "Ticket", fecha=fecha_actual)
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"No se pudo registrar el ticket: {e}")
+            return "break"
+        id_trabajo = imprimir_ticket(id_ticket, fecha_actual, [linea[1:] for linea in lineas])
+        update_status(f"Ticket {id_ticket} ({total_caja['total']:.2f} €) enviado a la cola de impresión.")
+        vigilar_impresion(id_trabajo, f"Ticket {id_ticket}")
+        vaciar_caja()
+        entry_caja_codigo.focus_set()
+        return "break"
+
+    def cobrar_factura_caja(event=None):
+        if not venta_caja:
+            update_status("La venta está vacía.")
+            return "break"
+        nombre_cliente = entry_caja_cliente.get().strip()
+        if not nombre_cliente:
+            update_status("Indica el cliente para la factura.")
+            entry_caja_cliente.focus_set()
+            return "break"
+        cliente = obtener_cliente(cliente_caja["id"]) if cliente_caja["id"] else None
+        lineas = lineas_venta_caja()
+        fecha_actual = datetime.now().strftime(FORMATO_FECHA)
+        try:
+            id_factura = registrar_venta(lineas, "Venta", nombre_cliente, cliente[0] if cliente else None, fecha_actual)
+        except sqlite3.Error as e:
+            messagebox.showerror("Error", f"No se pudo registrar la factura: {e}")
+            return "break"
+        total_con_iva = round(sum(linea[4] for linea in lineas), 2)
+        if cliente:
+            cabecera = (id_factura, cliente[2], fecha_actual, total_con_iva, cliente[1], cliente[4], cliente[5], cliente[6], cliente[7])
+        else:
+            cabecera = (id_factura, nombre_cliente, fecha_actual, total_con_iva, "", "", "", "", "")
+        cabecera += (ajuste("serie_factura"), ajuste("iva"))  # Los mismos que registrar_venta guardó con la factura
+        ruta = os.path.join(ruta_salida_documentos(), f"factura_{id_factura}.pdf")
+        renderizar_factura_consolidada(ruta, cabecera, [(None, None, nombre, cantidad, precio, total)
+                                                        for _, nombre, cantidad, precio, total in lineas])
+        update_status(f"Factura {numero_documento('factura', id_factura)} ({total_con_iva:.2f} €) guardada en {ruta}")
+        vaciar_caja()
+        entry_caja_codigo.focus_set()
+        return "break"
+
+    def vaciar_caja_tecla(event=None):
+        if entry_caja_codigo.get():
+            entry_caja_codigo.delete(0, tk.END)
+            label_caja_sugerencia.config(text="")
+        elif venta_caja and messagebox.askyesno("Caja", "¿Vaciar la venta en curso?"):
+            vaciar_caja()
+        return "break"
+
+    def autocompletar_cliente_caja(event):
+        if event.keysym in ("Up", "Down", "Return", "Escape", "Tab"):
+            return
+        cliente_caja["id"] = None
+        sugerencias_caja.clear()
+        for cliente in indice_clientes.buscar(entry_caja_cliente.get()):
+            sugerencias_caja[descripcion_cliente(cliente)] = cliente
+        entry_caja_cliente["values"] = list(sugerencias_caja)
+
+    def elegir_cliente_caja(event=None):
+        cliente = sugerencias_caja.get(entry_caja_cliente.get())
+        if cliente:
+            cliente_caja["id"] = int(cliente[0])
+            entry_caja_cliente.set(cliente[2])
+        entry_caja_codigo.focus_set()
+
+    entry_caja_cliente.bind("<KeyRelease>", autocompletar_cliente_caja)
+    entry_caja_cliente.bind("<<ComboboxSelected>>", elegir_cliente_caja)
+    entry_caja_cliente.bind("<Return>", elegir_cliente_caja)
+
+    entry_caja_codigo.bind("<Return>", añadir_entrada_caja)
+    entry_caja_codigo.bind("<KP_Enter>", añadir_entrada_caja)
+    entry_caja_codigo.bind("<KeyRelease>", sugerir_producto_caja)
+    entry_caja_codigo.bind("<Escape>", vaciar_caja_tecla)
+    for widget in (entry_caja_codigo, tree_caja):
+        widget.bind("<Up>", lambda event: mover_seleccion_caja(-1))
+        widget.bind("<Down>", lambda event: mover_seleccion_caja(1))
+        widget.bind("<plus>", lambda event: cambiar_cantidad_caja(1))
+        widget.bind("<KP_Add>", lambda event: cambiar_cantidad_caja(1))
+        widget.bind("<minus>", lambda event: cambiar_cantidad_caja(-1))
+        widget.bind("<KP_Subtract>", lambda event: cambiar_cantidad_caja(-1))
+        widget.bind("<Delete>", quitar_seleccion_caja)
+        widget.bind("<F2>", lambda event: editar_celda_caja('Cantidad'))
+        widget.bind("<F3>", lambda event: editar_celda_caja('Precio'))
+    for widget in (entry_caja_codigo, tree_caja, entry_caja_cliente):
+        widget.bind("<F9>", cobrar_ticket_caja)
+        widget.bind("<F10>", cobrar_factura_caja)
+    tree_caja.bind("<<TreeviewSelect>>", lambda event: seleccion_caja.update(id=int(tree_caja.selection()[0])) if tree_caja.selection() else None)
+
+    def entrar_en_caja(event=None):
+        if notebook.select() == str(tab_caja):
+            entry_caja_codigo.focus_set()
+
+    notebook.bind("<<NotebookTabChanged>>", entrar_en_caja, add="+")
+    redibujar_caja()
+
+
+    def entregar_avisos():
+        """Aplica a las tablas los cambios publicados por la capa de datos (también desde otros hilos)."""
+        try:
+            bus_eventos.entregar()
+        finally:
+            ventana.after(INTERVALO_AVISOS_MS, entregar_avisos)
+
+    entregar_avisos()
+
     # Crear tablas al iniciar
     crear_tablas()
+    # Copia automática si la última tiene más de un día
+    if copia_pendiente():
+        copia_seguridad()
     # Iniciar la ventana principal
     ventana.mainloop()
+    diario_carritos.cerrar()
+    if cambio_tienda["nombre"]:
+        os.environ["FERRETERIA_TIENDA"] = cambio_tienda["nombre"]
+        os.execv(sys.executable, [sys.executable, os.path.abspath(__file__)])
+
+
+# =================== LÍNEA DE ÓRDENES =================== #
+def main(argv=None):
+    """Sin argumentos abre la interfaz; con una orden ejecuta la herramienta correspondiente."""
+    parser = argparse.ArgumentParser(description="Sistema de Facturación Profesional")
+    parser.add_argument("--tienda", help="Tienda con la que trabajar (sección [tiendas] del archivo de configuración)")
+    ordenes = parser.add_subparsers(dest="orden")
+
+    orden_copia = ordenes.add_parser("copia", help="Hace una copia de seguridad en caliente")
+    orden_copia.add_argument("--directorio", help="Directorio de destino (por defecto ~/ferreteria_copias)")
+    ordenes.add_parser("listar-copias", help="Lista las copias de seguridad disponibles")
+    orden_verificar = ordenes.add_parser("verificar-copia", help="Comprueba la integridad de una copia")
+    orden_verificar.add_argument("archivo")
+    orden_restaurar = ordenes.add_parser("restaurar", help="Restaura la base de datos desde una copia")
+    orden_restaurar.add_argument("archivo")
+    orden_bench = ordenes.add_parser("benchmark-copia", help="Mide la latencia de cobro durante una copia")
+    orden_bench.add_argument("--ventas", type=int, default=200)
+    orden_bench.add_argument("--filas", type=int, default=200000, help="Filas de historial de relleno")
+    orden_facturar = ordenes.add_parser("facturar-albaranes", help="Factura los albaranes pendientes (una factura por cliente)")
+    orden_facturar.add_argument("--desde", help="Primer día (YYYY-MM-DD)")
+    orden_facturar.add_argument("--hasta", help="Último día (YYYY-MM-DD)")
+    orden_facturar.add_argument("--directorio", help="Directorio de los PDF (por defecto, en el escritorio)")
+    for nombre, ayuda in (("exportar-facturae", "Exporta las facturas del periodo en Facturae 3.2.2 (un archivo por cliente)"),
+                          ("exportar-verifactu", "Exporta los registros de facturación encadenados del periodo")):
+        orden_exportar = ordenes.add_parser(nombre, help=ayuda)
+        orden_exportar.add_argument("--desde", help="Primer día (YYYY-MM-DD)")
+        orden_exportar.add_argument("--hasta", help="Último día (YYYY-MM-DD)")
+        orden_exportar.add_argument("--directorio", help="Directorio de destino")
+    ordenes.add_parser("ajustes", help="Muestra los ajustes de la tienda y de dónde se leen")
+    ordenes.add_parser("verificar-registros", help="Comprueba la cadena de huellas de los registros de facturación")
+    orden_sincronizar = ordenes.add_parser("sincronizar", help="Intercambia cambios con las demás tiendas")
+    orden_sincronizar.add_argument("destino", nargs="?", help="Carpeta compartida o host:puerto (por defecto, el ajuste sincronizacion)")
+    orden_servidor = ordenes.add_parser("servidor-sincronizacion", help="Atiende por red las sincronizaciones de otras tiendas")
+    orden_servidor.add_argument("--puerto", type=int, default=PUERTO_SINCRONIZACION)
+    orden_servidor.add_argument("--host", default="127.0.0.1",
+                                help="Dirección en la que escuchar (por defecto, solo este equipo; \"\" = todas)")
+    ordenes.add_parser("estado-sincronizacion", help="Muestra el ID de la tienda y lo recibido de las demás")
+    ordenes.add_parser("nuevo-nodo", help="Nueva identidad para una tienda creada copiando la base de datos de otra")
+    orden_integridad = ordenes.add_parser("comprobar-integridad", help="Busca incoherencias entre facturas, historial, productos y clientes")
+    orden_integridad.add_argument("--reparar", action="store_true", help="Repara en una transacción lo que se puede reparar")
+    orden_integridad.add_argument("--ejemplos", type=int, default=10, help="Filas de ejemplo que se muestran por comprobación")
+    orden_carga = ordenes.add_parser("prueba-carga", help="Simula varias cajas trabajando a la vez sobre la base de datos")
+    orden_carga.add_argument("--terminales", type=int, default=4, help="Cajas simuladas (un proceso cada una)")
+    orden_carga.add_argument("--duracion", type=float, default=30.0, help="Segundos de prueba")
+    orden_carga.add_argument("--conexion", choices=("por-llamada", "persistente"), default="por-llamada",
+                             help="Una conexión por llamada (como el programa) o una por proceso")
+    orden_carga.add_argument("--diario", choices=MODOS_DIARIO, help="PRAGMA journal_mode (por defecto, el de la base)")
+    orden_carga.add_argument("--sincronizacion", choices=MODOS_SINCRONIZACION, help="PRAGMA synchronous")
+    orden_carga.add_argument("--espera", type=float, default=5.0, help="Segundos de espera si la base está bloqueada")
+    orden_carga.add_argument("--cobro", choices=("lineas", "transaccion"), default="lineas",
+                             help="Cobro línea a línea como generar_ticket o en una transacción con registrar_venta")
+    orden_carga.add_argument("--lineas", type=int, default=10, help="Máximo de líneas por venta")
+    orden_carga.add_argument("--busquedas", type=float, default=0.2, help="Probabilidad de una búsqueda tras cada venta")
+    orden_carga.add_argument("--informes", type=float, default=0.05, help="Probabilidad de un informe tras cada venta")
+    orden_carga.add_argument("--pausa", type=float, default=0, help="Milisegundos medios entre operaciones (0: sin pausa)")
+    orden_carga.add_argument("--productos", type=int, default=2000, help="Productos ficticios si la base no tiene catálogo")
+    orden_carga.add_argument("--base", help="Base de datos a usar tal cual (por defecto, una copia temporal de la de la tienda)")
+    orden_carga.add_argument("--semilla", type=int, default=1)
+    orden_carga.add_argument("--json", help="Guarda el resultado en este archivo para comparar configuraciones")
+
+    args = parser.parse_args(argv)
+    if args.tienda:
+        if args.tienda not in tiendas_configuradas():
+            parser.error(f"La tienda {args.tienda} no está en {ruta_configuracion()}")
+        os.environ["FERRETERIA_TIENDA"] = args.tienda
+
+    if args.orden is None:
+        crear_ventana_principal()
+    elif args.orden == "copia":
+        print(hacer_copia_seguridad(args.directorio))
+    elif args.orden == "listar-copias":
+        for ruta in listar_copias():
+            print(f"{ruta}\t{os.path.getsize(ruta)} bytes")
+    elif args.orden == "verificar-copia":
+        correcta, mensaje = verificar_copia(args.archivo)
+        print(mensaje)
+        return 0 if correcta else 1
+    elif args.orden == "restaurar":
+        restaurar_copia(args.archivo)
+        print(f"Base de datos restaurada desde {args.archivo}")
+    elif args.orden == "benchmark-copia":
+        resultado = medir_impacto_copia(args.ventas, args.filas)
+        print(f"Duración de la copia: {resultado['duracion_copia_s']:.2f} s")
+        for nombre in ("sin_copia", "durante_copia"):
+            datos = resultado[nombre]
+            print(f"{nombre:>14}: {datos['ventas']} ventas, p50 {datos['p50_ms']:.2f} ms, "
+                  f"p95 {datos['p95_ms']:.2f} ms, máx {datos['max_ms']:.2f} ms")
+    elif args.orden in ("exportar-facturae", "exportar-verifactu"):
+        crear_tablas()
+        exportar = exportar_facturae if args.orden == "exportar-facturae" else exportar_verifactu
+        for ruta in exportar(args.desde, args.hasta, args.directorio):
+            print(ruta)
+    elif args.orden == "ajustes":
+        print(f"# Archivo de configuración: {ruta_configuracion()}")
+        for clave, valor in recargar_ajustes().items():
+            if clave == "clave_sincronizacion" and valor:
+                valor = "********"
+            print(f"{clave} = {valor!r}")
+    elif args.orden == "verificar-registros":
+        crear_tablas()
+        erroneos = verificar_cadena_registros()
+        if erroneos:
+            print(f"La cadena no cuadra en {len(erroneos)} facturas: {', '.join(map(str, erroneos[:20]))}")
+            return 1
+        print("Cadena de registros correcta")
+    elif args.orden == "facturar-albaranes":
+        crear_tablas()
+        ids_facturas, rutas = facturar_albaranes(args.desde, args.hasta, args.directorio)
+        print(f"{len(ids_facturas)} facturas generadas")
+        for ruta in rutas:
+            print(ruta)
+    elif args.orden == "sincronizar":
+        crear_tablas()
+        recibidos, enviados = sincronizar(args.destino)
+        print(f"{recibidos} cambios recibidos, {enviados} enviados")
+    elif args.orden == "servidor-sincronizacion":
+        crear_tablas()
+        print(f"Esperando sincronizaciones en {args.host or 'todas las interfaces'}, puerto {args.puerto}")
+
+        def avisar(direccion, resultado, error):
+            if error:
+                print(f"{direccion[0]}: error {error}", file=sys.stderr)
+            else:
+                print(f"{direccion[0]}: tienda {resultado[0]}, {resultado[1]} cambios recibidos, {resultado[2]} enviados")
+
+        servir_sincronizacion(args.puerto, args.host, avisar)
+    elif args.orden == "estado-sincronizacion":
+        crear_tablas()
+        local, pendientes, remotos = estado_sincronizacion()
+        print(f"Tienda {local}: {pendientes} cambios sin exportar a la carpeta compartida")
+        for nodo, recibido, actualizado in remotos:
+            print(f"{nodo}\trecibido hasta {recibido}\t{actualizado or ''}")
+    elif args.orden == "nuevo-nodo":
+        crear_tablas()
+        print(f"Nuevo ID de tienda: {nuevo_nodo()}")
+    elif args.orden == "comprobar-integridad":
+        crear_tablas()
+        pendientes = 0
+        for clave, descripcion, filas, reparada in comprobar_coherencia(args.reparar):
+            print(f"{descripcion}: {len(filas)}{' (reparado)' if reparada else ''}")
+            for referencia, detalle in filas[:args.ejemplos]:
+                print(f"    {referencia}\t{detalle}")
+            if filas and not reparada:
+                pendientes += 1
+        return 1 if pendientes else 0
+    elif args.orden == "prueba-carga":
+        resultado = prueba_de_carga(args.terminales, args.duracion, args.conexion, args.diario, args.sincronizacion,
+                                    args.espera, args.cobro, args.lineas, args.busquedas, args.informes, args.pausa,
+                                    args.productos, args.base, args.semilla)
+        print(f"{args.terminales} cajas durante {resultado['segundos']:.1f} s; conexión {args.conexion}, "
+              f"diario {args.diario or 'de la base'}, cobro {args.cobro}")
+        print(f"{'operación':<10}{'total':>9}{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'máx ms':>9}{'bloqueos':>10}{'errores':>9}")
+        for operacion, datos in resultado["operaciones"].items():
+            print(f"{operacion:<10}{datos['total']:>9}{datos['por_segundo']:>9.1f}{datos['p50_ms']:>9.2f}{datos['p95_ms']:>9.2f}"
+                  f"{datos['p99_ms']:>9.2f}{datos['max_ms']:>9.2f}{datos['bloqueos']:>10}{datos['errores']:>9}")
+        print(f"Documentos con número repetido: {resultado['documentos_repetidos']}")
+        for operacion, mensaje in resultado["mensajes"].items():
+            print(f"Error en {operacion}: {mensaje}", file=sys.stderr)
+        for fallo in resultado["fallos"]:
+            print(fallo, file=sys.stderr)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(resultado, f, ensure_ascii=False, indent=2)
+        total = resultado["operaciones"]["total"]
+        return 1 if total["bloqueos"] or total["errores"] or resultado["fallos"] else 0
+    return 0
+
 
 # Iniciar la ventana principal
-crear_ventana_principal()
+if __name__ == "__main__":
+    sys.exit(main())
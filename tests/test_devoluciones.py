@@ -0,0 +1,46 @@
+"""Devoluciones contra albaranes facturados y su factura consolidada."""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import facturacion
+
+
+class DevolucionAlbaranFacturado(unittest.TestCase):
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        entorno = mock.patch.dict(os.environ, {
+            "HOME": self.directorio,
+            "FERRETERIA_CONFIG": os.path.join(self.directorio, "ferreteria.toml"),
+            "FERRETERIA_DB": os.path.join(self.directorio, "ferreteria.db"),
+        })
+        entorno.start()
+        self.addCleanup(entorno.stop)
+        self.addCleanup(shutil.rmtree, self.directorio)
+        facturacion.crear_tablas()
+        facturacion.añadir_producto("Martillo", "111", "", 10.0, 5)
+        self.id_albaran = facturacion.generar_id_factura()
+        facturacion.registrar_albaran(self.id_albaran, "Obras SL", "Calle 1", "2026-01-10 10:00:00",
+                                      [("Martillo", 2, 10.0, 20.0)])
+        self.id_factura, = facturacion.consolidar_albaranes()
+
+    def test_no_se_devuelve_dos_veces(self):
+        facturacion.registrar_devolucion(self.id_factura, [("Martillo", 2)])
+        self.assertEqual(facturacion.lineas_devolubles(self.id_factura), [("Martillo", 2, 2, 10.0)])
+        with self.assertRaises(ValueError):
+            facturacion.registrar_devolucion(self.id_albaran, [("Martillo", 2)])
+        with self.assertRaises(ValueError):
+            facturacion.registrar_devolucion(self.id_factura, [("Martillo", 1)])
+
+    def test_albaran_facturado_se_devuelve_contra_la_factura(self):
+        self.assertEqual(facturacion.factura_de_albaran(self.id_albaran), self.id_factura)
+        with self.assertRaises(ValueError):
+            facturacion.registrar_devolucion(self.id_albaran, [("Martillo", 1)])
+        facturacion.registrar_devolucion(self.id_factura, [("Martillo", 1)])
+        self.assertEqual(facturacion.lineas_devolubles(self.id_factura), [("Martillo", 2, 1, 10.0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
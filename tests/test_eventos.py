@@ -0,0 +1,55 @@
+"""Bus de avisos y refresco de muchas filas a la vez."""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import facturacion
+
+
+class BusDeAvisos(unittest.TestCase):
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        entorno = mock.patch.dict(os.environ, {
+            "HOME": self.directorio,
+            "FERRETERIA_CONFIG": os.path.join(self.directorio, "ferreteria.toml"),
+            "FERRETERIA_DB": os.path.join(self.directorio, "ferreteria.db"),
+        })
+        entorno.start()
+        self.addCleanup(entorno.stop)
+        self.addCleanup(shutil.rmtree, self.directorio)
+        facturacion.crear_tablas()
+
+    def test_un_suscriptor_que_falla_no_corta_la_entrega(self):
+        bus = facturacion.BusEventos()
+        recibidos, mensajes = [], []
+
+        def falla(ids):
+            raise RuntimeError("fila desaparecida")
+
+        bus.suscribir(facturacion.EVENTO_MENSAJE, mensajes.append)
+        bus.suscribir(facturacion.EVENTO_PRODUCTO, falla)
+        bus.suscribir(facturacion.EVENTO_PRODUCTO, recibidos.append)
+        bus.suscribir(facturacion.EVENTO_CLIENTE, recibidos.append)
+        bus.publicar(facturacion.EVENTO_PRODUCTO, [1])
+        bus.publicar(facturacion.EVENTO_CLIENTE, [2])
+
+        self.assertEqual(bus.entregar(), 2)
+        self.assertEqual(recibidos, [{1}, {2}])
+        bus.entregar()
+        self.assertEqual(len(mensajes), 1)
+        self.assertIn("fila desaparecida", mensajes[0])
+
+    def test_muchos_ids_en_una_consulta(self):
+        conn = facturacion.conectar_db()
+        conn.executemany("INSERT INTO productos (nombre, codigo, precio, cantidad) VALUES (?, ?, 1, 1)",
+                         [(f"Producto {i}", str(i)) for i in range(40000)])
+        conn.commit()
+        conn.close()
+        ids = [str(i) for i in range(1, 40001)]
+        self.assertEqual(len(facturacion.obtener_productos(ids)), 40000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+"""Cola de impresión compartida por varias cajas."""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import facturacion
+
+
+class ColaImpresionPorCaja(unittest.TestCase):
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        entorno = mock.patch.dict(os.environ, {
+            "HOME": self.directorio,
+            "FERRETERIA_CONFIG": os.path.join(self.directorio, "ferreteria.toml"),
+            "FERRETERIA_DB": os.path.join(self.directorio, "ferreteria.db"),
+            "FERRETERIA_CAJA": "caja1",
+        })
+        entorno.start()
+        self.addCleanup(entorno.stop)
+        self.addCleanup(shutil.rmtree, self.directorio)
+        facturacion.crear_tablas()
+        self.destino = f"archivo:{self.directorio}"
+
+    def encolar(self, caja, documento):
+        os.environ["FERRETERIA_CAJA"] = caja
+        return facturacion.encolar_impresion(documento, "pdf", b"%PDF", self.destino)
+
+    def test_cada_caja_imprime_los_suyos(self):
+        propio = self.encolar("caja1", "propio")
+        ajeno = self.encolar("caja2", "ajeno")
+
+        os.environ["FERRETERIA_CAJA"] = "caja1"
+        self.assertEqual(facturacion.procesar_cola_impresion(), 1)
+        self.assertEqual(facturacion.estado_trabajo_impresion(propio)[0], "impreso")
+        self.assertEqual(facturacion.estado_trabajo_impresion(ajeno)[0], "pendiente")
+        self.assertEqual([trabajo[1] for trabajo in facturacion.obtener_cola_impresion()], ["propio"])
+
+
+if __name__ == "__main__":
+    unittest.main()
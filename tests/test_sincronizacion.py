@@ -0,0 +1,150 @@
+"""Sincronización entre dos tiendas con bases de datos temporales."""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import facturacion
+
+
+class SincronizacionEntreTiendas(unittest.TestCase):
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp()
+        self.carpeta = os.path.join(self.directorio, "compartida")
+        os.makedirs(self.carpeta)
+        entorno = mock.patch.dict(os.environ, {
+            "HOME": self.directorio,
+            "FERRETERIA_CONFIG": os.path.join(self.directorio, "ferreteria.toml"),
+        })
+        entorno.start()
+        self.addCleanup(entorno.stop)
+        self.addCleanup(shutil.rmtree, self.directorio)
+        for tienda in ("a", "b"):
+            self.usar(tienda)
+            facturacion.crear_tablas()
+
+    def usar(self, tienda):
+        os.environ["FERRETERIA_DB"] = os.path.join(self.directorio, f"{tienda}.db")
+
+    def consultar(self, tienda, sql):
+        self.usar(tienda)
+        conn = facturacion.conectar_db()
+        try:
+            return sorted(conn.execute(sql).fetchall())
+        finally:
+            conn.close()
+
+    def productos(self, tienda):
+        return self.consultar(tienda, "SELECT uid, codigo, nombre, precio, cantidad FROM productos")
+
+    def sincronizar(self, rondas=2):
+        for _ in range(rondas):
+            for tienda in ("a", "b"):
+                self.usar(tienda)
+                facturacion.sincronizar_carpeta(self.carpeta)
+
+    def test_convergen(self):
+        self.usar("a")
+        facturacion.añadir_producto("Martillo", "8400000000017", "", 12.5, 10)
+        facturacion.añadir_cliente("B12345678", "Obras SL", "", "", "", "", "", "", "")
+        self.usar("b")
+        facturacion.añadir_producto("Alicates", "8400000000024", "", 8.0, 4)
+        self.sincronizar()
+
+        self.usar("b")
+        conn = facturacion.conectar_db()
+        conn.execute("UPDATE productos SET precio = 13, cantidad = cantidad - 2 WHERE nombre = 'Martillo'")
+        conn.commit()
+        conn.close()
+        self.usar("a")
+        conn = facturacion.conectar_db()
+        conn.execute("UPDATE productos SET cantidad = cantidad - 1 WHERE nombre = 'Martillo'")
+        conn.execute("DELETE FROM productos WHERE nombre = 'Alicates'")
+        conn.commit()
+        conn.close()
+        self.sincronizar()
+
+        self.assertEqual(self.productos("a"), self.productos("b"))
+        self.assertEqual([fila[2:] for fila in self.productos("a")], [("Martillo", 13.0, 7)])
+        self.assertEqual(self.consultar("a", "SELECT uid, nombre_fiscal FROM clientes"),
+                         self.consultar("b", "SELECT uid, nombre_fiscal FROM clientes"))
+
+    def test_mismo_conjunto_dos_veces(self):
+        self.usar("a")
+        facturacion.añadir_producto("Martillo", "8400000000017", "", 12.5, 10)
+        conn = facturacion.conectar_db()
+        conjunto = facturacion.conjunto_cambios(conn.cursor(), 0)
+        conn.close()
+
+        self.usar("b")
+        nuevos, recibido = facturacion.aplicar_cambios(conjunto)
+        self.assertEqual(nuevos, len(conjunto["cambios"]))
+        self.assertEqual(facturacion.aplicar_cambios(conjunto), (0, recibido))
+        self.assertEqual(self.productos("a"), self.productos("b"))
+
+    def test_codigo_de_barras_compartido(self):
+        self.usar("a")
+        facturacion.añadir_producto("Tornillo", "123", "", 0.1, 100)
+        facturacion.añadir_producto("Tuerca", "123", "", 0.05, 50)
+        self.usar("b")
+        facturacion.añadir_producto("Arandela", "123", "", 0.02, 80)
+        self.sincronizar()
+
+        self.assertEqual(self.productos("a"), self.productos("b"))
+        self.assertEqual(sorted(fila[2] for fila in self.productos("a")), ["Arandela", "Tornillo", "Tuerca"])
+
+        self.usar("b")
+        conn = facturacion.conectar_db()
+        conn.execute("DELETE FROM productos WHERE nombre = 'Tuerca'")
+        conn.commit()
+        conn.close()
+        self.sincronizar()
+        self.assertEqual(self.productos("a"), self.productos("b"))
+        self.assertEqual(sorted(fila[2] for fila in self.productos("a")), ["Arandela", "Tornillo"])
+
+    def test_baja_gana_a_un_cambio_posterior(self):
+        self.usar("a")
+        facturacion.añadir_producto("Martillo", "111", "", 10.0, 5)
+        self.sincronizar()
+
+        self.usar("b")
+        conn = facturacion.conectar_db()
+        conn.execute("DELETE FROM productos WHERE nombre = 'Martillo'")
+        conn.commit()
+        conn.close()
+        self.usar("a")
+        conn = facturacion.conectar_db()
+        conn.execute("UPDATE productos SET precio = 12, cantidad = cantidad - 1 WHERE nombre = 'Martillo'")
+        conn.commit()
+        conn.close()
+        self.sincronizar()
+
+        self.assertEqual(self.productos("a"), [])
+        self.assertEqual(self.productos("b"), [])
+
+        self.usar("a")
+        facturacion.añadir_producto("Martillo", "111", "", 12.0, 4)
+        self.sincronizar()
+        self.assertEqual(self.productos("a"), self.productos("b"))
+        self.assertEqual([fila[1:] for fila in self.productos("b")], [("111", "Martillo", 12.0, 4)])
+
+    def test_ventas_de_otra_tienda_en_el_historial(self):
+        self.usar("a")
+        facturacion.registrar_transaccion(1, "ticket", "Martillo", 2, 10.0, 20.0, "2026-03-02 10:00:00")
+        nodo_a = self.consultar("a", "SELECT id_nodo FROM nodo_sincronizacion")[0][0]
+        self.usar("b")
+        facturacion.registrar_transaccion(1, "ticket", "Alicates", 1, 8.0, 8.0, "2026-03-01 09:00:00")
+        self.sincronizar()
+
+        self.usar("b")
+        self.assertEqual(facturacion.tiendas_historial(), [nodo_a])
+        self.assertEqual([fila[2] for fila in facturacion.obtener_historial()], ["Alicates"])
+        self.assertEqual([fila[2:] for fila in facturacion.obtener_historial(tienda=nodo_a)],
+                         [("Martillo", 2, 10.0, 20.0, "2026-03-02 10:00:00", nodo_a)])
+        todas = facturacion.obtener_historial("2026-03-01", "2026-03-31", tienda=facturacion.TODAS_LAS_TIENDAS)
+        self.assertEqual([(fila[2], fila[7]) for fila in todas], [("Martillo", nodo_a), ("Alicates", None)])
+
+
+if __name__ == "__main__":
+    unittest.main()